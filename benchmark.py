@@ -0,0 +1,163 @@
+#!/usr/bin/python3
+
+########################################################################
+#
+#  Speare2Brain, the Shakespeare -> Brainfuck transpiler
+#
+#  Copyright (C) 2014 Matthew Darby
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or (at
+#  your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful, but
+#  WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#  General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+#  USA.
+#
+########################################################################
+"""Compiles every play in the examples directory, timing each phase,
+and runs the results on fixed inputs to count the steps they take.
+
+    ./benchmark.py > results.json
+    ./benchmark.py --compare results.json
+
+Comparing against an earlier run prints a table and flags any program
+that got bigger, slower to run, noticeably slower to compile, or whose
+output changed. The exit status is 1 if there were any regressions."""
+import sys, os, argparse, json, time, io, glob, hashlib
+import brainfuck, nspl2bf
+from speare2brain import spl_to_nspl
+
+# What each example reads from stdin while being run
+INPUTS = {"guess.spl": b"50\n",
+          "primes.spl": b"30\n",
+          "reverse.spl": b"Shakespeare\n"}
+
+# Compile times are noisy, so only count a slowdown by more than both
+# this fraction and this many seconds
+TIME_TOLERANCE = 0.2
+TIME_SLACK = 0.01
+
+def benchmark_program(filename, args):
+    """Compiles and runs one play, returning a dict of measurements.
+    Each compile phase reports the best of args.repeat timings."""
+    name = os.path.basename(filename)
+    result = {"error": None}
+    with open(filename, "rb") as f:
+        source = f.read()
+    best = {}
+    for attempt in range(args.repeat):
+        start = time.time()
+        text, messages = spl_to_nspl(source)
+        timings = {"spl2nspl": time.time() - start}
+        if text is None:
+            result["error"] = messages.strip()
+            return result
+        program, report = nspl2bf.transpile(text, args.layout,
+                                            args.dispatch, args.cell_bits,
+                                            timings)
+        for phase, seconds in timings.items():
+            best[phase] = min(best.get(phase, seconds), seconds)
+    for phase, seconds in best.items():
+        result[phase + "_seconds"] = seconds
+    result["bytes"] = len(brainfuck.to_brainfuck(program))
+
+    output = io.BytesIO()
+    try:
+        result["steps"] = brainfuck.run(program, args.cell_bits,
+                                        stdin=io.BytesIO(INPUTS.get(name,
+                                                                    b"")),
+                                        stdout=output,
+                                        max_steps=args.max_steps)
+    except (IndexError, RuntimeError) as error:
+        result["error"] = str(error)
+    result["output_sha256"] = hashlib.sha256(output.getvalue()).hexdigest()
+    return result
+
+def compare(baseline, results):
+    """Prints each measurement next to its baseline, and returns the
+    list of regressions"""
+    regressions = []
+    print("%-16s %-18s %14s %14s" % ("program", "measurement",
+                                     "baseline", "now"))
+    for name, now in sorted(results["programs"].items()):
+        before = baseline["programs"].get(name)
+        if before is None:
+            print("%-16s new" % name)
+            continue
+        for measurement in sorted(now):
+            old, new = before.get(measurement), now[measurement]
+            if measurement.endswith("_seconds"):
+                worse = (old is not None and
+                         new > old * (1 + TIME_TOLERANCE) and
+                         new > old + TIME_SLACK)
+                print("%-16s %-18s %14.4f %14.4f%s" % (
+                    name, measurement, old or 0, new,
+                    "  SLOWER" if worse else ""))
+            elif measurement in ("bytes", "steps"):
+                worse = old is not None and new is not None and new > old
+                print("%-16s %-18s %14s %14s%s" % (
+                    name, measurement, old, new, "  WORSE" if worse else ""))
+            else:
+                worse = old != new
+                if worse:
+                    print("%-16s %-18s changed" % (name, measurement))
+            if worse:
+                regressions.append((name, measurement))
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        usage="./benchmark.py [options] > results.json")
+    parser.add_argument("--examples", metavar="DIR",
+                        default=os.path.join(
+                            os.path.dirname(os.path.realpath(__file__)),
+                            "examples"),
+                        help="directory of .spl files to benchmark")
+    parser.add_argument("--compare", metavar="JSON",
+                        help="compare against the results of an earlier "
+                        "run instead of printing JSON")
+    parser.add_argument("--output", metavar="JSON",
+                        help="also write the results to this file")
+    parser.add_argument("--repeat", type=int, default=3,
+                        help="compile each play this many times and keep "
+                        "the best times")
+    parser.add_argument("--max-steps", type=int, default=50000000,
+                        help="give up running a play after this many steps")
+    nspl2bf.add_arguments(parser)
+    args = parser.parse_args()
+    # Compile for the width the plays are run at
+    args.cell_bits = args.cell_bits or nspl2bf.DEFAULT_CELL_BITS
+
+    results = {"options": {"layout": args.layout,
+                           "dispatch": args.dispatch,
+                           "cell_bits": args.cell_bits},
+               "programs": {}}
+    for filename in sorted(glob.glob(os.path.join(args.examples, "*.spl"))):
+        print("Benchmarking " + filename, file=sys.stderr)
+        results["programs"][os.path.basename(filename)] = \
+            benchmark_program(filename, args)
+    text = json.dumps(results, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    if not args.compare:
+        print(text)
+        sys.exit(0)
+    with open(args.compare) as f:
+        baseline = json.load(f)
+    if baseline.get("options") != results["options"]:
+        print("Warning: the baseline was run with different options",
+              file=sys.stderr)
+    regressions = compare(baseline, results)
+    if regressions:
+        print("%d regressions" % len(regressions))
+        sys.exit(1)
+    print("No regressions")
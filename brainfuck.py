@@ -0,0 +1,627 @@
+#!/usr/bin/python3
+
+########################################################################
+#
+#  Speare2Brain, the Shakespeare -> Brainfuck transpiler
+#
+#  Copyright (C) 2014 Matthew Darby
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or (at
+#  your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful, but
+#  WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#  General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+#  USA.
+#
+########################################################################
+"""A run-length encoded intermediate representation of Brainfuck.
+
+A program is a list of operations, each a (kind, argument) tuple:
+
+    (ADD, n)      - add n (possibly negative) to the current cell
+    (MOVE, n)     - move the pointer n cells (possibly negative)
+    (LOOP, body)  - run the list of operations in body while the
+                    current cell is non-zero
+    (OUTPUT, None), (INPUT, None), (DEBUG, None) - '.', ',' and '#'
+    (SET, n)      - set the current cell to n, i.e. [-] followed by adds
+    (MUL, terms)  - a multiply loop: for each (offset, factor) in terms,
+                    add factor times the current cell to the cell at
+                    offset, then clear the current cell
+    (MARK, label) - does nothing, but everything up to the next MARK
+                    was generated on behalf of label
+
+SET and MUL are only ever produced by the optimiser. MARKs let the
+code a compiler generates be traced back to what generated it; the
+optimiser moves code across them freely, so the attribution is only
+approximate where code was merged.
+
+Programs can be run directly with run(), which first links them into a
+flat array of instructions with precomputed jump targets."""
+import sys
+
+ADD = "add"
+MOVE = "move"
+LOOP = "loop"
+OUTPUT = "output"
+INPUT = "input"
+DEBUG = "debug"
+SET = "set"
+MUL = "mul"
+MARK = "mark"
+
+class ProgramBuilder:
+    """Builds a program incrementally from fragments of Brainfuck text,
+    merging runs of +- and <> as they arrive"""
+    def __init__(self):
+        self.program = []
+        self.open_loops = []
+
+    def write(self, brainfuck):
+        ops = self.program
+        for command in brainfuck:
+            if command == "+" or command == "-":
+                self._merge(ADD, 1 if command == "+" else -1)
+            elif command == ">" or command == "<":
+                self._merge(MOVE, 1 if command == ">" else -1)
+            elif command == "[":
+                self.open_loops.append(ops)
+                ops = []
+                self.program = ops
+            elif command == "]":
+                if not self.open_loops:
+                    raise ValueError("Unbalanced ']' in Brainfuck program")
+                body = ops
+                ops = self.open_loops.pop()
+                ops.append((LOOP, body))
+                self.program = ops
+            elif command == ".":
+                ops.append((OUTPUT, None))
+            elif command == ",":
+                ops.append((INPUT, None))
+            elif command == "#":
+                ops.append((DEBUG, None))
+
+    def mark(self, label):
+        self.program.append((MARK, label))
+
+    def _merge(self, kind, amount):
+        ops = self.program
+        if ops and ops[-1][0] == kind:
+            amount += ops[-1][1]
+            ops.pop()
+        if amount:
+            ops.append((kind, amount))
+
+    def getvalue(self):
+        if self.open_loops:
+            raise ValueError("Unbalanced '[' in Brainfuck program")
+        return self.program
+
+def parse(brainfuck):
+    """Converts Brainfuck text into a run-length encoded program"""
+    builder = ProgramBuilder()
+    builder.write(brainfuck)
+    return builder.getvalue()
+
+def optimise(program, cell_bits=None):
+    """Runs the peephole passes over a program until it stops shrinking:
+    +- and <> cancellation, clear and multiply loop recognition, and
+    removal of loops and clears that act on cells known to be zero. If
+    the width of the cells is known, amounts are then wrapped to go the
+    shorter way round."""
+    previous_size = None
+    size = program_size(program)
+    while size != previous_size:
+        program = _merge_adjacent(_recognise_loops(program))
+        program = _merge_adjacent(_fold_known_values(program, {}, 0))
+        program = _drop_trailing_operations(program)
+        previous_size, size = size, program_size(program)
+    if cell_bits is not None:
+        program = _wrap_amounts(program, 2 ** cell_bits)
+    return program
+
+def program_size(program):
+    """Returns the number of operations in a program, counting those
+    inside loops"""
+    size = 0
+    for kind, argument in program:
+        size += 1
+        if kind == LOOP:
+            size += program_size(argument)
+    return size
+
+def _recognise_loops(program):
+    """Replaces [-] style loops with SET and loops that only shuffle a
+    value around with MUL"""
+    result = []
+    for kind, argument in program:
+        if kind == LOOP:
+            body = _merge_adjacent(_recognise_loops(argument))
+            replacement = _simple_loop(body)
+            result.append(replacement if replacement else (LOOP, body))
+        else:
+            result.append((kind, argument))
+    return result
+
+def _simple_loop(body):
+    """Returns a SET or MUL equivalent to the given loop body, or None
+    if the loop is not that simple"""
+    body = [operation for operation in body if operation[0] != MARK]
+    if len(body) == 1 and body[0][0] == ADD and body[0][1] in (1, -1):
+        return (SET, 0)
+    position = 0
+    changes = {}
+    for kind, argument in body:
+        if kind == ADD:
+            changes[position] = changes.get(position, 0) + argument
+        elif kind == MOVE:
+            position += argument
+        else:
+            return None
+    if position != 0 or changes.get(0) != -1:
+        return None
+    terms = tuple(sorted((offset, factor) for offset, factor
+                         in changes.items() if offset != 0 and factor))
+    return (MUL, terms)
+
+def _merge_adjacent(program):
+    """Merges neighbouring operations that act on the same cell and
+    drops operations that cancel out"""
+    result = []
+    for kind, argument in program:
+        if kind == LOOP:
+            argument = _merge_adjacent(argument)
+        elif (kind == ADD or kind == MOVE) and not argument:
+            continue
+        # Look straight through MARKs, they don't do anything
+        last = len(result) - 1
+        while last >= 0 and result[last][0] == MARK:
+            last -= 1
+        if last >= 0 and kind != MARK:
+            last_kind, last_argument = result[last]
+            if kind == last_kind and (kind == ADD or kind == MOVE):
+                del result[last]
+                if last_argument + argument:
+                    result.insert(last, (kind, last_argument + argument))
+                continue
+            if last_kind == SET and kind == ADD:
+                result[last] = (SET, last_argument + argument)
+                continue
+            if kind == SET and last_kind in (ADD, SET):
+                result[last] = (SET, argument)
+                continue
+        result.append((kind, argument))
+    return result
+
+def _fold_known_values(program, values, default):
+    """Tracks the values of cells relative to the pointer through
+    straight-line code. Loops, clears and multiplies on a cell known to
+    be zero are dropped, and SETs on known cells become plain ADDs.
+    values maps relative offsets to known values (None if unknown) and
+    default is the value of every cell not in values."""
+    result = []
+    position = 0
+    for kind, argument in program:
+        current = values.get(position, default)
+        if kind == ADD:
+            if current is not None:
+                values[position] = current + argument
+        elif kind == MOVE:
+            position += argument
+        elif kind == SET:
+            values[position] = argument
+            if current is not None:
+                if current == argument:
+                    continue
+                kind, argument = ADD, argument - current
+        elif kind == INPUT:
+            values[position] = None
+        elif kind == MUL:
+            if current == 0:
+                continue
+            for offset, factor in argument:
+                target = values.get(position + offset, default)
+                if current is None or target is None:
+                    values[position + offset] = None
+                else:
+                    values[position + offset] = target + current * factor
+            values[position] = 0
+        elif kind == LOOP:
+            if current == 0:
+                continue
+            argument = _fold_known_values(argument, {}, None)
+            written = _cells_written(argument)
+            if written is None:
+                # The loop leaves the pointer somewhere unknown, so the
+                # only thing we still know is the cell we stopped on
+                values.clear()
+                default = None
+                position = 0
+            else:
+                for offset in written:
+                    values[position + offset] = None
+            values[position] = 0
+        result.append((kind, argument))
+    return result
+
+def _cells_written(program):
+    """Returns the set of offsets, relative to the starting pointer,
+    that a program may write to. Returns None if the program does not
+    return the pointer to where it started."""
+    written = set()
+    position = 0
+    for kind, argument in program:
+        if kind == MOVE:
+            position += argument
+        elif kind in (ADD, SET, INPUT):
+            written.add(position)
+        elif kind == MUL:
+            written.add(position)
+            written.update(position + offset for offset, factor in argument)
+        elif kind == LOOP:
+            inner = _cells_written(argument)
+            if inner is None:
+                return None
+            written.update(position + offset for offset in inner)
+    if position != 0:
+        return None
+    return written
+
+def _wrap_amounts(program, modulus):
+    """Replaces every amount added, set or multiplied by with the
+    equivalent amount modulo the cell size that is nearest zero"""
+    def wrap(amount):
+        amount %= modulus
+        return amount - modulus if amount > modulus // 2 else amount
+    result = []
+    for kind, argument in program:
+        if kind == LOOP:
+            argument = _wrap_amounts(argument, modulus)
+        elif kind in (ADD, SET):
+            argument = wrap(argument)
+            if kind == ADD and not argument:
+                continue
+        elif kind == MUL:
+            argument = tuple((offset, wrap(factor))
+                             for offset, factor in argument)
+        result.append((kind, argument))
+    return result
+
+def _drop_trailing_operations(program):
+    """Operations after the last loop or I/O cannot be observed"""
+    end = len(program)
+    while end and program[end - 1][0] in (ADD, MOVE, SET, MUL, MARK):
+        end -= 1
+    return program[:end]
+
+def to_brainfuck(program):
+    """Converts a program back into Brainfuck text"""
+    fragments = []
+    _write_brainfuck(program, fragments)
+    return "".join(fragments)
+
+def label_ranges(program):
+    """Returns a list of (start, end, label) giving the range of
+    to_brainfuck(program) written under each MARK label, in order.
+    Neighbouring ranges never share a label, and commands before the
+    first MARK come under None."""
+    ranges = []
+    current = [None]
+
+    def count(size):
+        if not size:
+            return
+        if ranges and ranges[-1][2] == current[0]:
+            start, end, label = ranges.pop()
+        else:
+            start = end = ranges[-1][1] if ranges else 0
+        ranges.append((start, end + size, current[0]))
+
+    def walk(program):
+        for kind, argument in program:
+            if kind == MARK:
+                current[0] = argument
+            elif kind == LOOP:
+                count(1)
+                walk(argument)
+                count(1)
+            else:
+                count(len(to_brainfuck([(kind, argument)])))
+    walk(program)
+    return ranges
+
+def label_sizes(program):
+    """Returns a map from each MARK label to the number of Brainfuck
+    commands written under it, see label_ranges"""
+    sizes = {}
+    for start, end, label in label_ranges(program):
+        sizes[label] = sizes.get(label, 0) + end - start
+    return sizes
+
+def _write_brainfuck(program, fragments):
+    for kind, argument in program:
+        if kind == ADD:
+            fragments.append("+" * argument if argument > 0
+                             else "-" * -argument)
+        elif kind == MOVE:
+            fragments.append(">" * argument if argument > 0
+                             else "<" * -argument)
+        elif kind == LOOP:
+            fragments.append("[")
+            _write_brainfuck(argument, fragments)
+            fragments.append("]")
+        elif kind == OUTPUT:
+            fragments.append(".")
+        elif kind == INPUT:
+            fragments.append(",")
+        elif kind == DEBUG:
+            fragments.append("#")
+        elif kind == SET:
+            fragments.append("[-]")
+            _write_brainfuck([(ADD, argument)], fragments)
+        elif kind == MUL:
+            loop_body = [(ADD, -1)]
+            position = 0
+            for offset, factor in argument:
+                loop_body.append((MOVE, offset - position))
+                loop_body.append((ADD, factor))
+                position = offset
+            loop_body.append((MOVE, -position))
+            _write_brainfuck([(LOOP, _merge_adjacent(loop_body))], fragments)
+
+def to_c(program, cell_bits=8, tape_size=30000):
+    """Converts a program into a C program. Pointer moves in straight
+    line code are folded into the offsets of the cells it touches, and
+    multiply loops become plain arithmetic. cell_bits of None gives
+    64 bit cells. Input at the end of the stream reads as 0."""
+    cell_type = "int64_t" if cell_bits is None else "uint%d_t" % cell_bits
+    lines = ["#include <stdio.h>",
+             "#include <stdint.h>",
+             "",
+             "static %s tape[%d];" % (cell_type, tape_size),
+             "",
+             "int main(void)",
+             "{",
+             "    %s *p = tape;" % cell_type]
+    _write_c(program, lines, 1)
+    lines += ["    fflush(stdout);",
+              "    return 0;",
+              "}",
+              ""]
+    return "\n".join(lines)
+
+def _write_c(program, lines, depth):
+    indent = "    " * depth
+    position = 0
+    for kind, argument in program:
+        cell = "p[%d]" % position
+        if kind == MOVE:
+            position += argument
+            continue
+        if kind == LOOP:
+            if position:
+                lines.append("%sp += %d;" % (indent, position))
+                position = 0
+            lines.append("%swhile (*p) {" % indent)
+            _write_c(argument, lines, depth + 1)
+            lines.append("%s}" % indent)
+        elif kind == ADD:
+            lines.append("%s%s += %d;" % (indent, cell, argument))
+        elif kind == SET:
+            lines.append("%s%s = %d;" % (indent, cell, argument))
+        elif kind == MUL:
+            for offset, factor in argument:
+                lines.append("%sp[%d] += %s * %d;" % (
+                    indent, position + offset, cell, factor))
+            lines.append("%s%s = 0;" % (indent, cell))
+        elif kind == OUTPUT:
+            lines.append("%sputchar(%s);" % (indent, cell))
+        elif kind == INPUT:
+            lines.append("%sfflush(stdout);" % indent)
+            lines.append("%s{ int c = getchar(); %s = c == EOF ? 0 : c; }" % (
+                indent, cell))
+        elif kind == DEBUG:
+            lines.append('%sfprintf(stderr, "#%%ld: %%ld\\n", '
+                         '(long)(p + %d - tape), (long)%s);' % (
+                             indent, position, cell))
+    if position:
+        lines.append("%sp += %d;" % (indent, position))
+
+# Opcodes of linked programs
+_ADD, _MOVE, _SET, _MUL, _SCAN, _OPEN, _CLOSE, _OUTPUT, _INPUT, _DEBUG = \
+    range(10)
+
+def link(program, labels=None):
+    """Flattens a program into a list of (opcode, argument, extra)
+    instructions for run(). Each loop becomes an _OPEN that jumps past
+    its matching _CLOSE when the cell is zero, and a _CLOSE that jumps
+    back inside the loop while it isn't. Loops that only move the
+    pointer, like [>], become a single _SCAN. If given a list for
+    labels, fills it with the label of the MARK each instruction
+    follows."""
+    code = []
+    _link(program, code, labels, [None])
+    return code
+
+def _link(program, code, labels, current):
+    for kind, argument in program:
+        if kind == MARK:
+            current[0] = argument
+        elif kind == ADD:
+            code.append((_ADD, argument, None))
+        elif kind == MOVE:
+            code.append((_MOVE, argument, None))
+        elif kind == SET:
+            code.append((_SET, argument, None))
+        elif kind == MUL:
+            offsets = [offset for offset, factor in argument] or [0]
+            code.append((_MUL, argument, (min(offsets), max(offsets))))
+        elif kind == LOOP and len(argument) == 1 and argument[0][0] == MOVE:
+            code.append((_SCAN, argument[0][1], None))
+        elif kind == LOOP:
+            # The brackets count towards the label the loop started under
+            start = len(code)
+            code.append(None)
+            owner = current[0]
+            if labels is not None:
+                labels.append(owner)
+            _link(argument, code, labels, current)
+            code.append((_CLOSE, start + 1, None))
+            code[start] = (_OPEN, len(code), None)
+            if labels is not None:
+                labels.append(owner)
+        elif kind == OUTPUT:
+            code.append((_OUTPUT, None, None))
+        elif kind == INPUT:
+            code.append((_INPUT, None, None))
+        elif kind == DEBUG:
+            code.append((_DEBUG, None, None))
+        if labels is not None:
+            labels.extend([current[0]] * (len(code) - len(labels)))
+
+class Profile:
+    """What run() did under each MARK label: how many instructions it
+    executed, and how many times those read or wrote a cell. Moving
+    the pointer doesn't count as touching the tape, but a scan counts
+    every cell it looks at. Also keeps the highest cell touched."""
+    def __init__(self):
+        self.steps = {}
+        self.accesses = {}
+        self.highest_cell = 0
+
+# How much output run holds on to before writing it out, if there's no
+# newline or input to write it out for sooner
+OUTPUT_BUFFER_SIZE = 4096
+
+def run(program, cell_bits=8, tape_size=30000, stdin=None, stdout=None,
+        max_steps=None, profile=None):
+    """Runs a program, reading and writing bytes. cell_bits of None
+    gives unbounded cells. Input at the end of the stream reads as 0.
+    Output is written out at each newline and before reading input, and
+    whatever is left when the program stops, errors included.
+    Raises IndexError if the pointer leaves the tape, and RuntimeError
+    if more than max_steps instructions run. Returns the number of
+    linked instructions executed. If given a Profile, adds to it what
+    the program did, even if it stops with an error."""
+    stdin = stdin or sys.stdin.buffer
+    stdout = stdout or sys.stdout.buffer
+    labels = counts = touched = None
+    if profile is not None:
+        labels = []
+    code = link(program, labels)
+    if profile is not None:
+        counts = [0] * len(code)
+        # Cells touched beyond the one under the pointer
+        touched = [0] * len(code)
+    highest = 0
+    mask = -1 if cell_bits is None else 2 ** cell_bits - 1
+    tape = [0] * tape_size
+    pointer = 0
+    pc = 0
+    steps = 0
+    end = len(code)
+    output = bytearray()
+    if max_steps is None:
+        max_steps = float("inf")
+    try:
+        while pc < end:
+            opcode, argument, extra = code[pc]
+            steps += 1
+            if steps > max_steps:
+                raise RuntimeError("Stopped after %d steps" % max_steps)
+            if counts is not None:
+                counts[pc] += 1
+                if pointer > highest:
+                    highest = pointer
+            pc += 1
+            if opcode == _ADD:
+                tape[pointer] = (tape[pointer] + argument) & mask
+            elif opcode == _MOVE:
+                pointer += argument
+                if not 0 <= pointer < tape_size:
+                    raise IndexError("Pointer moved off the tape to "
+                                     "cell %d" % pointer)
+            elif opcode == _OPEN:
+                if not tape[pointer]:
+                    pc = argument
+            elif opcode == _CLOSE:
+                if tape[pointer]:
+                    pc = argument
+            elif opcode == _SET:
+                tape[pointer] = argument & mask
+            elif opcode == _MUL:
+                value = tape[pointer]
+                if value:
+                    if (pointer + extra[0] < 0 or
+                            pointer + extra[1] >= tape_size):
+                        raise IndexError("Multiply loop off the tape at "
+                                         "cell %d" % pointer)
+                    for offset, factor in argument:
+                        tape[pointer + offset] = (tape[pointer + offset] +
+                                                  value * factor) & mask
+                    tape[pointer] = 0
+                    if touched is not None:
+                        touched[pc - 1] += len(argument)
+                        highest = max(highest, pointer + extra[1])
+            elif opcode == _SCAN:
+                while tape[pointer]:
+                    pointer += argument
+                    if not 0 <= pointer < tape_size:
+                        raise IndexError("Pointer moved off the tape "
+                                         "to cell %d" % pointer)
+                    if touched is not None:
+                        touched[pc - 1] += 1
+                        highest = max(highest, pointer)
+            elif opcode == _OUTPUT:
+                character = tape[pointer] & 0xFF
+                output.append(character)
+                if character == 10 or len(output) >= OUTPUT_BUFFER_SIZE:
+                    stdout.write(output)
+                    stdout.flush()
+                    output.clear()
+            elif opcode == _INPUT:
+                # Whatever was written so far should be seen before waiting
+                stdout.write(output)
+                stdout.flush()
+                output.clear()
+                character = stdin.read(1)
+                tape[pointer] = character[0] if character else 0
+            elif opcode == _DEBUG:
+                stdout.write(output)
+                stdout.flush()
+                output.clear()
+                print("#%d: %s" % (pointer, tape[:16]), file=sys.stderr)
+    finally:
+        stdout.write(output)
+        stdout.flush()
+        if counts is not None:
+            for label, (opcode, argument, extra), count, more in zip(
+                    labels, code, counts, touched):
+                accesses = more + (count if opcode != _MOVE else 0)
+                profile.steps[label] = profile.steps.get(label, 0) + count
+                profile.accesses[label] = (profile.accesses.get(label, 0) +
+                                           accesses)
+            profile.highest_cell = max(profile.highest_cell, highest)
+    return steps
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        print("Usage: ./brainfuck.py input.bf > output.bf")
+        sys.exit(2)
+    filename = sys.argv[1]
+    try:
+        f = open(filename, "r")
+    except IOError:
+        print("Could not find file " + filename, file=sys.stderr)
+        sys.exit(2)
+    text = f.read()
+    f.close()
+    print(to_brainfuck(optimise(parse(text))))
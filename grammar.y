@@ -9,6 +9,8 @@ Changes from the original work present in this file:
   also known as Not-Shakespeare Programming Language.
 * Constant expressions are evaluated as often as possible
   rather than being left in the form 2*2*2*2*1 etc.
+* Statements are preceded by line,N, with the line of the play they
+  end on, so generated code can be traced back to the play.
 
 Based off the work and released under the same license as the below:
 
@@ -51,6 +53,7 @@ USA.
 /* Local function prototypes */
 static void report_error(const char *expected_symbol);
 static void report_warning(const char *expected_symbol);
+static char *line_token(int line);
 
 /* Global variables local to this file */
 static char *current_act = NULL;
@@ -58,6 +61,7 @@ static char *current_scene = NULL;
 static int num_errors = 0;           // error counter
 static int num_warnings = 0;         // warning counter
 static int i;                        // all-purpose counter
+static int first_sentence_line = 0;  // line the current Line's first sentence ends on
 
 %}
 
@@ -340,7 +344,7 @@ PositiveComparative {
 
 Comparison:
 NOT NonnegatedComparison {
-  $$ = cat3(newstr("not,"), $2, newstr("endnot,"));
+  $$ = cat3(newstr("not,"), $2, newstr(",endnot"));
   free($1);
 }|
 NonnegatedComparison {
@@ -629,7 +633,8 @@ RETURN_TO {
 
 Line:
 CHARACTER COLON SentenceList {
-  $$ = cat4(newstr("activate,"), str2varname($1), newstr(",\n"), $3);
+  $$ = cat5(line_token(first_sentence_line),
+	    newstr("activate,"), str2varname($1), newstr(",\n"), $3);
   free($2);
 }|
 CHARACTER COLON error {
@@ -857,13 +862,13 @@ SceneHeader SceneContents {
 
 SceneContents:
 EnterExit {
-  $$ = $1;
+  $$ = cat2(line_token(yylineno), $1);
 }|
 Line {
   $$ = $1;
 }|
 SceneContents EnterExit {
-  $$ = cat2($1, $2);
+  $$ = cat3($1, line_token(yylineno), $2);
 }|
 SceneContents Line {
   $$ = cat2($1, $2);
@@ -894,18 +899,21 @@ SCENE_ROMAN error Comment EndSymbol {
 
 Sentence:
 UnconditionalSentence {
-  $$ = $1;
+  $$ = cat2(line_token(yylineno), $1);
 }|
 Conditional COMMA UnconditionalSentence {
-  $$ = cat5(newstr("if,"), $1, newstr(",\n"), $3, newstr("endif,\n"));
+  $$ = cat6(line_token(yylineno),
+	    newstr("if,"), $1, newstr(",\n"), $3, newstr("endif,\n"));
 }|
 Conditional error UnconditionalSentence {
   report_warning("comma");
-  $$ = cat5(newstr("if,"), $1, newstr(",\n"), $3, newstr("endif,\n"));
+  $$ = cat6(line_token(yylineno),
+	    newstr("if,"), $1, newstr(",\n"), $3, newstr("endif,\n"));
 };
 
 SentenceList:
 Sentence {
+  first_sentence_line = yylineno;
   $$ = $1;
 }|
 SentenceList Sentence {
@@ -1223,6 +1231,15 @@ int yyerror(char *s)
   return 0;
 }
 
+/* Statements are preceded by line,N, with the line of the play they
+   end on, so that generated code can be traced back to it */
+char *line_token(int line)
+{
+  char buffer[32];
+  sprintf(buffer, "line,%d,", line);
+  return newstr(buffer);
+}
+
 void report_error(const char *expected_symbol)
 {
   fprintf(stderr, "Error at line %d: %s expected\n", yylineno, expected_symbol);
@@ -22,11 +22,44 @@
 #  USA.
 #
 ########################################################################
-import sys, re
+import sys, re, argparse, math, time, io, json, heapq
+import brainfuck
 
-class MemoryLayout:
-    """A representation of the Brainfuck memory layout offsets"""
+class RegisterUsage:
+    """Counts how often the pointer visits each cell, and how often it
+    travels between each pair of cells. Visits inside loops are weighted
+    by their loop depth as a rough stand-in for how often they run."""
     def __init__(self):
+        self.visits = {}
+        self.transitions = {}
+        self.last_cell = 0
+
+    def record(self, cell, weight):
+        self.visits[cell] = self.visits.get(cell, 0) + weight
+        if cell != self.last_cell:
+            pair = (min(cell, self.last_cell), max(cell, self.last_cell))
+            self.transitions[pair] = self.transitions.get(pair, 0) + weight
+        self.last_cell = cell
+
+    def travel(self, cell_layout):
+        """Estimates the pointer travel of the recorded transitions if
+        the cells were laid out according to cell_layout"""
+        return sum(weight * abs(cell_layout.get(first, first) -
+                                cell_layout.get(second, second))
+                   for (first, second), weight in self.transitions.items())
+
+class MemoryLayout:
+    """A representation of the Brainfuck memory layout offsets.
+
+    dispatch picks how code that works on "whoever is active" or "whoever
+    is being spoken to" finds that character's register when it isn't
+    known at compile time: "linear" counts down the stored index through
+    one nested loop per character, "binary" keeps each index in binary
+    in a row of bit cells as well, and walks a decision tree over the
+    bits. The binary tree costs a handful of steps per bit instead of a
+    few per character, at the price of splitting the index into bits
+    each time it changes at runtime."""
+    def __init__(self, dispatch="linear"):
         self.pointer = 0
         self.copy_register_offset = 0
         self.result_register_offset = 1
@@ -43,83 +76,419 @@ class MemoryLayout:
         self.characters = ["left"]
         self.character_to_offset = {}
         self.left_register_counter = 0
+        self.bookends = {}
+        self.loop_pointers = []
+        self.cell_layout = {}
+        self.usage = None
+        self.jump_targets = set()
+        self.dispatch = dispatch
+        # Cell width in bits, or None if the interpreter's cells are
+        # unbounded or their width isn't known
+        self.cell_bits = None
+        self.constant_recipes = {}
+        # Whether to MARK the output with what generated it, and the
+        # offset of the token that started the statement being compiled
+        self.marking = False
+        self.statement_offset = None
+        # How deeply binary expressions nest, each level below the
+        # first keeping its Left operand in a cell past the characters
+        self.expression_depth = 0
+        # Characters with a stack, in the order their stacks are
+        # interleaved. None until known, when every character gets one.
+        self.stack_characters = None
+        self.stacked = []
+        # The scene machine, only laid out if the play has gotos: the
+        # tree of scenes to dispatch on, a Running register to loop on,
+        # a Continue register cleared by goto so the rest of the scene
+        # is skipped, two registers for testing bits of the scene code,
+        # and one bit cell per level of the tree
+        self.scene_tree = None
+        self.scene_blocks = {}
+        self.scene_codes = {}
+        self.running_register_offset = None
+        self.continue_register_offset = None
+        self.scene_test_register_offset = None
+        self.scene_else_register_offset = None
+        self.scene_bit_offsets = []
+        self.guards = 0
+        self.guard_pending = False
+        # Whether the play asks questions, divides, reads input or prints
+        # numbers, in which case a block of test cells goes just past
+        # the characters. conditional is "true" or "false" while
+        # compiling the sentence after an if, and unreachable is set
+        # after a goto that is always taken.
+        self.test_cells = False
+        self.conditional = None
+        self.unreachable = False
+        # Cells that hold the digits of a number while it is printed,
+        # after the test cells. Only laid out if the play prints numbers.
+        self.digit_slots = 0
+        # Bit cells for each stage register, least significant first.
+        # Only filled in for binary dispatch.
+        self.index_bit_offsets = {}
+        # The tape starts out zeroed, so nobody is on stage
+        self.known_registers = {self.on_stage_one_register_offset: 0,
+                                self.on_stage_two_register_offset: 0,
+                                self.active_character_register_offset: 0,
+                                self.second_character_register_offset: 0}
+        self.output = brainfuck.ProgramBuilder()
+
+    def emit(self, commands):
+        """Appends raw Brainfuck commands to the output program. Pointer
+        movement must go through move_pointer_to_offset. Loops are kept
+        balanced: a ']' first moves the pointer back to the cell its
+        matching '[' was opened on."""
+        if "[" not in commands and "]" not in commands:
+            self.output.write(commands)
+            return
+        for command in commands:
+            if command == "[":
+                self.loop_pointers.append(self.pointer)
+            elif command == "]":
+                self.move_pointer_to_cell(self.loop_pointers.pop())
+            self.output.write(command)
+
+    def mark(self, name):
+        """Labels the code emitted from here on as generated for name
+        by the current statement, if marking"""
+        if self.marking:
+            self.output.mark((name, self.statement_offset))
 
     def add_character(self, character_name):
         self.characters.append(character_name)
 
     def finalise_characters(self):
         """Calculate the offsets for each character, which is a function
-        of their position in the characters array"""
+        of their position in the characters array. Binary dispatch
+        needs enough bit cells to hold the highest character index, and
+        these go between the registers and the characters."""
+        if self.scene_tree is not None:
+            code_length = max(len(code) for code in self.scene_codes.values())
+            offset = self.first_character_offset
+            self.running_register_offset = offset
+            self.continue_register_offset = offset + 1
+            self.scene_test_register_offset = offset + 2
+            self.scene_else_register_offset = offset + 3
+            self.scene_bit_offsets = list(range(offset + 4,
+                                                offset + 4 + code_length))
+            self.first_character_offset += 4 + code_length
+            # The first block is already running
+            self.add_value_at_offset(1, self.continue_register_offset)
+        if self.dispatch == "binary":
+            bit_count = len(self.characters).bit_length()
+            for register in (self.active_character_register_offset,
+                             self.second_character_register_offset):
+                self.index_bit_offsets[register] = list(range(
+                    self.first_character_offset,
+                    self.first_character_offset + bit_count))
+                for bit_offset in self.index_bit_offsets[register]:
+                    self.set_known_value(bit_offset, 0)
+                self.first_character_offset += bit_count
         for idx, character in enumerate(self.characters):
             self.character_to_offset[character] = (self.first_character_offset +
                                                    idx)
 
+    def known_value(self, offset):
+        """Returns the value a stage register is known to hold at this
+        point of the program at compile time, or None if it can only be
+        known at runtime"""
+        return self.known_registers.get(offset)
+
+    def set_known_value(self, offset, value):
+        """Records the value a stage register will hold at runtime, None
+        meaning it can't be known at compile time"""
+        if value is None:
+            self.known_registers.pop(offset, None)
+        else:
+            self.known_registers[offset] = value
+
+    def forget_known_values(self):
+        """Called wherever control flow can arrive from more than one
+        place, so the stage registers could hold anything"""
+        self.known_registers = {}
+
+    def set_value_at_offset(self, value, offset):
+        """Outputs the Brainfuck commands to set a register to a value
+        known at compile time, and records that value"""
+        self.zero_value_at_offset(offset)
+        self.add_value_at_offset(value, offset)
+        self.set_known_value(offset, value)
+        self.write_index_bits(offset)
+
+    def write_index_bits(self, register):
+        """Brings the bit cells of a stage register up to date after it
+        has been written to, when using binary dispatch. Known indexes are
+        simply set; otherwise the index is halved once per bit into Temp
+        with the remainder landing in the bit cell, using Retrieve and
+        Loop as scratch. This takes steps in proportion to the index."""
+        bits = self.index_bit_offsets.get(register)
+        if not bits:
+            return
+        value = self.known_value(register)
+        if value is not None:
+            for bit, bit_offset in enumerate(bits):
+                if self.known_value(bit_offset) != (value >> bit) & 1:
+                    self.set_value_at_offset((value >> bit) & 1, bit_offset)
+            return
+
+        remaining_offset = self.retrieve_register_offset
+        half_offset = self.temp_register_offset
+        toggle_offset = self.loop_register_offset
+        self.zero_value_at_offset(remaining_offset)
+        self.zero_value_at_offset(half_offset)
+        self.copy_register(register, remaining_offset)
+        for bit_offset in bits:
+            self.zero_value_at_offset(bit_offset)
+            # Flip the bit for every unit of the index, carrying into
+            # Temp each time it goes from one back to zero
+            self.move_pointer_to_offset(remaining_offset)
+            self.emit("[-")
+            self.add_value_at_offset(1, toggle_offset)
+            self.move_pointer_to_offset(bit_offset)
+            self.emit("[-")
+            self.subtract_value_at_offset(1, toggle_offset)
+            self.add_value_at_offset(1, half_offset)
+            self.move_pointer_to_offset(bit_offset)
+            self.emit("]")
+            self.move_pointer_to_offset(toggle_offset)
+            self.emit("[-")
+            self.add_value_at_offset(1, bit_offset)
+            self.move_pointer_to_offset(toggle_offset)
+            self.emit("]")
+            self.move_pointer_to_offset(remaining_offset)
+            self.emit("]")
+            # What was carried is what's left to split up
+            self.move_pointer_to_offset(half_offset)
+            self.emit("[-")
+            self.add_value_at_offset(1, remaining_offset)
+            self.move_pointer_to_offset(half_offset)
+            self.emit("]")
+            self.set_known_value(bit_offset, None)
+
+    def layout_size(self):
+        """Returns the number of cells, registers and characters, that
+        can be rearranged by a cell layout. Stacks stay where they are."""
+        return self.first_character_offset + len(self.characters)
+
+    def offset_names(self):
+        """Returns a map of each register and character offset to a
+        readable name for it"""
+        names = {}
+        for attribute, value in vars(self).items():
+            if attribute.endswith("_register_offset") and value is not None:
+                names[value] = attribute[:-len("_register_offset")]
+        for bit, offset in enumerate(self.scene_bit_offsets):
+            names[offset] = "scene_bit_%d" % bit
+        for register, bits in self.index_bit_offsets.items():
+            for bit, offset in enumerate(bits):
+                names[offset] = "%s_bit_%d" % (names[register], bit)
+        for character, offset in self.character_to_offset.items():
+            names[offset] = character
+        return names
+
     def move_pointer_to_character(self, character_name):
         """Outputs the required Brainfuck commands to move to the
         passed character's offset"""
         try:
             offset = self.character_to_offset[character_name]
-            self.pointer = offset
-            return ">" * offset
+            self.move_pointer_to_offset(offset)
         except KeyError:
             print("Error: Character does not exist: " + character_name,
                   file=sys.stderr)
             raise
 
-    def move_pointer_to_character_stack_counter(self, character_name):
-        """Outputs the required Brainfuck commands to move to the
-        passed character's stack counter"""
-        try:
-            offset = self.character_to_offset[character_name]
-            offset += len(self.characters)
-            self.pointer = offset
-            return ">" * offset
-        except KeyError:
-            print("Error: Character does not exist: " + character_name,
-                  file=sys.stderr)
-            raise
-
-    def get_character_stack_position_offset(self,
-                                            character_name,
-                                            stack_pos):
-        """Outputs the required Brainfuck commands to move to the
-        passed character's stack counter"""
-        try:
-            offset = self.character_to_offset[character_name]
-            offset += (len(self.characters) + 1) * stack_pos
-            return offset
-        except KeyError:
-            print("Error: Character does not exist: " + character_name,
-                  file=sys.stderr)
-            raise
+    def test_cell_offset(self):
+        """Returns the offset of the first test cell, cells that can be
+        tested for zero without changing them. They sit just past the
+        characters, where a cell layout can't split them up, in this
+        order: Truth, its flag, a zero cell, Down's flag, Down, Up, Up's
+        flag, another zero cell, Countdown's flag, Countdown, Countup,
+        Countup's flag, a third zero cell, Left sign's flag, Left sign,
+        Right sign, Right sign's flag and a last zero cell. Truth holds
+        the answer to the last question, Down and Up the values it
+        compares, Countdown is the divisor counting down in divmod, and
+        Countdown and Countup race to find the sign of a value when the
+        cell width isn't known. The sign cells are 1 for a negative
+        left or right operand while it is worked on as a magnitude."""
+        return self.layout_size()
+
+    def digit_offset(self, index):
+        """Returns the offset of the cell for the digit worth 10 **
+        index when printing a number, which comes after the test
+        cells"""
+        return self.layout_size() + TEST_CELLS + index
+
+    def free_offset(self):
+        """Returns the first offset past the characters and any test
+        and digit cells, where Left operands and then stacks go"""
+        if self.test_cells:
+            return self.layout_size() + TEST_CELLS + self.digit_slots
+        return self.layout_size()
+
+    def left_operand_offset(self, depth):
+        """Returns the offset of the Left operand of a binary expression
+        nested depth deep. The outermost uses the "left" character's
+        register; the rest sit one after the other past the
+        characters."""
+        if not depth:
+            return self.character_to_offset["left"]
+        return self.free_offset() + depth - 1
+
+    def stack_index(self, character):
+        """Returns which of the interleaved stacks is the character's,
+        remembering that the character uses one"""
+        if character not in self.stacked:
+            self.stacked.append(character)
+        if self.stack_characters is None:
+            return self.characters.index(character)
+        if character not in self.stack_characters:
+            raise ValueError("No stack was laid out for " + character)
+        return self.stack_characters.index(character)
+
+    def stack_stride(self):
+        """Returns the distance between the levels of a stack"""
+        if self.stack_characters is None:
+            return 3 * len(self.characters)
+        return 3 * len(self.stack_characters)
+
+    def stack_marker_offset(self, character, level):
+        """Returns the offset of the marker cell of a character's stack
+        at the given level, level -1 being the zero cell below the
+        bottom.
+
+        Stacks live past everything else, as they can grow without
+        limit. Each level of a stack is a marker cell, 1 if the level
+        holds a value, followed by the magnitude of the value and a
+        sign cell, 1 if it is negative. The stacks of characters that
+        use them are interleaved level by level, so a stack is walked
+        with a scan loop like [>>>] that stops at the first unused
+        level. Only characters the play pushes to or pops from get a
+        stack, so the scan moves few cells per level."""
+        base = self.free_offset() + max(self.expression_depth - 1, 0)
+        stride = self.stack_stride()
+        return base + stride * (level + 1) + 3 * self.stack_index(character)
+
+    def scan_stack(self, step):
+        """Emits a scan along the markers of the stack the pointer is on,
+        up a level at a time if step is 1 or down if it is -1, stopping
+        at the first zero marker. Where the pointer ends up is only
+        known at runtime, so the caller has to bring it back to the
+        zero cell below the bottom of the stack and say so."""
+        stride = self.stack_stride()
+        self.output.write("[" + (">" if step > 0 else "<") * stride + "]")
+
+    def push_to_stack(self, source_register_offset, sign_offset, character):
+        """Moves a magnitude from the source register and a sign from
+        the cell at sign_offset onto the top of the character's stack,
+        leaving both zeroed. Every unit is carried by scanning up the
+        stack and back, so this takes steps in proportion to the
+        magnitude but not to the depth of the stack, as far as an
+        interpreter with fast scans goes."""
+        bottom = self.stack_marker_offset(character, 0)
+        below = self.stack_marker_offset(character, -1)
+        down = "<" * self.stack_stride()
+        for offset, cell in ((source_register_offset, 1), (sign_offset, 2)):
+            self.move_pointer_to_offset(offset)
+            self.emit("[-")
+            self.move_pointer_to_offset(bottom)
+            self.scan_stack(1)
+            # Add to the cell of the first unused level, then head back
+            # down from the level below it
+            self.output.write(">" * cell + "+" + "<" * cell + down)
+            self.scan_stack(-1)
+            self.pointer = below
+            self.move_pointer_to_offset(offset)
+            self.emit("]")
+        # Now mark the level as used
+        self.move_pointer_to_offset(bottom)
+        self.scan_stack(1)
+        self.output.write("+" + down)
+        self.scan_stack(-1)
+        self.pointer = below
+
+    def pop_from_stack(self, character):
+        """Replaces the value of the character's register with the top
+        of their stack, which is removed. Popping an empty stack gives
+        zero. The sign is carried into the Right sign cell and applied
+        once the magnitude is in the register, so this takes steps in
+        proportion to the magnitude, like push_to_stack."""
+        register = self.character_to_offset[character]
+        sign = self.test_cell_offset() + 15
+        bottom = self.stack_marker_offset(character, 0)
+        below = self.stack_marker_offset(character, -1)
+        down = "<" * self.stack_stride()
+        self.zero_value_at_offset(register)
+        self.zero_value_at_offset(sign)
+        self.move_pointer_to_offset(bottom)
+        self.scan_stack(1)
+        # Onto the top level, or the zero cell below the bottom if
+        # the stack is empty, in which case this is skipped
+        self.output.write(down + "[-")
+        for offset, cell in ((register, 1), (sign, 2)):
+            self.output.write(">" * cell + "[-" + "<" * cell + down)
+            self.scan_stack(-1)
+            self.pointer = below
+            self.add_value_at_offset(1, offset)
+            self.move_pointer_to_offset(bottom)
+            # The level being popped is now the first unused one
+            self.scan_stack(1)
+            self.output.write(">" * cell + "]" + "<" * cell)
+        self.output.write(down)
+        self.scan_stack(-1)
+        self.output.write("]")
+        self.pointer = below
+        self.open_if_nonzero(sign, 1)
+        self.move_register(register, self.copy_register_offset, -1)
+        self.move_register(self.copy_register_offset, register)
+        self.close_if_nonzero(sign, 1)
+        self.zero_value_at_offset(sign)
+
+    def push_to_second_character_stack(self, source_register_offset):
+        """Moves the value of the source register onto the second
+        character's stack. It is split into a sign and a magnitude
+        first, see split_sign, in Down and the Right sign cell."""
+        base = self.test_cell_offset()
+        down, sign = base + 4, base + 15
+        self.move_register(source_register_offset, down)
+        self.split_sign(down, sign, 1)
+        def copy_function(source, dest):
+            self.push_to_stack(source, sign, self.offset_character(dest))
+        self.copy_second_character_skeleton(down, copy_function)
+        # In case there was nobody to push for
+        self.zero_value_at_offset(down)
+        self.zero_value_at_offset(sign)
+
+    def pop_second_character_stack(self):
+        """Pops the top of the second character's stack into their
+        register"""
+        def copy_function(source, dest):
+            self.pop_from_stack(self.offset_character(dest))
+        self.copy_second_character_skeleton(0, copy_function)
+
+    def offset_character(self, offset):
+        """Returns the character whose register is at the offset"""
+        return self.characters[offset - self.first_character_offset]
 
     def copy_register(self, source_register_offset, destination_register_offset):
         """Outputs the Brainfuck commands to copy a value between
         registers. Will assume Copy is empty."""
         # Move the source value to the destination and copy registers
-        output_brainfuck = self.zero_value_at_offset(self.copy_register_offset)
-        output_brainfuck += self.move_pointer_to_offset(source_register_offset)
-        output_brainfuck += "[-" + self.reset_pointer()
-        output_brainfuck += self.move_pointer_to_offset(
-            destination_register_offset)
-        output_brainfuck += "+" + self.reset_pointer()
-        output_brainfuck += self.move_pointer_to_offset(
-            self.copy_register_offset)
-        output_brainfuck += "+" + self.reset_pointer()
-        output_brainfuck += self.move_pointer_to_offset(
-            source_register_offset) + "]"
-        output_brainfuck += self.reset_pointer()
+        self.zero_value_at_offset(self.copy_register_offset)
+        self.move_pointer_to_offset(source_register_offset)
+        self.emit("[-")
+        self.move_pointer_to_offset(destination_register_offset)
+        self.emit("+")
+        self.move_pointer_to_offset(self.copy_register_offset)
+        self.emit("+")
+        self.move_pointer_to_offset(source_register_offset)
+        self.emit("]")
         # Copy back
-        output_brainfuck += self.move_pointer_to_offset(
-            self.copy_register_offset)
-        output_brainfuck += "[-" + self.reset_pointer()
-        output_brainfuck += self.move_pointer_to_offset(
-            source_register_offset)
-        output_brainfuck += "+" + self.reset_pointer()
-        output_brainfuck += self.move_pointer_to_offset(
-            self.copy_register_offset) + "]"
-        output_brainfuck += self.reset_pointer()
-        return output_brainfuck
+        self.move_pointer_to_offset(self.copy_register_offset)
+        self.emit("[-")
+        self.move_pointer_to_offset(source_register_offset)
+        self.emit("+")
+        self.move_pointer_to_offset(self.copy_register_offset)
+        self.emit("]")
 
     def copy_from_second_character_register(self,
                                             destination_register_offset):
@@ -127,11 +496,8 @@ class MemoryLayout:
         a destination register via addition. Assumes Copy will be zero.
         Same for Loop."""
         copy_function = lambda source, dest: self.copy_register(dest, source)
-        output_brainfuck = self.copy_second_character_skeleton(
-            destination_register_offset,
-            copy_function)
-
-        return output_brainfuck
+        self.copy_second_character_skeleton(destination_register_offset,
+                                            copy_function)
 
     def copy_from_first_character_register(self,
                                             destination_register_offset):
@@ -139,11 +505,8 @@ class MemoryLayout:
         a destination register via addition. Assumes Copy will be zero.
         Same for Loop."""
         copy_function = lambda source, dest: self.copy_register(dest, source)
-        output_brainfuck = self.copy_first_character_skeleton(
-            destination_register_offset,
-            copy_function)
-
-        return output_brainfuck
+        self.copy_first_character_skeleton(destination_register_offset,
+                                           copy_function)
 
     def copy_into_second_character_register(self,
                                             source_register_offset):
@@ -151,36 +514,27 @@ class MemoryLayout:
         the second characters's register via addition. Assumes Copy will
         be zero. Same for Loop."""
         copy_function = lambda source, dest: self.copy_register(source, dest)
-        output_brainfuck = self.copy_second_character_skeleton(
-            source_register_offset,
-            copy_function)
-
-        return output_brainfuck
+        self.copy_second_character_skeleton(source_register_offset,
+                                            copy_function)
 
     def output_second_character_register(self):
         """Outputs the content of the source register"""
-        copy_function = lambda source, dest: (
-            self.move_pointer_to_offset(dest) + "." + self.reset_pointer())
-        output_brainfuck = self.copy_second_character_skeleton(
-            0,
-            copy_function)
-
-        return output_brainfuck
+        def copy_function(source, dest):
+            self.move_pointer_to_offset(dest)
+            self.emit(".")
+        self.copy_second_character_skeleton(0, copy_function)
 
     def reset_second_character_register(self):
         """Resets the content of the source register"""
-        copy_function = lambda source, dest: (
-            self.move_pointer_to_offset(dest) + "[-]" + self.reset_pointer())
-        output_brainfuck = self.copy_second_character_skeleton(
-            0,
-            copy_function)
-
-        return output_brainfuck
+        def copy_function(source, dest):
+            self.move_pointer_to_offset(dest)
+            self.emit("[-]")
+        self.copy_second_character_skeleton(0, copy_function)
 
     def copy_second_character_skeleton(self,
                                        register,
                                        copy_function):
-        return self.copy_character_skeleton(
+        self.copy_character_skeleton(
             register,
             copy_function,
             self.second_character_register_offset)
@@ -188,7 +542,7 @@ class MemoryLayout:
     def copy_first_character_skeleton(self,
                                        register,
                                        copy_function):
-        return self.copy_character_skeleton(
+        self.copy_character_skeleton(
             register,
             copy_function,
             self.active_character_register_offset)
@@ -199,126 +553,940 @@ class MemoryLayout:
                                 character_register):
         """Provides the skeleton code for copying into/from the second
         character"""
+        character_index = self.known_value(character_register)
+        if character_index is not None:
+            # We know who it is at compile time, so go straight to their
+            # register. Index 0 means nobody, same as the loops below.
+            if character_index:
+                character = self.characters[character_index - 1]
+                copy_function(register, self.character_to_offset[character])
+            return
+        if self.dispatch == "binary":
+            self.copy_character_decision_tree(register,
+                                              copy_function,
+                                              character_register)
+            return
+
         retrieve_register_offset = self.retrieve_register_offset
         loop_register_offset = self.loop_register_offset
 
-        output_brainfuck = ""
         # Setup our Copy and Loop registers, Loop will be made zero
         # once we enter the inner loop
-        output_brainfuck += self.copy_register(
-            character_register,
-            self.retrieve_register_offset)
-        output_brainfuck += self.add_value_at_offset(
-            1,
-            self.loop_register_offset)
-        output_brainfuck += self.move_pointer_to_offset(retrieve_register_offset)
-
-        inner_brainfuck = ""
+        self.copy_register(character_register,
+                           self.retrieve_register_offset)
+        self.add_value_at_offset(1, self.loop_register_offset)
+        self.move_pointer_to_offset(retrieve_register_offset)
+
+        # One nested loop per character, each decrementing Retrieve.
+        # Relies off the first character in the array holding the
+        # first position in memory, etc.
+        for character in self.characters:
+            self.emit("[-")
         for character in self.characters[::-1]:
-            # Relies off the first character in the array holding the
-            # first position in memory, etc.
-            temp_brainfuck = ""
-            temp_brainfuck += "[-" + inner_brainfuck
-            temp_brainfuck += "<" * retrieve_register_offset
-            self.pointer = 0 # Ick.
             # The first time we reach here, it's because we either hit
             # the bottom bottom or skipped an inner loop.
-            temp_brainfuck += self.move_pointer_to_offset(loop_register_offset)
-            temp_brainfuck += "[-" # If this is the first time in, decrement Loop
-            temp_brainfuck += self.reset_pointer()
-            temp_brainfuck += copy_function(
-                register,
-                self.character_to_offset[character])
-            temp_brainfuck += self.move_pointer_to_offset(loop_register_offset)
-            temp_brainfuck += "]"
-            temp_brainfuck += self.reset_pointer()
-            temp_brainfuck += self.move_pointer_to_offset(retrieve_register_offset)
-            temp_brainfuck += "]"
-            inner_brainfuck = temp_brainfuck
-            self.pointer = 0 # Hacks! HACKS
-        output_brainfuck += inner_brainfuck + "<" * retrieve_register_offset
-        return output_brainfuck
+            self.move_pointer_to_offset(loop_register_offset)
+            self.emit("[-") # If this is the first time in, decrement Loop
+            copy_function(register, self.character_to_offset[character])
+            self.move_pointer_to_offset(loop_register_offset)
+            self.emit("]")
+            self.move_pointer_to_offset(retrieve_register_offset)
+            self.emit("]")
+
+    def copy_character_decision_tree(self,
+                                     register,
+                                     copy_function,
+                                     character_register):
+        """The binary dispatch version of the skeleton. Tests the bits of
+        the character index from the most significant down, so only one
+        bit test per level of the tree runs. Each test moves the bit into
+        Retrieve, clearing Loop if it was set, then runs one branch or the
+        other with both zeroed again for the level below."""
+        bits = self.index_bit_offsets[character_register]
+        bit_offset = self.retrieve_register_offset
+        else_offset = self.loop_register_offset
+
+        def has_characters(prefix, depth):
+            # Indexes below this node of the tree, 0 being nobody
+            unset = len(bits) - depth
+            lowest = prefix << unset
+            highest = lowest + (1 << unset) - 1
+            return highest >= 1 and lowest <= len(self.characters)
+
+        def branch(prefix, depth):
+            if depth == len(bits):
+                character = self.characters[prefix - 1]
+                copy_function(register, self.character_to_offset[character])
+                return
+            one, zero = prefix * 2 + 1, prefix * 2
+            index_bit_offset = bits[len(bits) - depth - 1]
+            # Move the bit out into Retrieve, clearing Loop if it's set
+            if has_characters(zero, depth + 1):
+                self.add_value_at_offset(1, else_offset)
+            self.move_pointer_to_offset(index_bit_offset)
+            self.emit("[-")
+            self.add_value_at_offset(1, bit_offset)
+            if has_characters(zero, depth + 1):
+                self.subtract_value_at_offset(1, else_offset)
+            self.move_pointer_to_offset(index_bit_offset)
+            self.emit("]")
+            # Put it back before taking the branch for a set bit
+            self.move_pointer_to_offset(bit_offset)
+            self.emit("[-")
+            self.add_value_at_offset(1, index_bit_offset)
+            if has_characters(one, depth + 1):
+                branch(one, depth + 1)
+            self.move_pointer_to_offset(bit_offset)
+            self.emit("]")
+            if has_characters(zero, depth + 1):
+                self.move_pointer_to_offset(else_offset)
+                self.emit("[-")
+                branch(zero, depth + 1)
+                self.move_pointer_to_offset(else_offset)
+                self.emit("]")
+
+        if has_characters(0, 0):
+            branch(0, 0)
+
+    def set_scene(self, block):
+        """Sets the scene code bits so the scene machine runs the given
+        block next. Every bit was cleared by the dispatch into the block
+        being run, so only the ones need setting."""
+        for bit, value in enumerate(self.scene_codes[block]):
+            if value:
+                self.add_value_at_offset(1, self.scene_bit_offsets[bit])
+
+    def open_pending_guard(self):
+        """After a goto, the rest of the scene only runs if the goto
+        wasn't taken, so it goes in a loop on Continue that is left as
+        soon as the scene ends"""
+        if not self.guard_pending:
+            return
+        self.guard_pending = False
+        self.guards += 1
+        self.move_pointer_to_offset(self.continue_register_offset)
+        self.emit("[")
+
+    def close_guards(self):
+        """Ends the guards opened by open_pending_guard at the end of a
+        scene, clearing Continue so each one is only run once"""
+        if self.guards:
+            self.zero_value_at_offset(self.continue_register_offset)
+        for guard in range(self.guards):
+            self.move_pointer_to_offset(self.continue_register_offset)
+            self.emit("]")
+        self.guards = 0
+        self.guard_pending = False
+
+    def open_if_zero(self, offset, side):
+        """Opens code that only runs if the test cell at offset is
+        zero, leaving the cell as it is. The cell beside it on the given
+        side, -1 for left or 1 for right, is a flag that is zero outside
+        of this, and the one beyond that is always zero. Either way the
+        test takes a handful of steps: the flag is set, then [<-]<[-
+        runs the code with the flag cleared, and <] ends up on the zero
+        cell."""
+        step = "<" if side < 0 else ">"
+        self.add_value_at_offset(1, offset + side)
+        self.move_pointer_to_offset(offset)
+        self.output.write("[" + step + "-]" + step + "[-")
+        self.pointer = offset + side
+
+    def close_if_zero(self, offset, side):
+        """Ends code opened by open_if_zero"""
+        self.move_pointer_to_offset(offset + 2 * side)
+        self.output.write("]")
+
+    def open_if_nonzero(self, offset, side):
+        """Opens code that only runs if the test cell at offset is
+        not zero, leaving the cell as it is. This is the other branch of
+        open_if_zero: the code runs inside [ ... >-] with the flag still
+        set, and it costs the same handful of steps."""
+        self.add_value_at_offset(1, offset + side)
+        self.move_pointer_to_offset(offset)
+        self.output.write("[")
+
+    def close_if_nonzero(self, offset, side):
+        """Ends code opened by open_if_nonzero"""
+        step = "<" if side < 0 else ">"
+        self.move_pointer_to_offset(offset + side)
+        self.output.write("-]" + step + "[-" + step + "]")
+        self.pointer = offset + 2 * side
+
+    def compare(self, comparison, negate=False):
+        """Sets Truth to whether the left value of a question is
+        "equal_to", "greater_than" or "less_than" the right one, or to
+        the opposite if negate, clearing Down and Up. For equality the
+        right value is taken away from the left and the difference
+        tested, a dozen or so steps. Otherwise both values are split
+        into a sign and a magnitude, see split_sign, which settles
+        values of different signs. If the signs agree, the magnitudes
+        race towards zero together, swapped if both are negative, and
+        whichever gets there first is the smaller. That is the cost of
+        the signs plus about fifteen steps per unit of the smaller
+        magnitude."""
+        base = self.test_cell_offset()
+        truth, down, up = base, base + 4, base + 5
+        left_sign, right_sign = base + 14, base + 15
+        running = self.loop_register_offset
+        if comparison not in ("equal_to", "greater_than", "less_than"):
+            raise Exception("Unknown comparison: " + comparison)
+
+        def set_truth(value):
+            self.zero_value_at_offset(truth)
+            self.add_value_at_offset(int(value != negate), truth)
+
+        set_truth(False)
+        if comparison == "equal_to":
+            self.move_pointer_to_offset(up)
+            self.emit("[-")
+            self.subtract_value_at_offset(1, down)
+            self.move_pointer_to_offset(up)
+            self.emit("]")
+            self.open_if_zero(down, -1)
+            set_truth(True)
+            self.close_if_zero(down, -1)
+            self.zero_value_at_offset(down)
+            return
+        self.split_sign(down, left_sign, -1)
+        self.split_sign(up, right_sign, 1)
+        self.zero_value_at_offset(running)
+        self.add_value_at_offset(1, running)
+        self.open_if_nonzero(left_sign, -1)
+        self.open_if_nonzero(right_sign, 1)
+        # Both negative, so the one nearer zero is the greater
+        self.move_register(down, self.copy_register_offset)
+        self.move_register(up, down)
+        self.move_register(self.copy_register_offset, up)
+        self.close_if_nonzero(right_sign, 1)
+        self.open_if_zero(right_sign, 1)
+        self.zero_value_at_offset(running)
+        set_truth(comparison == "less_than")
+        self.close_if_zero(right_sign, 1)
+        self.close_if_nonzero(left_sign, -1)
+        self.open_if_zero(left_sign, -1)
+        self.open_if_nonzero(right_sign, 1)
+        self.zero_value_at_offset(running)
+        set_truth(comparison == "greater_than")
+        self.close_if_nonzero(right_sign, 1)
+        self.close_if_zero(left_sign, -1)
+        # The one that should get to zero first is tested first, so
+        # that equal magnitudes end up false
+        if comparison == "greater_than":
+            order = ((up, 1, True), (down, -1, False))
+        else:
+            order = ((down, -1, True), (up, 1, False))
+        self.move_pointer_to_offset(running)
+        self.emit("[")
+        for offset, side, value in order:
+            self.open_if_zero(offset, side)
+            self.zero_value_at_offset(running)
+            set_truth(value)
+            self.close_if_zero(offset, side)
+        self.subtract_value_at_offset(1, down)
+        self.subtract_value_at_offset(1, up)
+        self.move_pointer_to_offset(running)
+        self.emit("]")
+        for offset in (down, up, left_sign, right_sign):
+            self.zero_value_at_offset(offset)
+
+    def split_sign(self, value_offset, sign_offset, side):
+        """Replaces the value of a register with its magnitude, adding 1
+        to the sign cell at sign_offset, whose flag is on the given
+        side, if it was negative. The most negative value of a wrapping
+        cell keeps its bits, which still count down the right number
+        of times. Uses Copy, Result, Retrieve, Temp, Loop, Countdown
+        and Countup.
+
+        Countdown and Countup race from the value towards zero, one
+        down and one up, counting the magnitude as they go, about
+        fifteen steps per unit of it. If the cell width is known, the
+        race gives up after SIGN_RACE_LIMIT units and the sign bit is
+        found instead, see sign_bit, so a big magnitude costs a few
+        hundred steps more than the race would have taken to get that
+        far rather than steps in proportion to it."""
+        countdown = self.test_cell_offset() + 9
+        countup = countdown + 1
+        running = self.loop_register_offset
+        limit = SIGN_RACE_LIMIT.get(self.cell_bits)
+        self.zero_value_at_offset(running)
+        self.move_pointer_to_offset(value_offset)
+        self.emit("[-")
+        self.add_value_at_offset(1, countdown)
+        self.add_value_at_offset(1, countup)
+        self.move_pointer_to_offset(value_offset)
+        self.emit("]")
+        self.add_constant_at_offset(limit or 1, running)
+        self.open_if_zero(countdown, -1)
+        self.zero_value_at_offset(running)
+        self.close_if_zero(countdown, -1)
+        self.move_pointer_to_offset(running)
+        self.emit("[")
+        if limit:
+            self.subtract_value_at_offset(1, running)
+        self.subtract_value_at_offset(1, countdown)
+        self.add_value_at_offset(1, countup)
+        self.add_value_at_offset(1, value_offset)
+        self.open_if_zero(countdown, -1)
+        self.zero_value_at_offset(running)
+        self.close_if_zero(countdown, -1)
+        self.open_if_zero(countup, 1)
+        self.zero_value_at_offset(running)
+        self.add_value_at_offset(1, sign_offset)
+        self.close_if_zero(countup, 1)
+        self.move_pointer_to_offset(running)
+        self.emit("]")
+        if limit:
+            # Neither got to zero, so Countdown is the value less the
+            # limit and the magnitude has to be found the other way
+            self.add_value_at_offset(1, running)
+            self.open_if_zero(countdown, -1)
+            self.zero_value_at_offset(running)
+            self.close_if_zero(countdown, -1)
+            self.open_if_zero(countup, 1)
+            self.zero_value_at_offset(running)
+            self.close_if_zero(countup, 1)
+            self.zero_value_at_offset(countup)
+            self.move_register(running, countup)
+            self.open_if_nonzero(countup, 1)
+            self.move_register(countdown, value_offset)
+            self.sign_bit(value_offset, sign_offset)
+            self.open_if_nonzero(sign_offset, side)
+            self.move_register(value_offset, self.copy_register_offset, -1)
+            self.move_register(self.copy_register_offset, value_offset)
+            self.close_if_nonzero(sign_offset, side)
+            self.close_if_nonzero(countup, 1)
+        self.zero_value_at_offset(countdown)
+        self.zero_value_at_offset(countup)
+
+    def sign_bit(self, value_offset, sign_offset):
+        """Adds the sign bit of a register to the sign cell at
+        sign_offset, for cells of a known width. A copy of the value has
+        its bits cleared from the bottom up, each found by shifting what
+        is left of it up with doubling move loops until only that bit
+        could still be set, which leaves the sign bit. That is a fixed
+        cost on interpreters that run move loops in one step: a few
+        hundred steps for 8 bit cells, over a thousand for 16 and four
+        thousand for 32. Uses Copy, Result, Retrieve, Temp, Loop and
+        Countdown."""
+        copy = self.copy_register_offset
+        running = self.loop_register_offset
+        remainder = self.result_register_offset
+        weight = self.retrieve_register_offset
+        shifted = self.temp_register_offset
+        shifts = self.test_cell_offset() + 9
+        for offset in (remainder, weight, shifted, running, shifts):
+            self.zero_value_at_offset(offset)
+        self.copy_register(value_offset, remainder)
+        self.add_value_at_offset(1, weight)
+        self.add_constant_at_offset(self.cell_bits - 1, shifts)
+        # One pass per bit below the sign bit
+        self.move_pointer_to_offset(shifts)
+        self.emit("[")
+        self.copy_register(remainder, shifted)
+        self.copy_register(shifts, running)
+        self.move_pointer_to_offset(running)
+        self.emit("[-")
+        self.move_register(shifted, copy, 2)
+        self.move_register(copy, shifted)
+        self.move_pointer_to_offset(running)
+        self.emit("]")
+        self.move_pointer_to_offset(shifted)
+        self.emit("[")
+        self.move_pointer_to_offset(weight)
+        self.emit("[-")
+        self.subtract_value_at_offset(1, remainder)
+        self.add_value_at_offset(1, copy)
+        self.move_pointer_to_offset(weight)
+        self.emit("]")
+        self.move_register(copy, weight)
+        self.zero_value_at_offset(shifted)
+        self.emit("]")
+        self.move_register(weight, copy, 2)
+        self.move_register(copy, weight)
+        self.subtract_value_at_offset(1, shifts)
+        self.emit("]")
+        self.zero_value_at_offset(weight)
+        self.move_pointer_to_offset(remainder)
+        self.emit("[")
+        self.add_value_at_offset(1, sign_offset)
+        self.zero_value_at_offset(remainder)
+        self.emit("]")
+
+    def move_register(self, source_register_offset,
+                      destination_register_offset, factor=1):
+        """Outputs a move loop adding factor times the source register
+        to the destination, leaving the source zeroed. Interpreters that
+        turn move loops into multiplications do this in one step."""
+        self.move_pointer_to_offset(source_register_offset)
+        self.emit("[-")
+        self.add_signed_value_at_offset(factor, destination_register_offset)
+        self.move_pointer_to_offset(source_register_offset)
+        self.emit("]")
+
+    def multiply(self, outer_offset, inner_offset, target_offset,
+                 restore_offset):
+        """Adds the product of the outer and inner registers to the
+        target, leaving outer zeroed. Each unit of outer runs a single
+        move loop that adds inner into the target and the restore
+        register together, then moves restore back into inner, so it
+        costs a few steps per unit of outer on an interpreter that turns
+        move loops into multiplications. The smaller operand should be
+        outer where that is known. The restore register has to start at
+        zero."""
+        self.move_pointer_to_offset(outer_offset)
+        self.emit("[-")
+        self.move_pointer_to_offset(inner_offset)
+        self.emit("[-")
+        self.add_value_at_offset(1, target_offset)
+        self.add_value_at_offset(1, restore_offset)
+        self.move_pointer_to_offset(inner_offset)
+        self.emit("]")
+        self.move_register(restore_offset, inner_offset)
+        self.move_pointer_to_offset(outer_offset)
+        self.emit("]")
+
+    def divmod(self, dividend_offset, divisor_offset, quotient_offset,
+               remainder_offset, growth=0):
+        """Divides the dividend register by the divisor register in one
+        pass, adding the quotient and remainder to their registers and
+        leaving the dividend and divisor zeroed. The remainder register
+        has to start at zero. The divisor goes into Countdown, then each
+        unit of the dividend moves one off Countdown and onto the
+        remainder. Whenever Countdown reaches zero, the remainder is
+        moved back into it and the quotient goes up by one. That is
+        around twenty steps per unit of the dividend, whatever the
+        divisor. Values are taken as magnitudes, see signed_divmod, and
+        dividing by zero gives nonsense rather than hanging. With growth, the divisor
+        gets that much bigger each time it goes into the dividend."""
+        countdown = self.test_cell_offset() + 9
+        self.move_register(divisor_offset, countdown)
+        self.move_pointer_to_offset(dividend_offset)
+        self.emit("[-")
+        self.add_value_at_offset(1, remainder_offset)
+        self.subtract_value_at_offset(1, countdown)
+        self.open_if_zero(countdown, -1)
+        self.move_register(remainder_offset, countdown)
+        self.add_value_at_offset(growth, countdown)
+        self.add_value_at_offset(1, quotient_offset)
+        self.close_if_zero(countdown, -1)
+        self.move_pointer_to_offset(dividend_offset)
+        self.emit("]")
+        self.zero_value_at_offset(countdown)
+
+    def print_decimal(self):
+        """Prints the value in Down as a signed decimal number, leaving
+        Down zeroed. Down and Up race towards zero like a question does,
+        which finds the sign and the size of the value, and the same
+        loop divides it by ten into the units digit and Result. The rest
+        of the digits come from one divmod each, the quotient going back
+        and forth between Result and Retrieve, and they are printed
+        from the top with leading zeros skipped. That is around forty
+        steps per unit of the value and a few dozen per digit slot.
+        With unbounded cells, whatever is left of the quotient after the
+        last slot is printed first, see print_leftover_digits."""
+        base = self.test_cell_offset()
+        down, up, countdown = base + 4, base + 5, base + 9
+        running = self.loop_register_offset
+        quotients = [self.result_register_offset,
+                     self.retrieve_register_offset]
+        digits = [self.digit_offset(index)
+                  for index in range(self.digit_slots)]
+        for quotient in quotients:
+            self.zero_value_at_offset(quotient)
+        self.add_value_at_offset(10, countdown)
+        self.copy_register(down, up)
+        self.zero_value_at_offset(running)
+        self.add_value_at_offset(1, running)
+        self.open_if_zero(down, -1)
+        self.zero_value_at_offset(running)
+        self.close_if_zero(down, -1)
+        self.move_pointer_to_offset(running)
+        self.emit("[")
+        self.subtract_value_at_offset(1, down)
+        self.add_value_at_offset(1, up)
+        self.add_value_at_offset(1, digits[0])
+        self.subtract_value_at_offset(1, countdown)
+        self.open_if_zero(countdown, -1)
+        self.move_register(digits[0], countdown)
+        self.add_value_at_offset(1, quotients[0])
+        self.close_if_zero(countdown, -1)
+        self.open_if_zero(down, -1)
+        self.zero_value_at_offset(running)
+        self.close_if_zero(down, -1)
+        # Up getting there first means the value is negative. Both at
+        # once is half way round a wrapping cell, also negative.
+        self.open_if_zero(up, 1)
+        self.zero_value_at_offset(running)
+        self.add_constant_at_offset(ord("-"), up)
+        self.emit(".")
+        self.add_constant_at_offset(-ord("-"), up)
+        self.close_if_zero(up, 1)
+        self.move_pointer_to_offset(running)
+        self.emit("]")
+        self.zero_value_at_offset(down)
+        self.zero_value_at_offset(up)
+        self.zero_value_at_offset(countdown)
+        for index in range(1, len(digits)):
+            self.add_value_at_offset(10, self.temp_register_offset)
+            self.divmod(quotients[(index - 1) % 2], self.temp_register_offset,
+                        quotients[index % 2], digits[index])
+        leftover = quotients[(len(digits) - 1) % 2]
+        if self.cell_bits is None:
+            # Anything left over is printed first, and then every digit
+            # cell has to be printed, zero or not
+            self.move_pointer_to_offset(leftover)
+            self.emit("[")
+            self.print_leftover_digits(leftover, quotients[len(digits) % 2])
+            self.zero_value_at_offset(leftover)
+            self.add_value_at_offset(1, up)
+            self.move_pointer_to_offset(leftover)
+            self.emit("]")
+        else:
+            # Anything left over doesn't fit in a cell, so can't happen
+            self.zero_value_at_offset(leftover)
+        # Up adds up the digits printed so far, so it stays zero
+        # through the leading zeros
+        for digit in reversed(digits[1:]):
+            self.copy_register(digit, up)
+            self.open_if_nonzero(up, 1)
+            self.add_constant_at_offset(ord("0"), digit)
+            self.emit(".")
+            self.close_if_nonzero(up, 1)
+            self.zero_value_at_offset(digit)
+        self.add_constant_at_offset(ord("0"), digits[0])
+        self.emit(".")
+        self.zero_value_at_offset(digits[0])
+        self.zero_value_at_offset(up)
+
+    def print_leftover_digits(self, value_offset, spare_offset):
+        """Prints a positive register in decimal, leaving it as it is,
+        for values too big for the digit cells. The digits are counted by
+        dividing a copy of the value by ten until nothing is left, then
+        each one is found by dividing a fresh copy down to it, so this
+        takes a divmod per digit for every digit, but needs no more
+        cells however big the value is. The spare register has to start
+        at zero. Uses Copy, Temp, Loop, Down and the sign cells."""
+        base = self.test_cell_offset()
+        work, index, remainder = base + 4, base + 14, base + 15
+        count = self.loop_register_offset
+        ten = self.temp_register_offset
+
+        def divide_work():
+            self.add_value_at_offset(10, ten)
+            self.divmod(work, ten, spare_offset, remainder)
+
+        for offset in (work, index, remainder, count, ten):
+            self.zero_value_at_offset(offset)
+        self.copy_register(value_offset, work)
+        self.move_pointer_to_offset(work)
+        self.emit("[")
+        divide_work()
+        self.zero_value_at_offset(remainder)
+        self.move_register(spare_offset, work)
+        self.add_value_at_offset(1, count)
+        self.move_pointer_to_offset(work)
+        self.emit("]")
+        self.move_pointer_to_offset(count)
+        self.emit("[-")
+        self.copy_register(count, index)
+        self.copy_register(value_offset, work)
+        self.move_pointer_to_offset(index)
+        self.emit("[-")
+        divide_work()
+        self.zero_value_at_offset(remainder)
+        self.move_register(spare_offset, work)
+        self.move_pointer_to_offset(index)
+        self.emit("]")
+        divide_work()
+        self.zero_value_at_offset(spare_offset)
+        self.add_constant_at_offset(ord("0"), remainder)
+        self.emit(".")
+        self.zero_value_at_offset(remainder)
+        self.move_pointer_to_offset(count)
+        self.emit("]")
+
+    def read_decimal(self, target_offset):
+        """Reads a decimal number into the target register, which has to
+        start at zero, the way C's %d does: leading whitespace is
+        skipped, a plus or minus sign may come first and reading stops
+        at the first character that isn't a digit, which is used up.
+        Nothing that can be read gives zero. Each character is read into
+        Down and told apart with a zero test per character it could be,
+        about a hundred and thirty steps for a digit and eighty for
+        whitespace, the running total being multiplied by ten with a
+        move loop."""
+        base = self.test_cell_offset()
+        down, sign = base + 4, base + 14
+        running = self.loop_register_offset
+        negative = self.retrieve_register_offset
+        scratch = self.temp_register_offset
+        spaces = [ord(space) for space in " \t\n\v\f\r"]
+        digits = [ord(digit) for digit in "0123456789"]
+
+        def read():
+            self.zero_value_at_offset(down)
+            self.emit(",")
+
+        self.zero_value_at_offset(negative)
+        self.zero_value_at_offset(running)
+        self.add_value_at_offset(1, running)
+        self.emit("[")
+        self.zero_value_at_offset(running)
+        read()
+        self.flag_if_among(down, -1, spaces, running)
+        self.move_pointer_to_offset(running)
+        self.emit("]")
+        self.flag_if_among(down, -1, [ord("-")], negative)
+        self.zero_value_at_offset(sign)
+        self.flag_if_among(down, -1, [ord("+"), ord("-")], sign)
+        self.open_if_nonzero(sign, -1)
+        read()
+        self.close_if_nonzero(sign, -1)
+        self.zero_value_at_offset(sign)
+        self.flag_if_among(down, -1, digits, running)
+        self.move_pointer_to_offset(running)
+        self.emit("[")
+        self.move_register(target_offset, scratch, 10)
+        self.move_register(scratch, target_offset)
+        self.add_constant_at_offset(-ord("0"), down)
+        self.move_register(down, target_offset)
+        self.zero_value_at_offset(running)
+        read()
+        self.flag_if_among(down, -1, digits, running)
+        self.move_pointer_to_offset(running)
+        self.emit("]")
+        self.zero_value_at_offset(down)
+        self.move_pointer_to_offset(negative)
+        self.emit("[-")
+        self.move_register(target_offset, scratch)
+        self.move_register(scratch, target_offset, -1)
+        self.move_pointer_to_offset(negative)
+        self.emit("]")
+
+    def flag_if_among(self, offset, side, values, flag_offset):
+        """Adds 1 to the flag register if the test cell at offset, whose
+        flag is on the given side, holds one of the values, leaving the
+        cell as it is. The cell is moved from one value to the next,
+        with a zero test at each."""
+        current = 0
+        for value in sorted(values):
+            self.add_constant_at_offset(current - value, offset)
+            self.open_if_zero(offset, side)
+            self.add_value_at_offset(1, flag_offset)
+            self.close_if_zero(offset, side)
+            current = value
+        self.add_constant_at_offset(current, offset)
+
+    def read_character(self, target_offset):
+        """Reads a character into the target register, which has to
+        start at zero. The end of input reads as -1, as in SPL, as long
+        as the interpreter gives zero or leaves the cell alone there."""
+        down = self.test_cell_offset() + 4
+        self.move_pointer_to_offset(down)
+        self.emit(",")
+        self.open_if_zero(down, -1)
+        self.subtract_value_at_offset(1, down)
+        self.close_if_zero(down, -1)
+        self.move_register(down, target_offset)
 
     def move_pointer_to_offset(self, offset):
-        """Outputs the required Brainfuck commands to move to the
-        passed raw offset"""
-        self.pointer = offset
-        return ">" * offset
+        """Outputs the relative Brainfuck moves required to get from the
+        current pointer position to the passed raw offset"""
+        self.move_pointer_to_cell(self.cell_layout.get(offset, offset))
+
+    def move_pointer_to_cell(self, cell):
+        """Outputs the relative Brainfuck moves required to get from the
+        current pointer position to the passed tape cell. Offsets only
+        differ from tape cells when a cell layout has been applied."""
+        if self.usage is not None:
+            self.usage.record(cell, 1 + len(self.loop_pointers))
+        distance = cell - self.pointer
+        self.pointer = cell
+        self.emit(">" * distance if distance > 0 else "<" * -distance)
 
     def zero_value_at_offset(self, offset):
         """Outputs the Brainfuck commands to zero the value at a given
-        offset and reset the pointer."""
-        output_brainfuck = ""
-        output_brainfuck += self.move_pointer_to_offset(offset)
-        output_brainfuck += "[-]"
-        output_brainfuck += self.reset_pointer()
-        return output_brainfuck
+        offset."""
+        self.move_pointer_to_offset(offset)
+        self.emit("[-]")
 
     def add_value_at_offset(self, value, offset):
-        """Outputs the Brainfuck commands to zero the value at a given
-        offset and reset the pointer."""
-        output_brainfuck = ""
-        output_brainfuck += self.move_pointer_to_offset(offset)
-        output_brainfuck += "+" * value
-        output_brainfuck += self.reset_pointer()
-        return output_brainfuck
+        """Outputs the Brainfuck commands to add a value to the cell at a
+        given offset."""
+        self.move_pointer_to_offset(offset)
+        self.emit("+" * value)
 
     def subtract_value_at_offset(self, value, offset):
-        """Outputs the Brainfuck commands to zero the value at a given
-        offset and reset the pointer."""
-        output_brainfuck = ""
-        output_brainfuck += self.move_pointer_to_offset(offset)
-        output_brainfuck += "-" * value
-        output_brainfuck += self.reset_pointer()
-        return output_brainfuck
-
-    def reset_pointer(self):
-        """Returns the Brainfuck command required to move the pointer
-        back to the 0 position. Needs to be called after you are
-        finished manipulating the memory location you're currently at"""
-        offset = self.pointer
-        self.pointer = 0
-        return "<" * offset
+        """Outputs the Brainfuck commands to subtract a value from the
+        cell at a given offset."""
+        self.move_pointer_to_offset(offset)
+        self.emit("-" * value)
+
+    def add_constant_at_offset(self, value, offset):
+        """Outputs the shortest Brainfuck we can find for adding a
+        constant, possibly negative, to the cell at a given offset:
+        either a run of +/- or a multiplication loop through Temp Two,
+        whichever is shorter counting pointer moves. Temp Two is only
+        used here, and is always left zeroed."""
+        value = self.nearest_amount(value)
+        if not value:
+            return
+        scratch_offset = self.temp_two_register_offset
+        scratch = self.cell_layout.get(scratch_offset, scratch_offset)
+        target = self.cell_layout.get(offset, offset)
+        distance = abs(scratch - target)
+        loops, factor, remainder = self.constant_recipe(value)
+        loop_cost = (abs(self.pointer - scratch) + 3 * distance + 3 +
+                     loops + abs(factor) + abs(remainder))
+        add_cost = abs(self.pointer - target) + abs(value)
+        program = self.output.program
+        if (self.pointer == target and program and
+                program[-1][0] == brainfuck.ADD):
+            # A run of +/- would merge with the one just emitted
+            add_cost = abs(program[-1][1] + value) - abs(program[-1][1])
+        if loop_cost >= add_cost:
+            self.add_signed_value_at_offset(value, offset)
+            return
+        # Temp Two counts down the loops, adding factor each time
+        self.add_value_at_offset(loops, scratch_offset)
+        self.emit("[-")
+        self.add_signed_value_at_offset(factor, offset)
+        self.move_pointer_to_offset(scratch_offset)
+        self.emit("]")
+        self.add_signed_value_at_offset(remainder, offset)
+
+    def nearest_amount(self, value):
+        """Returns the amount to add that has the same effect as value
+        and is nearest zero, which is value itself unless cells wrap"""
+        if self.cell_bits is None:
+            return value
+        # Cells wrap, so go whichever way round is shorter
+        modulus = 2 ** self.cell_bits
+        value %= modulus
+        if value > modulus // 2:
+            value -= modulus
+        return value
+
+    def add_signed_value_at_offset(self, value, offset):
+        """Adds or subtracts depending on the sign of value"""
+        if value >= 0:
+            self.add_value_at_offset(value, offset)
+        else:
+            self.subtract_value_at_offset(-value, offset)
+
+    def constant_recipe(self, value):
+        """Finds the loops, factor and remainder with the fewest
+        commands such that loops * factor + remainder == value. Each
+        value is only worked out once per compile."""
+        if value in self.constant_recipes:
+            return self.constant_recipes[value]
+        best = (abs(value), (0, 0, value))
+        loops = 2
+        while loops * loops <= abs(value) * 4:
+            for factor in (value // loops, -(-value // loops)):
+                remainder = value - loops * factor
+                cost = loops + abs(factor) + abs(remainder)
+                if cost < best[0]:
+                    best = (cost, (loops, factor, remainder))
+            loops += 1
+        self.constant_recipes[value] = best[1]
+        return best[1]
 
 def parse_file(file_text, memory):
-    output_brainfuck = ""
+    """Transpiles NSPL text into a run-length encoded Brainfuck program,
+    see the brainfuck module for its format."""
     tokens = file_text.split(',')
-    idx = 0
+    memory.bookends = index_bookends(tokens)
+    memory.expression_depth = expression_depth(tokens)
+    memory.jump_targets = index_jump_targets(tokens)
+    memory.test_cells = any(token in tokens for token in
+                            ("set_left_comp", "if", "div", "mod", "sqrt",
+                             "factorial", "push", "pop", "int_output",
+                             "int_input", "char_input"))
+    if "int_output" in tokens:
+        memory.digit_slots = DIGIT_SLOTS[memory.cell_bits]
+    blocks, memory.scene_blocks = split_scenes(tokens, memory.jump_targets)
+    if len(blocks) == 1:
+        parse_tokens(tokens, memory, 0, len(tokens))
+        return memory.output.getvalue()
+
+    # The first block only ever runs once, at the start, so it can go
+    # before the scene machine's loop
+    memory.scene_tree = scene_tree(tokens, blocks, memory.scene_blocks)
+    memory.scene_codes = scene_codes(memory.scene_tree)
+    emit_scene(tokens, memory, blocks, 0)
+    memory.statement_offset = None
+    memory.mark("scene dispatch")
+    memory.add_value_at_offset(1, memory.running_register_offset)
+    memory.emit("[")
+    emit_scene_dispatch(tokens, memory, blocks, memory.scene_tree, 0)
+    memory.move_pointer_to_offset(memory.running_register_offset)
+    memory.emit("]")
+    return memory.output.getvalue()
+
+def parse_tokens(tokens, memory, start, end):
+    """Runs the handler for each statement in a range of the tokens"""
+    idx = start
     # The main loop for parsing finds valid tokens and runs the
-    # the associated functions. Each function returns how many
-    # tokens we should skip after we've finished processing.
-    while idx < len(tokens):
-        current_token = tokens[idx]
-        if current_token in token_function_map().keys():
-            bf, off = token_function_map()[current_token](tokens, memory, idx)
-            output_brainfuck += bf
-            idx += off
+    # the associated functions. Each function emits its Brainfuck into
+    # the memory's output program and returns how many tokens we should
+    # skip after we've finished processing.
+    while idx < end and not memory.unreachable:
+        token_function = TOKEN_FUNCTION_MAP.get(tokens[idx])
+        if token_function:
+            if tokens[idx] not in ("line", "endif"):
+                memory.open_pending_guard()
+            memory.statement_offset = idx
+            memory.mark(tokens[idx])
+            idx += token_function(tokens, memory, idx)
         else:
             idx += 1
-    return output_brainfuck
+
+def split_scenes(tokens, jump_targets):
+    """Splits the tokens into blocks at the labels that some goto jumps
+    to, returning the (start, end) token range of each block along with
+    a map of those labels to the block they start. Labels with nothing
+    but other labels before the next one start the same block."""
+    starts = [0]
+    labels = {}
+    for idx, token in enumerate(tokens):
+        if token == "actlabel":
+            label = ("act", tokens[idx + 2])
+        elif token == "scenelabel":
+            label = ("scene", tokens[idx + 2], tokens[idx + 4])
+        else:
+            continue
+        if label not in jump_targets:
+            continue
+        if len(starts) > 1 and not any(
+                token in TOKEN_FUNCTION_MAP and
+                token not in ("actlabel", "scenelabel", "line")
+                for token in tokens[starts[-1]:idx]):
+            labels[label] = len(starts) - 1
+            continue
+        labels[label] = len(starts)
+        starts.append(idx)
+    missing = set(jump_targets) - set(labels)
+    if missing:
+        raise Exception("A goto jumps to a label that doesn't exist: " +
+                        ", ".join(" ".join(label) for label in missing))
+    ends = starts[1:] + [len(tokens)]
+    return list(zip(starts, ends)), labels
+
+def scene_tree(tokens, blocks, scene_blocks):
+    """Builds the decision tree the scene machine dispatches on. Each
+    block after the first is a leaf, and each inner node is a (zero,
+    one) pair tested on one bit of the scene code. The tree is built
+    like a Huffman code, so that blocks that are expected to run more
+    often take fewer bit tests to reach. A block is guessed to run once
+    for each way into it: falling into it from the block before, and
+    each goto to it, with gotos back up the play counting ten times as
+    they make loops."""
+    weights = [1] * len(blocks)
+    for idx, token in enumerate(tokens):
+        if token != "goto":
+            continue
+        goto = extract_next_elements(tokens, 5, idx)
+        if len(goto) == 5 and goto[3] == "scene":
+            block = scene_blocks[("scene", goto[2], goto[4])]
+        else:
+            block = scene_blocks[("act", goto[2])]
+        weights[block] += 10 if blocks[block][0] < idx else 1
+    heap = [(weights[block], block, block)
+            for block in range(1, len(blocks))]
+    heapq.heapify(heap)
+    count = len(blocks)
+    while len(heap) > 1:
+        zero_weight, _, zero = heapq.heappop(heap)
+        one_weight, _, one = heapq.heappop(heap)
+        heapq.heappush(heap, (zero_weight + one_weight, count, (zero, one)))
+        count += 1
+    return heap[0][2]
+
+def scene_codes(tree, prefix=()):
+    """Returns the bits of the scene code of each block in the tree"""
+    if not isinstance(tree, tuple):
+        return {tree: prefix}
+    codes = scene_codes(tree[0], prefix + (0,))
+    codes.update(scene_codes(tree[1], prefix + (1,)))
+    return codes
+
+def emit_scene(tokens, memory, blocks, block):
+    """Emits one block of the scene machine, ending by setting the scene
+    code to the block after it, or clearing Running after the last"""
+    start, end = blocks[block]
+    if block and "goto" in tokens[start:end]:
+        memory.zero_value_at_offset(memory.continue_register_offset)
+        memory.add_value_at_offset(1, memory.continue_register_offset)
+    parse_tokens(tokens, memory, start, end)
+    if memory.unreachable:
+        # The block always ends in a goto, so never runs off its end
+        memory.unreachable = False
+    else:
+        memory.open_pending_guard()
+        memory.mark("next scene")
+        if block + 1 < len(blocks):
+            memory.set_scene(block + 1)
+        else:
+            memory.zero_value_at_offset(memory.running_register_offset)
+    memory.close_guards()
+
+def emit_scene_dispatch(tokens, memory, blocks, tree, depth):
+    """Emits the decision tree that runs the block whose code is in the
+    scene bits, clearing the bits on the way down. Each level moves its
+    bit into Scene Test, clearing Scene Else if it was set, then runs
+    one branch or the other."""
+    if not isinstance(tree, tuple):
+        emit_scene(tokens, memory, blocks, tree)
+        return
+    zero, one = tree
+    bit_offset = memory.scene_bit_offsets[depth]
+    test_offset = memory.scene_test_register_offset
+    else_offset = memory.scene_else_register_offset
+    memory.statement_offset = None
+    memory.mark("scene dispatch")
+    memory.add_value_at_offset(1, else_offset)
+    memory.move_pointer_to_offset(bit_offset)
+    memory.emit("[-")
+    memory.add_value_at_offset(1, test_offset)
+    memory.subtract_value_at_offset(1, else_offset)
+    memory.move_pointer_to_offset(bit_offset)
+    memory.emit("]")
+    memory.move_pointer_to_offset(test_offset)
+    memory.emit("[-")
+    emit_scene_dispatch(tokens, memory, blocks, one, depth + 1)
+    memory.move_pointer_to_offset(test_offset)
+    memory.emit("]")
+    memory.move_pointer_to_offset(else_offset)
+    memory.emit("[-")
+    emit_scene_dispatch(tokens, memory, blocks, zero, depth + 1)
+    memory.move_pointer_to_offset(else_offset)
+    memory.emit("]")
 
 def setup_memory_offsets(tokens, memory, offset):
     """Extract the character array which resides between the chars and
     endchars tokens"""
     character_array = extract_elements_between_tokens(
         tokens,
-        token_pairs()["chars"],
-        offset)
+        TOKEN_PAIRS["chars"],
+        offset,
+        memory.bookends)
     if not character_array:
         raise Exception("No characters found in input NSPL file, aborting")
     for character in character_array:
         memory.add_character(character)
     memory.finalise_characters()
-    return ["", 2 + len(character_array)]
+    return 2 + len(character_array)
 
 def enter_characters(tokens, memory, offset):
-    """Returns the Brainfuck required to load the given characters into
+    """Emits the Brainfuck required to load the given characters into
     the character registers"""
-    output_brainfuck = ""
     character_array = extract_elements_between_tokens(
         tokens,
-        token_pairs()["enter_scene_multiple"],
-        offset)
+        TOKEN_PAIRS["enter_scene_multiple"],
+        offset,
+        memory.bookends)
     if not character_array:
         raise Exception("No characters provided to put onto scene, aborting")
     if len(character_array) != 2:
@@ -328,40 +1496,35 @@ def enter_characters(tokens, memory, offset):
         # Move to the OS1 + OS2 registers, wipe out the current value if
         # necessary and replace them with the index of the new characters
         # on stage
-        output_brainfuck += memory.move_pointer_to_offset(stage_offset)
-        output_brainfuck += "[-]"
-        output_brainfuck += "+" * (memory.characters.index(character) + 1)
-        output_brainfuck += memory.reset_pointer()
+        memory.set_value_at_offset(memory.characters.index(character) + 1,
+                                   stage_offset)
         stage_offset += 1
-    return [output_brainfuck, 2 + len(character_array)]
+    return 2 + len(character_array)
 
 def exit_characters(tokens, memory, offset):
-    """Returns the Brainfuck required to remove all characters
+    """Emits the Brainfuck required to remove all characters
     from the character registers"""
-    output_brainfuck = ""
     character_array = extract_elements_between_tokens(
         tokens,
-        token_pairs()["exit_scene_multiple"],
-        offset)
+        TOKEN_PAIRS["exit_scene_multiple"],
+        offset,
+        memory.bookends)
     if not (len(character_array) == 2 or len(character_array) == 0):
         raise Exception("Wrong number of characters provided")
     stage_offset = memory.on_stage_one_register_offset
     # Move to the OS1 + OS2 registers, wipe out the current value if
     # necessary and replace them with the index of the new characters
     # on stage
-    output_brainfuck += memory.move_pointer_to_offset(stage_offset)
-    output_brainfuck += "[-]"
-    output_brainfuck += memory.reset_pointer()
+    memory.zero_value_at_offset(stage_offset)
+    memory.set_known_value(stage_offset, 0)
     stage_offset += 1
-    output_brainfuck += memory.move_pointer_to_offset(stage_offset)
-    output_brainfuck += "[-]"
-    output_brainfuck += memory.reset_pointer()
-    return [output_brainfuck, 2 + len(character_array)]
+    memory.zero_value_at_offset(stage_offset)
+    memory.set_known_value(stage_offset, 0)
+    return 2 + len(character_array)
 
 def enter_character(tokens, memory, offset):
-    """Returns the Brainfuck required to load the given character into
+    """Emits the Brainfuck required to load the given character into
     the empty character register"""
-    output_brainfuck = ""
     new_character = extract_next_elements(tokens, 2, offset)[1]
     new_character_offset = memory.characters.index(new_character) + 1
     stage_offset = memory.on_stage_one_register_offset
@@ -371,76 +1534,81 @@ def enter_character(tokens, memory, offset):
 
     # There must be at least one empty space for the character to join.
     # We'll assume that if it isn't OS1, it must be OS2.
+    stage_one = memory.known_value(stage_offset)
+    if stage_one is not None:
+        # We know which one is free at compile time
+        if stage_one:
+            stage_offset += 1
+        stage_value = memory.known_value(stage_offset)
+        memory.add_value_at_offset(new_character_offset, stage_offset)
+        memory.set_known_value(stage_offset,
+                               None if stage_value is None
+                               else stage_value + new_character_offset)
+        return 2
+
     # Reset result
-    output_brainfuck += memory.move_pointer_to_offset(result_register_offset)
-    output_brainfuck += "[-]"
-    output_brainfuck += memory.reset_pointer()
+    memory.move_pointer_to_offset(result_register_offset)
+    memory.emit("[-]")
 
     # If OS1 == 0, fill it with the character and set Result to 1
     # Idiom for 'if equal to 0:
     #  <set non-zero register to 1><test register>
     #  [<set not-zero register to 0>]<test non-zero register>[<code>]
-    output_brainfuck += memory.move_pointer_to_offset(result_register_offset)
-    output_brainfuck += "+" + memory.reset_pointer()
-    output_brainfuck += memory.move_pointer_to_offset(stage_offset)
-    output_brainfuck += "[" + memory.reset_pointer()
-    output_brainfuck += memory.move_pointer_to_offset(result_register_offset)
-    output_brainfuck += "-" + memory.reset_pointer()
-    output_brainfuck += memory.move_pointer_to_offset(
-        stage_offset)
+    memory.move_pointer_to_offset(result_register_offset)
+    memory.emit("+")
+    memory.move_pointer_to_offset(stage_offset)
+    memory.emit("[")
+    memory.move_pointer_to_offset(result_register_offset)
+    memory.emit("-")
+    memory.move_pointer_to_offset(stage_offset)
     # Escape loop with Loop trick
-    output_brainfuck += "[-" + memory.reset_pointer()
-    output_brainfuck += memory.move_pointer_to_offset(
-        loop_register_offset)
-    output_brainfuck += "+" + memory.reset_pointer()
-    output_brainfuck += memory.move_pointer_to_offset(
-        stage_offset)
-    output_brainfuck += "]" + memory.reset_pointer()
-    output_brainfuck += memory.move_pointer_to_offset(
-        stage_offset)
-    output_brainfuck += "]" + memory.reset_pointer()
+    memory.emit("[-")
+    memory.move_pointer_to_offset(loop_register_offset)
+    memory.emit("+")
+    memory.move_pointer_to_offset(stage_offset)
+    memory.emit("]")
+    memory.move_pointer_to_offset(stage_offset)
+    memory.emit("]")
 
     # Restore OS1
-    output_brainfuck += memory.move_pointer_to_offset(
-        loop_register_offset)
-    output_brainfuck += "[-" + memory.reset_pointer()
-    output_brainfuck += memory.move_pointer_to_offset(
-        stage_offset)
-    output_brainfuck += "+" + memory.reset_pointer()
-    output_brainfuck += memory.move_pointer_to_offset(
-        loop_register_offset)
-    output_brainfuck += "]" + memory.reset_pointer()
+    memory.move_pointer_to_offset(loop_register_offset)
+    memory.emit("[-")
+    memory.move_pointer_to_offset(stage_offset)
+    memory.emit("+")
+    memory.move_pointer_to_offset(loop_register_offset)
+    memory.emit("]")
 
     # If Result is not zero, OS1 is empty and needs to be filled
     # Use the copy register to keep track of the fact we entered this loop
     # If copy is zero, don't copy into OS2 instead
-    output_brainfuck += memory.move_pointer_to_offset(copy_register_offset)
-    output_brainfuck += "[-]+" + memory.reset_pointer()
-    output_brainfuck += memory.move_pointer_to_offset(result_register_offset)
-    output_brainfuck += "[" + memory.reset_pointer()
-    output_brainfuck += memory.move_pointer_to_offset(stage_offset)
-    output_brainfuck += "+" * new_character_offset + memory.reset_pointer()
-    output_brainfuck += memory.move_pointer_to_offset(copy_register_offset)
-    output_brainfuck += "-" + memory.reset_pointer()
-    output_brainfuck += memory.move_pointer_to_offset(result_register_offset)
-    output_brainfuck += "-]" + memory.reset_pointer()
+    memory.move_pointer_to_offset(copy_register_offset)
+    memory.emit("[-]+")
+    memory.move_pointer_to_offset(result_register_offset)
+    memory.emit("[")
+    memory.move_pointer_to_offset(stage_offset)
+    memory.emit("+" * new_character_offset)
+    memory.move_pointer_to_offset(copy_register_offset)
+    memory.emit("-")
+    memory.move_pointer_to_offset(result_register_offset)
+    memory.emit("-]")
 
     # If the above didn't execute, Copy contains 1.
     stage_offset += 1
-    output_brainfuck += memory.move_pointer_to_offset(copy_register_offset)
-    output_brainfuck += "[" + memory.reset_pointer()
-    output_brainfuck += memory.move_pointer_to_offset(stage_offset)
-    output_brainfuck += "+" * new_character_offset + memory.reset_pointer()
-    output_brainfuck += memory.move_pointer_to_offset(copy_register_offset)
-    output_brainfuck += "-]" + memory.reset_pointer()
+    memory.move_pointer_to_offset(copy_register_offset)
+    memory.emit("[")
+    memory.move_pointer_to_offset(stage_offset)
+    memory.emit("+" * new_character_offset)
+    memory.move_pointer_to_offset(copy_register_offset)
+    memory.emit("-]")
+    memory.set_known_value(memory.on_stage_one_register_offset, None)
+    memory.set_known_value(memory.on_stage_two_register_offset, None)
 
     # Final result: Copy 0, Result 0, OS1 or OS2 filled with new offset
-    return [output_brainfuck, 2]
+    return 2
 
 def exit_character(tokens, memory, offset):
-    """Returns the Brainfuck required to remove the given character from
+    """Emits the Brainfuck required to remove the given character from
     the stage."""
-    output_brainfuck = ""
     character = extract_next_elements(tokens, 2, offset)[1]
     character_offset = memory.characters.index(character) + 1
     stage_one_offset = memory.on_stage_one_register_offset
@@ -450,42 +1618,53 @@ def exit_character(tokens, memory, offset):
     # We'll first try and remove the character from OS1
     # If there's still a non-zero value in OS1, we will
     # restore OS1 and delete OS2 instead.
-    output_brainfuck += memory.subtract_value_at_offset(character_offset,
-                                                        stage_one_offset)
-    output_brainfuck += memory.move_pointer_to_offset(stage_one_offset)
-    output_brainfuck += "[" + memory.reset_pointer()
-    output_brainfuck += memory.subtract_value_at_offset(character_offset,
-                                                        stage_two_offset)
-    output_brainfuck += memory.add_value_at_offset(character_offset,
-                                                   stage_one_offset)
-    output_brainfuck += memory.move_pointer_to_offset(stage_one_offset)
-    output_brainfuck += "[-" + memory.reset_pointer()
-    output_brainfuck += memory.move_pointer_to_offset(loop_register_offset)
-    output_brainfuck += "+" + memory.reset_pointer()
-    output_brainfuck += memory.move_pointer_to_offset(stage_one_offset)
-    output_brainfuck += "]" + memory.reset_pointer()
-    output_brainfuck += memory.move_pointer_to_offset(stage_one_offset)
-    output_brainfuck += "]" + memory.reset_pointer()
+    stage_one = memory.known_value(stage_one_offset)
+    if stage_one is not None:
+        # We know which register they're in at compile time
+        if stage_one == character_offset:
+            memory.subtract_value_at_offset(character_offset,
+                                            stage_one_offset)
+            memory.set_known_value(stage_one_offset, 0)
+        else:
+            stage_two = memory.known_value(stage_two_offset)
+            memory.subtract_value_at_offset(character_offset,
+                                            stage_two_offset)
+            memory.set_known_value(stage_two_offset,
+                                   None if stage_two is None
+                                   else stage_two - character_offset)
+        return 2
+
+    memory.subtract_value_at_offset(character_offset, stage_one_offset)
+    memory.move_pointer_to_offset(stage_one_offset)
+    memory.emit("[")
+    memory.subtract_value_at_offset(character_offset, stage_two_offset)
+    memory.add_value_at_offset(character_offset, stage_one_offset)
+    memory.move_pointer_to_offset(stage_one_offset)
+    memory.emit("[-")
+    memory.move_pointer_to_offset(loop_register_offset)
+    memory.emit("+")
+    memory.move_pointer_to_offset(stage_one_offset)
+    memory.emit("]")
+    memory.move_pointer_to_offset(stage_one_offset)
+    memory.emit("]")
 
     # Restore OS1
-    output_brainfuck += memory.move_pointer_to_offset(
-        loop_register_offset)
-    output_brainfuck += "[-" + memory.reset_pointer()
-    output_brainfuck += memory.move_pointer_to_offset(stage_one_offset)
-    output_brainfuck += "+" + memory.reset_pointer()
-    output_brainfuck += memory.move_pointer_to_offset(
-        loop_register_offset)
-    output_brainfuck += "]" + memory.reset_pointer()
-
+    memory.move_pointer_to_offset(loop_register_offset)
+    memory.emit("[-")
+    memory.move_pointer_to_offset(stage_one_offset)
+    memory.emit("+")
+    memory.move_pointer_to_offset(loop_register_offset)
+    memory.emit("]")
+    memory.set_known_value(stage_one_offset, None)
+    memory.set_known_value(stage_two_offset, None)
 
     # Final result: Copy 0, Result 0, OS1 or OS2 filled with new offset
-    return [output_brainfuck, 2]
+    return 2
 
 def activate_character(tokens, memory, offset):
-    """Returns the brainfuck for moving the given character into the
+    """Emits the brainfuck for moving the given character into the
     active character register, also moving the other character into the
     second person register if present"""
-    output_brainfuck = ""
     active_character = extract_next_elements(tokens, 2, offset)[1]
     active_character_offset = memory.characters.index(active_character) + 1
     result_register_offset = memory.result_register_offset
@@ -499,704 +1678,1266 @@ def activate_character(tokens, memory, offset):
     # offset of the other actor on stage. This means checking if
     # the first on-stage offset is equal to the active character's
     # offset. If not, copy in the secnd on-stage offset instead.
+    stage_one = memory.known_value(os1_register_offset)
+    stage_two = memory.known_value(os2_register_offset)
+    if stage_two is not None and stage_two != active_character_offset:
+        second_character_offset = stage_two
+    elif stage_two is not None and stage_one is not None:
+        second_character_offset = stage_one
+    else:
+        second_character_offset = None
+    if second_character_offset is not None:
+        # Who's on stage is known at compile time, so just set them
+        memory.set_value_at_offset(active_character_offset,
+                                   active_character_register_offset)
+        memory.set_value_at_offset(second_character_offset,
+                                   second_character_register_offset)
+        return 2
 
     # Reset the active character and result
-    output_brainfuck += memory.move_pointer_to_offset(result_register_offset)
-    output_brainfuck += "[-]"
-    output_brainfuck += memory.reset_pointer()
-    output_brainfuck += memory.move_pointer_to_offset(
-        active_character_register_offset)
-    output_brainfuck += "[-]"
-    output_brainfuck += memory.reset_pointer()
+    memory.move_pointer_to_offset(result_register_offset)
+    memory.emit("[-]")
+    memory.move_pointer_to_offset(active_character_register_offset)
+    memory.emit("[-]")
 
     # Put the target active character into the result and
     # active character slots.
-    output_brainfuck += memory.move_pointer_to_offset(result_register_offset)
-    output_brainfuck += "+" * active_character_offset
-    output_brainfuck += memory.reset_pointer()
-    output_brainfuck += memory.move_pointer_to_offset(
-        active_character_register_offset)
-    output_brainfuck += "+" * active_character_offset
-    output_brainfuck += memory.reset_pointer()
+    memory.move_pointer_to_offset(result_register_offset)
+    memory.emit("+" * active_character_offset)
+    memory.move_pointer_to_offset(active_character_register_offset)
+    memory.emit("+" * active_character_offset)
 
     # Subtract Result from OS2, put the result in Result
     # Sub-step: OS2 goes into copy register while subtracting
-    output_brainfuck +=  memory.move_pointer_to_offset(os2_register_offset)
-    output_brainfuck += "[-" + memory.reset_pointer()
-    output_brainfuck += memory.move_pointer_to_offset(result_register_offset)
-    output_brainfuck += "-" + memory.reset_pointer()
-    output_brainfuck += memory.move_pointer_to_offset(copy_register_offset)
-    output_brainfuck += "+" + memory.reset_pointer()
-    output_brainfuck +=  memory.move_pointer_to_offset(os2_register_offset)
-    output_brainfuck += "]" + memory.reset_pointer()
+    memory.move_pointer_to_offset(os2_register_offset)
+    memory.emit("[-")
+    memory.move_pointer_to_offset(result_register_offset)
+    memory.emit("-")
+    memory.move_pointer_to_offset(copy_register_offset)
+    memory.emit("+")
+    memory.move_pointer_to_offset(os2_register_offset)
+    memory.emit("]")
     # Sub-step: Restore OS2
-    output_brainfuck +=  memory.move_pointer_to_offset(copy_register_offset)
-    output_brainfuck += "[-" + memory.reset_pointer()
-    output_brainfuck += memory.move_pointer_to_offset(os2_register_offset)
-    output_brainfuck += "+" + memory.reset_pointer()
-    output_brainfuck += memory.move_pointer_to_offset(copy_register_offset)
-    output_brainfuck += "]" + memory.reset_pointer()
+    memory.move_pointer_to_offset(copy_register_offset)
+    memory.emit("[-")
+    memory.move_pointer_to_offset(os2_register_offset)
+    memory.emit("+")
+    memory.move_pointer_to_offset(copy_register_offset)
+    memory.emit("]")
 
     # Set Sec to 0. If Result != 0, add 1 to Sec. Reset Result.
-    output_brainfuck += memory.move_pointer_to_offset(
-        second_character_register_offset)
-    output_brainfuck += "[-]" + memory.reset_pointer()
-    output_brainfuck += memory.move_pointer_to_offset(result_register_offset)
-    output_brainfuck += "[" + memory.reset_pointer()
-    output_brainfuck += memory.move_pointer_to_offset(
-        second_character_register_offset)
-    output_brainfuck += "+" + memory.reset_pointer()
+    memory.move_pointer_to_offset(second_character_register_offset)
+    memory.emit("[-]")
+    memory.move_pointer_to_offset(result_register_offset)
+    memory.emit("[")
+    memory.move_pointer_to_offset(second_character_register_offset)
+    memory.emit("+")
     # Reset result.
-    output_brainfuck += memory.move_pointer_to_offset(result_register_offset)
-    output_brainfuck += "[-]"
-    output_brainfuck += "]" + memory.reset_pointer()
+    memory.move_pointer_to_offset(result_register_offset)
+    memory.emit("[-]")
+    memory.emit("]")
 
 
     # If Sec != 0, copy OS2 into Result
-    output_brainfuck += memory.move_pointer_to_offset(
-        second_character_register_offset)
-    output_brainfuck += "[" + memory.reset_pointer()
+    memory.move_pointer_to_offset(second_character_register_offset)
+    memory.emit("[")
     # Sub-step: OS2 goes into copy register while adding
-    output_brainfuck +=  memory.move_pointer_to_offset(os2_register_offset)
-    output_brainfuck += "[-" + memory.reset_pointer()
-    output_brainfuck += memory.move_pointer_to_offset(result_register_offset)
-    output_brainfuck += "+" + memory.reset_pointer()
-    output_brainfuck += memory.move_pointer_to_offset(copy_register_offset)
-    output_brainfuck += "+" + memory.reset_pointer()
-    output_brainfuck +=  memory.move_pointer_to_offset(os2_register_offset)
-    output_brainfuck += "]" + memory.reset_pointer()
+    memory.move_pointer_to_offset(os2_register_offset)
+    memory.emit("[-")
+    memory.move_pointer_to_offset(result_register_offset)
+    memory.emit("+")
+    memory.move_pointer_to_offset(copy_register_offset)
+    memory.emit("+")
+    memory.move_pointer_to_offset(os2_register_offset)
+    memory.emit("]")
     # Sub-step: Restore OS2
-    output_brainfuck +=  memory.move_pointer_to_offset(copy_register_offset)
-    output_brainfuck += "[-" + memory.reset_pointer()
-    output_brainfuck += memory.move_pointer_to_offset(os2_register_offset)
-    output_brainfuck += "+" + memory.reset_pointer()
-    output_brainfuck += memory.move_pointer_to_offset(copy_register_offset)
-    output_brainfuck += "]" + memory.reset_pointer()
-    output_brainfuck += memory.move_pointer_to_offset(
-        loop_register_offset)
-    output_brainfuck += "+" + memory.reset_pointer()
-    output_brainfuck += memory.move_pointer_to_offset(
-        second_character_register_offset)
-    output_brainfuck += "-"
-    output_brainfuck += "]" + memory.reset_pointer()
+    memory.move_pointer_to_offset(copy_register_offset)
+    memory.emit("[-")
+    memory.move_pointer_to_offset(os2_register_offset)
+    memory.emit("+")
+    memory.move_pointer_to_offset(copy_register_offset)
+    memory.emit("]")
+    memory.move_pointer_to_offset(loop_register_offset)
+    memory.emit("+")
+    memory.move_pointer_to_offset(second_character_register_offset)
+    memory.emit("-")
+    memory.emit("]")
 
     # Restore Sec from Loop
-    output_brainfuck +=  memory.move_pointer_to_offset(loop_register_offset)
-    output_brainfuck += "[-" + memory.reset_pointer()
-    output_brainfuck += memory.move_pointer_to_offset(
-        second_character_register_offset)
-    output_brainfuck += "+" + memory.reset_pointer()
-    output_brainfuck += memory.move_pointer_to_offset(loop_register_offset)
-    output_brainfuck += "]" + memory.reset_pointer()
+    memory.move_pointer_to_offset(loop_register_offset)
+    memory.emit("[-")
+    memory.move_pointer_to_offset(second_character_register_offset)
+    memory.emit("+")
+    memory.move_pointer_to_offset(loop_register_offset)
+    memory.emit("]")
 
     # Sec - 1
-    output_brainfuck += memory.move_pointer_to_offset(
-        second_character_register_offset)
-    output_brainfuck += "-" + memory.reset_pointer()
+    memory.move_pointer_to_offset(second_character_register_offset)
+    memory.emit("-")
 
     # If Sec != 0, reset sec, copy OS1 into Sec
-    output_brainfuck += memory.move_pointer_to_offset(
-        second_character_register_offset)
-    output_brainfuck += "[[-]" + memory.reset_pointer()
+    memory.move_pointer_to_offset(second_character_register_offset)
+    memory.emit("[[-]")
     # Sub-step: OS1 goes into copy register while adding to Sec
-    output_brainfuck +=  memory.move_pointer_to_offset(os1_register_offset)
-    output_brainfuck += "[-" + memory.reset_pointer()
-    output_brainfuck += memory.move_pointer_to_offset(
-        second_character_register_offset)
-    output_brainfuck += "+" + memory.reset_pointer()
-    output_brainfuck += memory.move_pointer_to_offset(copy_register_offset)
-    output_brainfuck += "+" + memory.reset_pointer()
-    output_brainfuck +=  memory.move_pointer_to_offset(os1_register_offset)
-    output_brainfuck += "]" + memory.reset_pointer()
+    memory.move_pointer_to_offset(os1_register_offset)
+    memory.emit("[-")
+    memory.move_pointer_to_offset(second_character_register_offset)
+    memory.emit("+")
+    memory.move_pointer_to_offset(copy_register_offset)
+    memory.emit("+")
+    memory.move_pointer_to_offset(os1_register_offset)
+    memory.emit("]")
     # Sub-step: Restore OS1
-    output_brainfuck +=  memory.move_pointer_to_offset(copy_register_offset)
-    output_brainfuck += "[-" + memory.reset_pointer()
-    output_brainfuck += memory.move_pointer_to_offset(os1_register_offset)
-    output_brainfuck += "+" + memory.reset_pointer()
-    output_brainfuck += memory.move_pointer_to_offset(copy_register_offset)
-    output_brainfuck += "]" + memory.reset_pointer()
-    output_brainfuck += memory.move_pointer_to_offset(
-        second_character_register_offset)
-    output_brainfuck += "[-" + memory.reset_pointer()
-    output_brainfuck += memory.move_pointer_to_offset(
-        loop_register_offset)
-    output_brainfuck += "+" + memory.reset_pointer()
-    output_brainfuck += memory.move_pointer_to_offset(
-        second_character_register_offset)
-    output_brainfuck += "]" + memory.reset_pointer()
-    output_brainfuck += memory.move_pointer_to_offset(
-        second_character_register_offset)
-    output_brainfuck += "]" + memory.reset_pointer()
+    memory.move_pointer_to_offset(copy_register_offset)
+    memory.emit("[-")
+    memory.move_pointer_to_offset(os1_register_offset)
+    memory.emit("+")
+    memory.move_pointer_to_offset(copy_register_offset)
+    memory.emit("]")
+    memory.move_pointer_to_offset(second_character_register_offset)
+    memory.emit("[-")
+    memory.move_pointer_to_offset(loop_register_offset)
+    memory.emit("+")
+    memory.move_pointer_to_offset(second_character_register_offset)
+    memory.emit("]")
+    memory.move_pointer_to_offset(second_character_register_offset)
+    memory.emit("]")
 
     # Restore Sec
-    output_brainfuck += memory.move_pointer_to_offset(
-        loop_register_offset)
-    output_brainfuck += "[-" + memory.reset_pointer()
-    output_brainfuck += memory.move_pointer_to_offset(
-        second_character_register_offset)
-    output_brainfuck += "+" + memory.reset_pointer()
-    output_brainfuck += memory.move_pointer_to_offset(
-        loop_register_offset)
-    output_brainfuck += "]" + memory.reset_pointer()
+    memory.move_pointer_to_offset(loop_register_offset)
+    memory.emit("[-")
+    memory.move_pointer_to_offset(second_character_register_offset)
+    memory.emit("+")
+    memory.move_pointer_to_offset(loop_register_offset)
+    memory.emit("]")
 
     # Add result to Sec.
     # Sub-step: Result goes into copy register while adding to Sec
-    output_brainfuck +=  memory.move_pointer_to_offset(result_register_offset)
-    output_brainfuck += "[-" + memory.reset_pointer()
-    output_brainfuck += memory.move_pointer_to_offset(
-        second_character_register_offset)
-    output_brainfuck += "+" + memory.reset_pointer()
-    output_brainfuck += memory.move_pointer_to_offset(copy_register_offset)
-    output_brainfuck += "+" + memory.reset_pointer()
-    output_brainfuck +=  memory.move_pointer_to_offset(result_register_offset)
-    output_brainfuck += "]" + memory.reset_pointer()
+    memory.move_pointer_to_offset(result_register_offset)
+    memory.emit("[-")
+    memory.move_pointer_to_offset(second_character_register_offset)
+    memory.emit("+")
+    memory.move_pointer_to_offset(copy_register_offset)
+    memory.emit("+")
+    memory.move_pointer_to_offset(result_register_offset)
+    memory.emit("]")
     # Sub-step: Restore OS1
-    output_brainfuck +=  memory.move_pointer_to_offset(copy_register_offset)
-    output_brainfuck += "[-" + memory.reset_pointer()
-    output_brainfuck += memory.move_pointer_to_offset(result_register_offset)
-    output_brainfuck += "+" + memory.reset_pointer()
-    output_brainfuck += memory.move_pointer_to_offset(copy_register_offset)
-    output_brainfuck += "]" + memory.reset_pointer()
+    memory.move_pointer_to_offset(copy_register_offset)
+    memory.emit("[-")
+    memory.move_pointer_to_offset(result_register_offset)
+    memory.emit("+")
+    memory.move_pointer_to_offset(copy_register_offset)
+    memory.emit("]")
 
     # Reset result
-    output_brainfuck += memory.move_pointer_to_offset(result_register_offset)
-    output_brainfuck += "[-]" + memory.reset_pointer()
-    return [output_brainfuck, 2]
+    memory.move_pointer_to_offset(result_register_offset)
+    memory.emit("[-]")
+    memory.set_known_value(active_character_register_offset,
+                           active_character_offset)
+    memory.set_known_value(second_character_register_offset, None)
+    memory.write_index_bits(active_character_register_offset)
+    memory.write_index_bits(second_character_register_offset)
+    return 2
+
+def act_label(tokens, memory, offset):
+    """Act labels emit no code, but if a goto can jump here then who is
+    on stage can no longer be known at compile time"""
+    act = extract_next_elements(tokens, 4, offset)[2]
+    if ("act", act) in memory.jump_targets:
+        memory.forget_known_values()
+    return 4
+
+def scene_label(tokens, memory, offset):
+    """Scene labels emit no code, but if a goto can jump here then who
+    is on stage can no longer be known at compile time"""
+    label = extract_next_elements(tokens, 6, offset)
+    if ("scene", label[2], label[4]) in memory.jump_targets:
+        memory.forget_known_values()
+    return 6
+
+def source_line(tokens, memory, offset):
+    """Line annotations from spl2nspl, naming the line of the play the
+    next statement ends on, emit no code. See source_map."""
+    return 2
+
+def goto(tokens, memory, offset):
+    """Emits the brainfuck for jumping to an act or scene: the scene
+    machine is told to run its block next, and Continue is cleared so
+    the rest of this one is skipped. A goto that isn't under an if is
+    always taken, so the rest of the block isn't compiled at all."""
+    goto = extract_next_elements(tokens, 5, offset)
+    if len(goto) == 5 and goto[3] == "scene":
+        label = ("scene", goto[2], goto[4])
+        length = 5
+    else:
+        label = ("act", goto[2])
+        length = 3
+    memory.set_scene(memory.scene_blocks[label])
+    if memory.conditional is None:
+        memory.unreachable = True
+        return length
+    memory.zero_value_at_offset(memory.continue_register_offset)
+    memory.guard_pending = True
+    return length
+
+def set_left_comp(tokens, memory, offset):
+    """Emits the brainfuck for working out the left value of a question
+    into Down"""
+    expression_array = extract_elements_between_tokens(
+        tokens,
+        TOKEN_PAIRS["set_left_comp"],
+        offset,
+        memory.bookends)
+    evaluate_expression(memory.test_cell_offset() + 4,
+                        tokens,
+                        memory,
+                        offset+1)
+    return len(expression_array) + 2
+
+def set_right_comp(tokens, memory, offset):
+    """Emits the brainfuck for working out the right value of a question
+    into Up"""
+    expression_array = extract_elements_between_tokens(
+        tokens,
+        TOKEN_PAIRS["set_right_comp"],
+        offset,
+        memory.bookends)
+    evaluate_expression(memory.test_cell_offset() + 5,
+                        tokens,
+                        memory,
+                        offset+1)
+    return len(expression_array) + 2
+
+def comparison(tokens, memory, offset):
+    """Emits the brainfuck for answering a question, setting Truth to 1
+    if its values compare as asked and 0 if not"""
+    memory.compare(tokens[offset])
+    return 1
+
+def negation(tokens, memory, offset):
+    """Emits the brainfuck for answering a question with a not in it,
+    which is no dearer than one without"""
+    comparison = tokens[offset + 1]
+    if comparison.endswith("endnot"):
+        # Older versions of spl2nspl left out the comma before endnot
+        memory.compare(comparison[:-len("endnot")], negate=True)
+        return 2
+    memory.compare(comparison, negate=True)
+    return 3
+
+def conditional(tokens, memory, offset):
+    """Emits the brainfuck that opens the sentence after an if, so it
+    only runs if the answer to the last question was as the if says.
+    Truth is tested without being changed, using its flag cell, so any
+    number of ifs can follow one question. A dozen or so steps on top
+    of the sentence whether it runs or not, with no copying."""
+    memory.conditional = tokens[offset + 1]
+    truth = memory.test_cell_offset()
+    if memory.conditional == "true":
+        memory.open_if_nonzero(truth, 1)
+    elif memory.conditional == "false":
+        memory.open_if_zero(truth, 1)
+    else:
+        raise Exception("Unknown condition: " + memory.conditional)
+    return 2
+
+def end_conditional(tokens, memory, offset):
+    """Emits the brainfuck that closes the sentence after an if. No
+    sentence can change who is on stage, so what is known about the
+    stage registers still holds."""
+    truth = memory.test_cell_offset()
+    if memory.conditional == "true":
+        memory.close_if_nonzero(truth, 1)
+    else:
+        memory.close_if_zero(truth, 1)
+    memory.conditional = None
+    return 1
 
 def output_character(tokens, memory, offset):
-    """Returns the brainfuck for outputing in ASCII the value in the
+    """Emits the brainfuck for outputing in ASCII the value in the
     Second character's register"""
-    output_brainfuck = memory.output_second_character_register()
-    return [output_brainfuck, 1]
+    memory.output_second_character_register()
+    return 1
+
+def output_number(tokens, memory, offset):
+    """Emits the brainfuck for outputing the value in the Second
+    character's register as a decimal number"""
+    memory.copy_from_second_character_register(memory.test_cell_offset() + 4)
+    memory.print_decimal()
+    return 1
+
+def input_number(tokens, memory, offset):
+    """Emits the brainfuck for reading a decimal number into the Second
+    character's register"""
+    memory.zero_value_at_offset(memory.result_register_offset)
+    memory.read_decimal(memory.result_register_offset)
+    memory.reset_second_character_register()
+    memory.copy_into_second_character_register(memory.result_register_offset)
+    memory.zero_value_at_offset(memory.result_register_offset)
+    return 1
+
+def input_character(tokens, memory, offset):
+    """Emits the brainfuck for reading a character into the Second
+    character's register"""
+    memory.zero_value_at_offset(memory.result_register_offset)
+    memory.read_character(memory.result_register_offset)
+    memory.reset_second_character_register()
+    memory.copy_into_second_character_register(memory.result_register_offset)
+    memory.zero_value_at_offset(memory.result_register_offset)
+    return 1
 
 def breakpoint(tokens, memory, offset):
-    """Returns the brainfuck for entering a debug state in some
+    """Emits the brainfuck for entering a debug state in some
     BF interpreters"""
-    output_brainfuck = "#"
-    return [output_brainfuck, 1]
+    memory.emit("#")
+    return 1
 
 def assign(tokens, memory, offset):
-    """Returns the brainfuck for resetting the Result register before
+    """Emits the brainfuck for resetting the Result register before
     evaluating the internal expressions and assigning the result
     to the character referenced in the Second register."""
     expression_array = extract_elements_between_tokens(
         tokens,
-        token_pairs()["assign"],
-        offset)
-    output_brainfuck = ""
-    output_brainfuck += memory.zero_value_at_offset(
-        memory.result_register_offset)
+        TOKEN_PAIRS["assign"],
+        offset,
+        memory.bookends)
+    memory.zero_value_at_offset(memory.result_register_offset)
     # Do the expression evaluation, not fun..
-    output_brainfuck += evaluate_expression(memory.result_register_offset,
-                                            tokens,
-                                            memory,
-                                            offset+1)[0]
+    evaluate_expression(memory.result_register_offset,
+                        tokens,
+                        memory,
+                        offset+1)
 
     # Put Result into the Second character's register after resetting
-    output_brainfuck += memory.reset_second_character_register()
-    output_brainfuck += memory.copy_into_second_character_register(
-        memory.result_register_offset)
-    return [output_brainfuck, len(expression_array) + 2]
+    memory.reset_second_character_register()
+    memory.copy_into_second_character_register(memory.result_register_offset)
+    return len(expression_array) + 2
+
+def push(tokens, memory, offset):
+    """Emits the brainfuck for evaluating an expression into Result and
+    pushing it onto the Second character's stack"""
+    expression_array = extract_elements_between_tokens(
+        tokens,
+        TOKEN_PAIRS["push"],
+        offset,
+        memory.bookends)
+    memory.zero_value_at_offset(memory.result_register_offset)
+    evaluate_expression(memory.result_register_offset,
+                        tokens,
+                        memory,
+                        offset+1)
+    memory.push_to_second_character_stack(memory.result_register_offset)
+    return len(expression_array) + 2
+
+def pop(tokens, memory, offset):
+    """Emits the brainfuck for popping the Second character's stack
+    into their register"""
+    memory.pop_second_character_stack()
+    return 1
 
 # Binary and unary functions will destroy Left and Right during
 # processing
 def add_expression(target_register, memory):
-    left_register_offset = memory.get_character_stack_position_offset(
-        "left",
+    left_register_offset = memory.left_operand_offset(
         memory.left_register_counter)
     # Add Right to Left and jam it in the target register
-    output_brainfuck = ""
-    output_brainfuck += memory.move_pointer_to_offset(
-        memory.right_register_offset)
-    output_brainfuck += "[-" + memory.reset_pointer()
-    output_brainfuck += memory.move_pointer_to_offset(
-        left_register_offset)
-    output_brainfuck += "+" + memory.reset_pointer()
-    output_brainfuck += memory.move_pointer_to_offset(
-        memory.right_register_offset)
-    output_brainfuck += "]" + memory.reset_pointer()
-    output_brainfuck += memory.copy_register(left_register_offset,
-                                             target_register)
-    return output_brainfuck
+    memory.move_pointer_to_offset(memory.right_register_offset)
+    memory.emit("[-")
+    memory.move_pointer_to_offset(left_register_offset)
+    memory.emit("+")
+    memory.move_pointer_to_offset(memory.right_register_offset)
+    memory.emit("]")
+    memory.copy_register(left_register_offset, target_register)
 
 def sub_expression(target_register, memory):
-    left_register_offset = memory.get_character_stack_position_offset(
-        "left",
+    left_register_offset = memory.left_operand_offset(
         memory.left_register_counter)
     # Subtract Right from Left and jam it in the target register
-    output_brainfuck = ""
-    output_brainfuck += memory.move_pointer_to_offset(
-        memory.right_register_offset)
-    output_brainfuck += "[-" + memory.reset_pointer()
-    output_brainfuck += memory.move_pointer_to_offset(
-        left_register_offset)
-    output_brainfuck += "-" + memory.reset_pointer()
-    output_brainfuck += memory.move_pointer_to_offset(
-        memory.right_register_offset)
-    output_brainfuck += "]" + memory.reset_pointer()
-    output_brainfuck += memory.copy_register(left_register_offset,
-                                             target_register)
-    return output_brainfuck
+    memory.move_pointer_to_offset(memory.right_register_offset)
+    memory.emit("[-")
+    memory.move_pointer_to_offset(left_register_offset)
+    memory.emit("-")
+    memory.move_pointer_to_offset(memory.right_register_offset)
+    memory.emit("]")
+    memory.copy_register(left_register_offset, target_register)
 
 def mul_expression(target_register, memory):
-    left_register_offset = memory.get_character_stack_position_offset(
-        "left",
+    left_register_offset = memory.left_operand_offset(
         memory.left_register_counter)
-    # Keep copying Left into Target until Loop runs out
-    output_brainfuck = ""
-    output_brainfuck += memory.move_pointer_to_offset(
-        memory.right_register_offset)
-    output_brainfuck += "[-" + memory.reset_pointer()
-    output_brainfuck += memory.copy_register(left_register_offset,
-                                             target_register)
-    output_brainfuck += memory.move_pointer_to_offset(
-        memory.right_register_offset)
-    output_brainfuck += "]" + memory.reset_pointer()
-    return output_brainfuck
+    # Loop on Left, as fold_expression puts any constant on the right
+    inner_register_offset = memory.right_register_offset
+    if target_register == inner_register_offset:
+        # Right can't be added to while it is being multiplied by
+        memory.zero_value_at_offset(memory.loop_register_offset)
+        memory.move_register(inner_register_offset,
+                             memory.loop_register_offset)
+        inner_register_offset = memory.loop_register_offset
+    memory.zero_value_at_offset(memory.temp_register_offset)
+    memory.multiply(left_register_offset,
+                    inner_register_offset,
+                    target_register,
+                    memory.temp_register_offset)
+    memory.zero_value_at_offset(inner_register_offset)
+
+def scaled_expression(target_register, factor, memory):
+    """Multiplies Right by a small constant factor in one move loop,
+    which is what mul by a constant and twice come down to"""
+    if target_register == memory.right_register_offset:
+        memory.zero_value_at_offset(memory.temp_register_offset)
+        memory.move_register(memory.right_register_offset,
+                             memory.temp_register_offset,
+                             factor)
+        memory.move_register(memory.temp_register_offset, target_register)
+        return
+    memory.move_register(memory.right_register_offset,
+                         target_register,
+                         factor)
 
 def mod_expression(target_register, memory):
-    output_brainfuck = ""
-    return output_brainfuck
+    signed_divmod(target_register, memory, False)
 
 def div_expression(target_register, memory):
-    left_register_offset = memory.get_character_stack_position_offset(
-        "left",
+    signed_divmod(target_register, memory, True)
+
+def signed_divmod(target_register, memory, quotient):
+    """Divides the left operand by Right the way C does, rounding
+    towards zero, and moves the quotient, or the remainder if not
+    quotient, into the target. The operands are split into signs and
+    magnitudes, see split_sign, and the magnitudes divided. The
+    quotient is then negated once for each negative operand and the
+    remainder takes the sign of the left operand."""
+    left_register_offset = memory.left_operand_offset(
         memory.left_register_counter)
-    output_brainfuck = ""
-    # Counter
-    output_brainfuck += memory.zero_value_at_offset(memory.temp_register_offset)
-    # Loop needs to be zeroed
-    output_brainfuck += memory.zero_value_at_offset(
-        memory.loop_register_offset)
-
-    # Loop over Left until left_zero is set
-    output_brainfuck += memory.move_pointer_to_offset(left_register_offset)
-    output_brainfuck += "[" + memory.reset_pointer()
-    output_brainfuck += memory.zero_value_at_offset(
-        memory.retrieve_register_offset)
-    output_brainfuck += memory.copy_register(memory.right_register_offset,
-                                             memory.loop_register_offset)
-    output_brainfuck += memory.move_pointer_to_offset(
-        memory.loop_register_offset)
-    output_brainfuck += "[" + memory.reset_pointer()
-    output_brainfuck += memory.subtract_value_at_offset(
-        1,
-        memory.loop_register_offset)
-    output_brainfuck += memory.subtract_value_at_offset(1,
-                                                        left_register_offset)
-    output_brainfuck += memory.move_pointer_to_offset(left_register_offset)
-    output_brainfuck += "[" + memory.reset_pointer()
-    output_brainfuck += memory.add_value_at_offset(
-        1,
-        memory.retrieve_register_offset)
-    output_brainfuck += memory.move_pointer_to_offset(left_register_offset)
-    output_brainfuck += "[-" + memory.reset_pointer()
-    output_brainfuck += memory.move_pointer_to_offset(
-        memory.copy_register_offset)
-    output_brainfuck += "+" + memory.reset_pointer()
-    output_brainfuck += memory.move_pointer_to_offset(left_register_offset)
-    output_brainfuck += "]" + memory.reset_pointer()
-    output_brainfuck += memory.move_pointer_to_offset(left_register_offset)
-    output_brainfuck += "]" + memory.reset_pointer()
-    output_brainfuck += memory.move_pointer_to_offset(
-        memory.copy_register_offset)
-    output_brainfuck += "[-" + memory.reset_pointer()
-    output_brainfuck += memory.move_pointer_to_offset(left_register_offset)
-    output_brainfuck += "+" + memory.reset_pointer()
-    output_brainfuck += memory.move_pointer_to_offset(
-        memory.copy_register_offset)
-    output_brainfuck += "]" + memory.reset_pointer()
-    output_brainfuck += memory.move_pointer_to_offset(
-        memory.loop_register_offset)
-    output_brainfuck += "]" + memory.reset_pointer()
-
-    # Check if Right is equal to Retrieve. If not, left = 0.
-    # If so, counter + 1
-    output_brainfuck += memory.copy_register(memory.right_register_offset,
-                                             memory.loop_register_offset)
-    output_brainfuck += memory.move_pointer_to_offset(
-        memory.retrieve_register_offset)
-    output_brainfuck += "[-" + memory.reset_pointer()
-    output_brainfuck += memory.move_pointer_to_offset(
-        memory.loop_register_offset)
-    output_brainfuck += "-" + memory.reset_pointer()
-    output_brainfuck += memory.move_pointer_to_offset(
-        memory.retrieve_register_offset)
-    output_brainfuck += "]" + memory.reset_pointer()
-
-    # Test Loop and wipe out left if true
-    output_brainfuck += memory.move_pointer_to_offset(
-        memory.loop_register_offset)
-    output_brainfuck += "[-" + memory.reset_pointer()
-    output_brainfuck += memory.move_pointer_to_offset(
-        left_register_offset)
-    output_brainfuck += "[-]" + memory.reset_pointer()
-    output_brainfuck += memory.move_pointer_to_offset(
-        memory.loop_register_offset)
-    output_brainfuck += "]" + memory.reset_pointer()
-
-    # If left isn't zero, we didn't nuke it, so add one to the counter
-    output_brainfuck += memory.move_pointer_to_offset(left_register_offset)
-    output_brainfuck += "[" + memory.reset_pointer()
-    output_brainfuck += memory.add_value_at_offset(
-        1,
-        memory.temp_register_offset)
-    output_brainfuck += memory.move_pointer_to_offset(left_register_offset)
-    output_brainfuck += "[-" + memory.reset_pointer()
-    output_brainfuck += memory.move_pointer_to_offset(
-        memory.copy_register_offset)
-    output_brainfuck += "+" + memory.reset_pointer()
-    output_brainfuck += memory.move_pointer_to_offset(left_register_offset)
-    output_brainfuck += "]" + memory.reset_pointer()
-    output_brainfuck += memory.move_pointer_to_offset(left_register_offset)
-    output_brainfuck += "]" + memory.reset_pointer()
-    output_brainfuck += memory.move_pointer_to_offset(
-        memory.copy_register_offset)
-    output_brainfuck += "[-" + memory.reset_pointer()
-    output_brainfuck += memory.move_pointer_to_offset(left_register_offset)
-    output_brainfuck += "+" + memory.reset_pointer()
-    output_brainfuck += memory.move_pointer_to_offset(
-        memory.copy_register_offset)
-    output_brainfuck += "]" + memory.reset_pointer()
-    output_brainfuck += memory.move_pointer_to_offset(
-        left_register_offset)
-    output_brainfuck += "]" + memory.reset_pointer()
-    output_brainfuck += memory.copy_register(memory.temp_register_offset,
-                                             target_register)
-    # Cleanup
-    output_brainfuck += memory.zero_value_at_offset(
-        memory.temp_register_offset)
-    output_brainfuck += memory.zero_value_at_offset(
-        memory.loop_register_offset)
-    output_brainfuck += memory.zero_value_at_offset(
-        memory.retrieve_register_offset)
-    return output_brainfuck
+    base = memory.test_cell_offset()
+    left_sign, right_sign = base + 14, base + 15
+    quotient_register_offset = memory.retrieve_register_offset
+    remainder_register_offset = memory.temp_register_offset
+
+    def negate(offset):
+        memory.move_register(offset, memory.copy_register_offset, -1)
+        memory.move_register(memory.copy_register_offset, offset)
+
+    memory.split_sign(left_register_offset, left_sign, -1)
+    memory.split_sign(memory.right_register_offset, right_sign, 1)
+    memory.zero_value_at_offset(quotient_register_offset)
+    memory.zero_value_at_offset(remainder_register_offset)
+    memory.divmod(left_register_offset,
+                  memory.right_register_offset,
+                  quotient_register_offset,
+                  remainder_register_offset)
+    memory.open_if_nonzero(left_sign, -1)
+    negate(quotient_register_offset)
+    negate(remainder_register_offset)
+    memory.close_if_nonzero(left_sign, -1)
+    memory.open_if_nonzero(right_sign, 1)
+    negate(quotient_register_offset)
+    memory.close_if_nonzero(right_sign, 1)
+    memory.zero_value_at_offset(left_sign)
+    memory.zero_value_at_offset(right_sign)
+    if quotient:
+        kept, thrown = quotient_register_offset, remainder_register_offset
+    else:
+        kept, thrown = remainder_register_offset, quotient_register_offset
+    memory.zero_value_at_offset(thrown)
+    memory.move_register(kept, target_register)
 
 def cube_expression(target_register, memory):
-    temp_register_offset = memory.temp_register_offset
-    output_brainfuck = ""
-    output_brainfuck += memory.zero_value_at_offset(
-        memory.loop_register_offset)
-    output_brainfuck += memory.zero_value_at_offset(
-        memory.temp_register_offset)
-    output_brainfuck += memory.copy_register(memory.right_register_offset,
-                                             memory.loop_register_offset)
-    output_brainfuck += memory.move_pointer_to_offset(
-        memory.right_register_offset)
-    output_brainfuck += "[-" + memory.reset_pointer()
-    output_brainfuck += memory.copy_register(memory.loop_register_offset,
-                                             temp_register_offset)
-    output_brainfuck += memory.move_pointer_to_offset(
-        memory.right_register_offset)
-    output_brainfuck += "]" + memory.reset_pointer()
-    output_brainfuck += memory.copy_register(temp_register_offset,
-                                             memory.retrieve_register_offset)
-    output_brainfuck += memory.zero_value_at_offset(temp_register_offset)
-    output_brainfuck += memory.copy_register(memory.loop_register_offset,
-                                             memory.right_register_offset)
-    output_brainfuck += memory.move_pointer_to_offset(
-        memory.right_register_offset)
-    output_brainfuck += "[-" + memory.reset_pointer()
-    output_brainfuck += memory.copy_register(memory.retrieve_register_offset,
-                                             temp_register_offset)
-    output_brainfuck += memory.move_pointer_to_offset(
-        memory.right_register_offset)
-    output_brainfuck += "]" + memory.reset_pointer()
-    output_brainfuck += memory.zero_value_at_offset(
-        memory.retrieve_register_offset)
-    output_brainfuck += memory.zero_value_at_offset(
-        memory.loop_register_offset)
-    output_brainfuck += memory.copy_register(temp_register_offset,
-                                             target_register)
-    output_brainfuck += memory.zero_value_at_offset(
-        memory.temp_register_offset)
-    return output_brainfuck
+    # Square into Copy, then multiply that by Right, keeping the
+    # smaller of the two in the outer loop
+    split_right_register(memory)
+    memory.zero_value_at_offset(memory.copy_register_offset)
+    memory.multiply(memory.loop_register_offset,
+                    memory.retrieve_register_offset,
+                    memory.copy_register_offset,
+                    memory.temp_register_offset)
+    memory.multiply(memory.retrieve_register_offset,
+                    memory.copy_register_offset,
+                    target_register,
+                    memory.temp_register_offset)
+    memory.zero_value_at_offset(memory.copy_register_offset)
 
 def factorial_expression(target_register, memory):
-    output_brainfuck = ""
-    return output_brainfuck
+    # Multiply a running product in Loop by Right, counting Right down
+    # to zero. Each multiplication loops on a copy of the count in
+    # Retrieve, the smaller operand, adding into Copy, which then
+    # becomes the product. Costs under 8 * n * n steps on interpreters
+    # that run move loops in one step; in plain Brainfuck, each
+    # multiplication takes steps in proportion to the count times the
+    # product so far, which wraps at the cell width. A negative count
+    # is found first, see split_sign, and gives 0.
+    right_register_offset = memory.right_register_offset
+    product_register_offset = memory.loop_register_offset
+    count_register_offset = memory.retrieve_register_offset
+    negative_register_offset = memory.test_cell_offset() + 15
+    memory.split_sign(right_register_offset, negative_register_offset, 1)
+    memory.zero_value_at_offset(product_register_offset)
+    memory.zero_value_at_offset(count_register_offset)
+    memory.zero_value_at_offset(memory.copy_register_offset)
+    memory.zero_value_at_offset(memory.temp_register_offset)
+    memory.add_value_at_offset(1, product_register_offset)
+    memory.open_if_nonzero(negative_register_offset, 1)
+    memory.zero_value_at_offset(right_register_offset)
+    memory.zero_value_at_offset(product_register_offset)
+    memory.close_if_nonzero(negative_register_offset, 1)
+    memory.zero_value_at_offset(negative_register_offset)
+    memory.move_pointer_to_offset(right_register_offset)
+    memory.emit("[")
+    # Copy the count, restoring it through Temp
+    memory.emit("[-")
+    memory.add_value_at_offset(1, count_register_offset)
+    memory.add_value_at_offset(1, memory.temp_register_offset)
+    memory.move_pointer_to_offset(right_register_offset)
+    memory.emit("]")
+    memory.move_register(memory.temp_register_offset, right_register_offset)
+    memory.multiply(count_register_offset,
+                    product_register_offset,
+                    memory.copy_register_offset,
+                    memory.temp_register_offset)
+    memory.zero_value_at_offset(product_register_offset)
+    memory.move_register(memory.copy_register_offset,
+                         product_register_offset)
+    memory.subtract_value_at_offset(1, right_register_offset)
+    memory.emit("]")
+    memory.move_register(product_register_offset, target_register)
 
 def square_expression(target_register, memory):
-    temp_register_offset = memory.temp_register_offset
-    # Keep copy Right into Loop and use Loop like Right in the Mul
-    # function
-    output_brainfuck = ""
-    output_brainfuck += memory.zero_value_at_offset(
-        memory.loop_register_offset)
-    output_brainfuck += memory.zero_value_at_offset(
-        memory.temp_register_offset)
-    output_brainfuck += memory.copy_register(memory.right_register_offset,
-                                             memory.loop_register_offset)
-    output_brainfuck += memory.move_pointer_to_offset(
-        memory.right_register_offset)
-    output_brainfuck += "[-" + memory.reset_pointer()
-    output_brainfuck += memory.copy_register(memory.loop_register_offset,
-                                             temp_register_offset)
-    output_brainfuck += memory.move_pointer_to_offset(
-        memory.right_register_offset)
-    output_brainfuck += "]" + memory.reset_pointer()
-    output_brainfuck += memory.zero_value_at_offset(
-        memory.loop_register_offset)
-    output_brainfuck += memory.copy_register(temp_register_offset,
-                                             target_register)
-    output_brainfuck += memory.zero_value_at_offset(
-        temp_register_offset)
-    return output_brainfuck
+    split_right_register(memory)
+    memory.multiply(memory.loop_register_offset,
+                    memory.retrieve_register_offset,
+                    target_register,
+                    memory.temp_register_offset)
+    memory.zero_value_at_offset(memory.retrieve_register_offset)
+
+def split_right_register(memory):
+    """Moves Right into both Loop and Retrieve, for multiplying it by
+    itself, and zeroes Temp to restore through"""
+    memory.zero_value_at_offset(memory.loop_register_offset)
+    memory.zero_value_at_offset(memory.retrieve_register_offset)
+    memory.zero_value_at_offset(memory.temp_register_offset)
+    memory.move_pointer_to_offset(memory.right_register_offset)
+    memory.emit("[-")
+    memory.add_value_at_offset(1, memory.loop_register_offset)
+    memory.add_value_at_offset(1, memory.retrieve_register_offset)
+    memory.move_pointer_to_offset(memory.right_register_offset)
+    memory.emit("]")
 
 def sqrt_expression(target_register, memory):
-    output_brainfuck = ""
-    return output_brainfuck
+    # Take away 1, 3, 5 and so on from Right for as long as it lasts,
+    # counting how many odd numbers went in whole: divmod with the
+    # divisor growing by two each time. About 20 steps per unit of
+    # Right, so at most 20 * 2 ** (cell bits - 1) once a negative Right
+    # has been found, see split_sign, and replaced with 0.
+    negative_register_offset = memory.test_cell_offset() + 15
+    memory.split_sign(memory.right_register_offset,
+                      negative_register_offset, 1)
+    memory.open_if_nonzero(negative_register_offset, 1)
+    memory.zero_value_at_offset(memory.right_register_offset)
+    memory.close_if_nonzero(negative_register_offset, 1)
+    memory.zero_value_at_offset(negative_register_offset)
+    memory.zero_value_at_offset(memory.loop_register_offset)
+    memory.zero_value_at_offset(memory.temp_register_offset)
+    memory.add_value_at_offset(1, memory.loop_register_offset)
+    if target_register == memory.right_register_offset:
+        memory.zero_value_at_offset(memory.retrieve_register_offset)
+        memory.move_register(memory.right_register_offset,
+                             memory.retrieve_register_offset)
+        dividend_register_offset = memory.retrieve_register_offset
+    else:
+        dividend_register_offset = memory.right_register_offset
+    memory.divmod(dividend_register_offset,
+                  memory.loop_register_offset,
+                  target_register,
+                  memory.temp_register_offset,
+                  growth=2)
+    memory.zero_value_at_offset(memory.temp_register_offset)
 
 def twice_expression(target_register, memory):
-    # Keep copying Left into Target until Loop runs out
-    output_brainfuck = ""
-    output_brainfuck += memory.move_pointer_to_offset(
-        memory.right_register_offset)
-    output_brainfuck += memory.zero_value_at_offset(
-        memory.temp_register_offset)
-    output_brainfuck += memory.move_pointer_to_offset(
-        memory.right_register_offset)
-    output_brainfuck += "[-" + memory.reset_pointer()
-    output_brainfuck += memory.move_pointer_to_offset(
-        memory.temp_register_offset)
-    output_brainfuck += "++" + memory.reset_pointer()
-    output_brainfuck += memory.move_pointer_to_offset(
-        memory.right_register_offset)
-    output_brainfuck += "]" + memory.reset_pointer()
-    output_brainfuck += memory.copy_register(memory.temp_register_offset,
-                                             target_register)
-    output_brainfuck += memory.zero_value_at_offset(
-        memory.temp_register_offset)
-    return output_brainfuck
-
-def value_of_expression(target_register,
-                        tokens,
-                        memory,
-                        offset):
-    character = extract_next_elements(tokens, 2, offset)[1]
-    output_brainfuck = ""
+    scaled_expression(target_register, 2, memory)
+
+def value_of_expression(target_register, character, memory):
     if character == "second_person":
-        output_brainfuck += memory.copy_from_second_character_register(
-            target_register)
+        memory.copy_from_second_character_register(target_register)
     elif character == "first_person":
-        output_brainfuck += memory.copy_from_first_character_register(
-            target_register)
+        memory.copy_from_first_character_register(target_register)
     else:
         character_register = memory.character_to_offset[character]
-        output_brainfuck += memory.copy_register(character_register,
-                                                target_register)
-    return output_brainfuck
-def const_expression(target_register,
-                     tokens,
-                     memory,
-                     offset):
-    value = int(extract_next_elements(tokens, 2, offset)[1])
-    sign = "+" if value > 0 else "-"
-    value = value if value > 0 else -value
-    output_brainfuck = ""
-    output_brainfuck += memory.move_pointer_to_offset(target_register)
-    output_brainfuck += sign * value
-    output_brainfuck += memory.reset_pointer()
-    return output_brainfuck
+        memory.copy_register(character_register, target_register)
+
+def const_expression(target_register, value, memory):
+    memory.add_constant_at_offset(value, target_register)
 
 def evaluate_expression(target_register, tokens, memory, offset):
-    """Returns the brainfuck for evaluating an expression and moving
-    the result into Result."""
-    output_brainfuck = ""
+    """Emits the brainfuck for evaluating an expression and moving
+    the result into Result. Returns the offset of the token following
+    the expression."""
+    expression, new_offset = parse_expression(tokens, offset)
+    expression = fold_expression(expression, memory.cell_bits)
+    emit_expression(target_register, expression, memory)
+    return new_offset
+
+def parse_expression(tokens, offset):
+    """Reads the expression starting at the offset into a tree of
+    tuples: (operation, left, right) for binary operations,
+    (operation, argument) for unary ones, ("const", value) and
+    ("value_of", character). Returns the tree along with the offset of
+    the token following the expression."""
+    expression = tokens[offset]
+    if expression in BINARY_EXPRESSION_FUNCTION_MAP:
+        left, right_offset = parse_expression(tokens, offset + 1)
+        right, end_offset = parse_expression(tokens, right_offset)
+        return (expression, left, right), end_offset + 1
+    elif expression in UNARY_EXPRESSION_FUNCTION_MAP:
+        argument, end_offset = parse_expression(tokens, offset + 1)
+        return (expression, argument), end_offset + 1
+    elif expression == "const":
+        return (expression, int(tokens[offset + 1])), offset + 2
+    elif expression in TERMINAL_FUNCTION_MAP:
+        return (expression, tokens[offset + 1]), offset + 2
+    print(expression)
+    print(tokens[offset-5:offset+5])
+    raise Exception("Expression not found.")
+
+def fold_expression(expression, cell_bits=None):
+    """Replaces every part of an expression tree that only depends on
+    constants with the constant it works out to, and drops additions
+    of zero, multiplications by one and so on. Anything times zero is
+    zero, since working out the other side has no side effects."""
+    operation = expression[0]
+    if operation in TERMINAL_FUNCTION_MAP:
+        return expression
+    arguments = [fold_expression(argument, cell_bits)
+                 for argument in expression[1:]]
+    values = [argument[1] if argument[0] == "const" else None
+              for argument in arguments]
+    if None not in values:
+        value = fold_constants(operation, values, cell_bits)
+        if value is not None:
+            return ("const", value)
+    if operation in BINARY_EXPRESSION_FUNCTION_MAP:
+        left, right = arguments
+        if operation == "add" and values[0] == 0:
+            return right
+        if operation in ("add", "sub") and values[1] == 0:
+            return left
+        if operation == "mul" and 0 in values:
+            return ("const", 0)
+        if operation == "mul" and values[0] == 1:
+            return right
+        if operation in ("mul", "div") and values[1] == 1:
+            return left
+        if operation == "mul" and values[0] is not None:
+            # Multiplication loops on its left operand
+            return (operation, right, left)
+    return (operation,) + tuple(arguments)
+
+def fold_constants(operation, values, cell_bits=None):
+    """Works out an operation on constants the way the SPL library
+    does. Returns None where that would be an error at runtime, or a
+    number too big to be worth putting in the program. Division, modulo
+    and square roots depend on the whole value, so aren't folded if it
+    would wrap round in a cell of the given width."""
+    if operation in ("div", "mod", "sqrt") and cell_bits is not None:
+        half = 2 ** (cell_bits - 1)
+        if any(value < -half or value >= half for value in values):
+            return None
+    if operation == "add":
+        value = values[0] + values[1]
+    elif operation == "sub":
+        value = values[0] - values[1]
+    elif operation == "mul":
+        value = values[0] * values[1]
+    elif operation in ("div", "mod"):
+        dividend, divisor = values
+        if divisor == 0:
+            return None
+        # C division, rounding towards zero
+        quotient = abs(dividend) // abs(divisor)
+        if (dividend < 0) != (divisor < 0):
+            quotient = -quotient
+        if operation == "div":
+            value = quotient
+        else:
+            value = dividend - divisor * quotient
+    elif operation == "twice":
+        value = values[0] * 2
+    elif operation == "square":
+        value = values[0] ** 2
+    elif operation == "cube":
+        value = values[0] ** 3
+    elif operation == "sqrt":
+        if values[0] < 0:
+            return None
+        value = math.isqrt(values[0])
+    elif operation == "factorial":
+        if values[0] < 0 or values[0] > 20:
+            return None
+        value = math.factorial(values[0])
+    else:
+        return None
+    if abs(value) >= 2 ** 32 and cell_bits is None:
+        return None
+    return value
+
+def emit_expression(target_register, expression, memory):
+    """Emits the brainfuck for an expression tree, leaving the result in
+    the target register"""
     # We need to figure out which order we have to evaluate the
     # expressions in to avoid clobbering any values.
     # For binary operations, we can load each argument into a register
     # but this gets hard if each argument is a binary operation itself.
     # We'll use a third register to hold one of the results if necessary.
 
-    # Pluck off the top token and evaluate its arguments and slam them
-    # into the Left/Right/Spare register if necessary
-    expression = tokens[offset]
-    new_offset = 0
-    if expression in binary_expression_function_map().keys():
+    # Pluck off the top of the tree and evaluate its arguments and slam
+    # them into the Left/Right/Spare register if necessary
+    operation = expression[0]
+    if (operation == "mul" and expression[2][0] == "const" and
+            abs(memory.nearest_amount(expression[2][1])) <= MAX_SCALE_FACTOR):
+        # Small constant factors go straight into a move loop
+        memory.mark(operation + " expression")
+        evaluate_unary_expression(target_register, expression, memory)
+        memory.mark(operation + " expression")
+        scaled_expression(target_register,
+                          memory.nearest_amount(expression[2][1]),
+                          memory)
+
+    elif operation in BINARY_EXPRESSION_FUNCTION_MAP:
         # Figure out if both arguments are binary expressions themselves
         # and if so, use Left and Spare (if argument is left arg) or
         # Right and Spare (if argument is right arg) and then copy
         # the value
-        output_brainfuck, new_offset = evaluate_binary_expression(
-            target_register,
-            tokens,
-            memory,
-            offset+1)
+        memory.mark(operation + " expression")
+        evaluate_binary_expression(target_register, expression, memory)
         # At this point, all the required nested calculations are done
         # and the Left Right registers are correctly populated. Do the
         # calculation and put it where it's meant to go
-        output_brainfuck += binary_expression_function_map()[expression](
-            target_register,
-            memory)
-
-    elif expression in unary_expression_function_map().keys():
-        output_brainfuck, new_offset = evaluate_unary_expression(target_register,
-                                                                 tokens,
-                                                                 memory,
-                                                                 offset+1)
-        output_brainfuck += unary_expression_function_map()[expression](
-            target_register,
-            memory)
-
-    elif expression in terminal_function_map().keys():
-        new_offset = offset + 2
-        output_brainfuck += terminal_function_map()[expression](
-            target_register,
-            tokens,
-            memory,
-            offset)
+        memory.mark(operation + " expression")
+        BINARY_EXPRESSION_FUNCTION_MAP[operation](target_register, memory)
+
+    elif operation in UNARY_EXPRESSION_FUNCTION_MAP:
+        memory.mark(operation + " expression")
+        evaluate_unary_expression(target_register, expression, memory)
+        memory.mark(operation + " expression")
+        UNARY_EXPRESSION_FUNCTION_MAP[operation](target_register, memory)
+
     else:
-        print(expression)
-        print(tokens[offset-5:offset+5])
-        raise Exception("Expression not found.")
-
-    return [output_brainfuck, new_offset]
-
-def evaluate_binary_expression(target_register,
-                               tokens,
-                               memory,
-                               offset):
-    output_brainfuck = ""
-    left_register_offset = memory.get_character_stack_position_offset(
-        "left",
+        memory.mark(operation + " expression")
+        TERMINAL_FUNCTION_MAP[operation](target_register,
+                                         expression[1],
+                                         memory)
+
+def evaluate_binary_expression(target_register, expression, memory):
+    left_register_offset = memory.left_operand_offset(
         memory.left_register_counter)
-    output_brainfuck += memory.zero_value_at_offset(left_register_offset)
-    output_brainfuck += memory.zero_value_at_offset(memory.right_register_offset)
+    memory.zero_value_at_offset(left_register_offset)
+    memory.zero_value_at_offset(memory.right_register_offset)
     memory.left_register_counter += 1
-    left_brainfuck, right_offset = evaluate_expression(
-        left_register_offset,
-        tokens,
-        memory,
-        offset)
-    right_brainfuck, end_offset = evaluate_expression(
-        memory.right_register_offset,
-        tokens,
-        memory,
-        right_offset)
-    output_brainfuck += left_brainfuck + right_brainfuck
+    emit_expression(left_register_offset, expression[1], memory)
+    emit_expression(memory.right_register_offset, expression[2], memory)
     memory.left_register_counter -= 1
-    return [output_brainfuck, end_offset + 1]
-
-def evaluate_unary_expression(target_register,
-                              tokens,
-                              memory,
-                              offset):
-    output_brainfuck = ""
-    output_brainfuck += memory.zero_value_at_offset(memory.right_register_offset)
-    eval_brainfuck, new_offset = evaluate_expression(
-        memory.right_register_offset,
-        tokens,
-        memory,
-        offset)
-    output_brainfuck += eval_brainfuck
-    return [output_brainfuck, new_offset+1]
+
+def evaluate_unary_expression(target_register, expression, memory):
+    memory.zero_value_at_offset(memory.right_register_offset)
+    emit_expression(memory.right_register_offset, expression[1], memory)
 
 def extract_next_elements(tokens, number_of_elements, offset):
     """Starting from the offset element of the tokens array, extract the
     next N elements."""
     return tokens[offset:offset + number_of_elements]
 
-def extract_elements_between_tokens(tokens, token_pair, offset):
+def extract_elements_between_tokens(tokens, token_pair, offset, bookends):
     """Starting from the offset element of the tokens array, find all
-    elements between the first occurrence of the start token and the
-    first occurrence of the end token."""
-    elements = []
-    start_token, end_token = token_pair[0], token_pair[1]
-    empty_exp = start_token + "," + end_token
-    reg_exp = start_token + ",(.*?)," + end_token
-
-    string_to_search = ",".join(tokens[offset:])
-    empty_match = re.match(empty_exp, string_to_search)
-    if empty_match:
+    elements between the start token at the offset and its matching
+    end token, as recorded by index_bookends."""
+    if tokens[offset] != token_pair[0] or offset not in bookends:
         return []
-
-    reg_match = re.match(reg_exp, string_to_search)
-    if reg_match:
-        elements = reg_match.group(1)
-        elements = elements.split(",")
-    else:
-        elements = []
-    return elements
+    return tokens[offset + 1:bookends[offset]]
+
+def index_jump_targets(tokens):
+    """Returns the set of act and scene labels that some goto in the
+    tokens jumps to, as ("act", act) and ("scene", act, scene)"""
+    targets = set()
+    for idx, token in enumerate(tokens):
+        if token != "goto":
+            continue
+        goto = extract_next_elements(tokens, 5, idx)
+        if len(goto) == 5 and goto[3] == "scene":
+            targets.add(("scene", goto[2], goto[4]))
+        else:
+            targets.add(("act", goto[2]))
+    return targets
+
+def expression_depth(tokens):
+    """Returns how deeply binary expressions nest in the tokens, which
+    is how many Left operands can be needed at once"""
+    starts = set(pair[0] for pair in BINARY_EXPRESSION_PAIRS.values())
+    ends = set(pair[1] for pair in BINARY_EXPRESSION_PAIRS.values())
+    depth = deepest = 0
+    for token in tokens:
+        if token in starts:
+            depth += 1
+            deepest = max(deepest, depth)
+        elif token in ends:
+            depth -= 1
+    return deepest
+
+def index_bookends(tokens):
+    """Makes a single pass over the tokens, pairing every start token
+    from the token and binary expression pairs with its end token.
+    Returns a map of start index to end index, so that looking up the
+    extent of a bookended section never rescans the rest of the file."""
+    end_to_start = {}
+    for start_token, end_token in (list(TOKEN_PAIRS.values()) +
+                                   list(BINARY_EXPRESSION_PAIRS.values())):
+        end_to_start[end_token] = start_token
+    open_tokens = {start_token: [] for start_token in end_to_start.values()}
+    bookends = {}
+    for idx, token in enumerate(tokens):
+        if token in open_tokens:
+            open_tokens[token].append(idx)
+        elif token in end_to_start:
+            starts = open_tokens[end_to_start[token]]
+            if starts:
+                bookends[starts.pop()] = idx
+    return bookends
+
+# Truth, Down, Up, Countdown, Countup and the sign cells with their
+# flags and zero cells, see MemoryLayout.test_cell_offset
+TEST_CELLS = 18
+
+# How far split_sign races a value towards zero before finding its sign
+# bit instead, by cell width: about as far as finding the bit costs
+SIGN_RACE_LIMIT = {8: 24, 16: 80, 32: 280}
+
+# Digit cells needed to print any value of a cell that many bits wide.
+# When the width isn't known, anything past the 32 bit count is printed
+# by print_leftover_digits
+DIGIT_SLOTS = {8: 3, 16: 5, 32: 10, None: 10}
+
+# The cell width of the bundled executor and of C output when --cell-bits
+# isn't given, which anything run there is compiled for
+DEFAULT_CELL_BITS = 8
+
+# The largest constant that mul puts straight into a move loop, rather
+# than looping on
+MAX_SCALE_FACTOR = 64
+
+# Dispatch tables are built once at import time rather than on every
+# lookup
+TOKEN_FUNCTION_MAP = {"chars": setup_memory_offsets,
+                      "enter_scene_multiple": enter_characters,
+                      "exit_scene_multiple": exit_characters,
+                      "enter_scene": enter_character,
+                      "exit_scene": exit_character,
+                      "activate": activate_character,
+                      "actlabel": act_label,
+                      "scenelabel": scene_label,
+                      "assign": assign,
+                      "push": push,
+                      "pop": pop,
+                      "output": output_character,
+                      "int_output": output_number,
+                      "int_input": input_number,
+                      "char_input": input_character,
+                      "break": breakpoint,
+                      "goto": goto,
+                      "set_left_comp": set_left_comp,
+                      "set_right_comp": set_right_comp,
+                      "equal_to": comparison,
+                      "greater_than": comparison,
+                      "less_than": comparison,
+                      "not": negation,
+                      "if": conditional,
+                      "endif": end_conditional,
+                      "line": source_line}
+
+TOKEN_PAIRS = {"chars": ["chars", "endchars"],
+               "enter_scene_multiple": ["enter_scene_multiple",
+                                        "end_enter_scene_multiple"],
+               "exit_scene_multiple": ["exit_scene_multiple",
+                                       "end_exit_scene_multiple"],
+               "assign": ["assign",
+                          "end_assign"],
+               "push": ["push",
+                        "end_push"],
+               "set_left_comp": ["set_left_comp",
+                                 "end_set_left_comp"],
+               "set_right_comp": ["set_right_comp",
+                                  "end_set_right_comp"]}
+
+BINARY_EXPRESSION_FUNCTION_MAP = {"add": add_expression,
+                                  "sub": sub_expression,
+                                  "mul": mul_expression,
+                                  "mod": mod_expression,
+                                  "div": div_expression}
+
+BINARY_EXPRESSION_PAIRS = {"add": ["add", "end_add"],
+                           "sub": ["sub", "end_sub"],
+                           "mul": ["mul", "end_mul"],
+                           "mod": ["mod", "end_mod"],
+                           "div": ["div", "end_div"]}
+
+UNARY_EXPRESSION_FUNCTION_MAP = {"cube": cube_expression,
+                                 "factorial": factorial_expression,
+                                 "square": square_expression,
+                                 "sqrt": sqrt_expression,
+                                 "twice": twice_expression}
+
+TERMINAL_FUNCTION_MAP = {"value_of": value_of_expression,
+                         "const": const_expression}
 
 def token_function_map():
-    function_map = {"chars": setup_memory_offsets,
-                    "enter_scene_multiple": enter_characters,
-                    "exit_scene_multiple": exit_characters,
-                    "enter_scene": enter_character,
-                    "exit_scene": exit_character,
-                    "activate": activate_character,
-                    "assign": assign,
-                    "output": output_character,
-                    "break": breakpoint}
-    return function_map
+    return TOKEN_FUNCTION_MAP
 
 def token_pairs():
-    pairs_map = {"chars": ["chars", "endchars"],
-                 "enter_scene_multiple": ["enter_scene_multiple",
-                                          "end_enter_scene_multiple"],
-                 "exit_scene_multiple": ["exit_scene_multiple",
-                                         "end_exit_scene_multiple"],
-                 "assign": ["assign",
-                            "end_assign"]}
-    return pairs_map
+    return TOKEN_PAIRS
 
 def binary_expression_function_map():
-    function_map = {"add": add_expression,
-                    "sub": sub_expression,
-                    "mul": mul_expression,
-                    "mod": mod_expression,
-                    "div": div_expression}
-    return function_map
+    return BINARY_EXPRESSION_FUNCTION_MAP
 
 def binary_expression_pairs():
-    pairs_map = {"add": ["add", "end_add"],
-                 "sub": ["sub", "end_sub"],
-                 "mul": ["mul", "end_mul"],
-                 "mod": ["mod", "end_mod"],
-                 "div": ["div", "end_div"]}
-    return pairs_map
+    return BINARY_EXPRESSION_PAIRS
 
 def unary_expression_function_map():
-    function_map = {"cube": cube_expression,
-                    "factorial": factorial_expression,
-                    "square": square_expression,
-                    "sqrt": sqrt_expression,
-                    "twice": twice_expression}
-    return function_map
+    return UNARY_EXPRESSION_FUNCTION_MAP
 
 def terminal_function_map():
-    function_map = {"value_of": value_of_expression,
-                    "const": const_expression}
-    return function_map
-
-def tidy_up(brainfuck):
-    """Removes adjacent <>"""
-    def balance(match):
-        string = match.group(0)
-        while len(string) > 1 and string[0] != string[-1]:
-            string = string[1:-1]
-        return string
-    brainfuck = re.sub('<+>+', balance, brainfuck)
-    brainfuck = re.sub('>+<+', balance, brainfuck)
-    return brainfuck
+    return TERMINAL_FUNCTION_MAP
+
+def frequency_layout(file_text, dispatch="linear"):
+    """Compiles the NSPL once with the default declaration-order layout
+    while counting register usage, then arranges the registers and
+    characters so that the busiest cells, and the cells the pointer
+    most often travels between, sit next to each other. Returns the
+    cell layout for MemoryLayout along with a readable report."""
+    memory = MemoryLayout(dispatch)
+    memory.usage = RegisterUsage()
+    parse_file(file_text, memory)
+    usage = memory.usage
+    offsets = range(memory.layout_size())
+
+    def closeness(offset, other):
+        pair = (min(offset, other), max(offset, other))
+        return usage.transitions.get(pair, 0)
+
+    # Greedily grow a line of cells outwards from the busiest one. Each
+    # step takes the unplaced cell most connected to those already
+    # placed and adds it to whichever end of the line is nearer to its
+    # neighbours. Cells that are never visited go at the far end.
+    unplaced = [offset for offset in offsets if usage.visits.get(offset)]
+    unplaced.sort(key=lambda offset: -usage.visits[offset])
+    line = unplaced[:1]
+    del unplaced[:1]
+    while unplaced:
+        best = max(unplaced, key=lambda offset: (
+            sum(closeness(offset, placed) for placed in line),
+            usage.visits[offset]))
+        unplaced.remove(best)
+        cost_left = sum(closeness(best, placed) * (idx + 1)
+                        for idx, placed in enumerate(line))
+        cost_right = sum(closeness(best, placed) * (len(line) - idx)
+                         for idx, placed in enumerate(line))
+        if cost_left < cost_right:
+            line.insert(0, best)
+        else:
+            line.append(best)
+    line += [offset for offset in offsets if offset not in line]
+    cell_layout = {offset: cell for cell, offset in enumerate(line)}
+
+    names = memory.offset_names()
+    report = ["Frequency layout (offset -> cell, weighted visits):"]
+    for cell, offset in enumerate(line):
+        report.append("  %-24s %3d -> %3d %8d" % (
+            names.get(offset, "?"), offset, cell,
+            usage.visits.get(offset, 0)))
+    report.append("Estimated pointer travel: %d with declaration layout, "
+                  "%d with frequency layout" % (usage.travel({}),
+                                                usage.travel(cell_layout)))
+    return cell_layout, "\n".join(report)
+
+def prepare_text(text):
+    """Strips the newlines and trailing comma from NSPL text, leaving
+    the comma separated tokens parse_file works through"""
+    text = re.sub('\n', '', text)
+    return re.sub(', *$', '', text)
+
+def source_lines(tokens):
+    """Returns the line of the play each token comes from, going by
+    the line annotations in the tokens, or None before the first"""
+    lines = []
+    line = None
+    for idx, token in enumerate(tokens):
+        if token == "line" and idx + 1 < len(tokens):
+            line = int(tokens[idx + 1])
+        lines.append(line)
+    return lines
+
+def source_scenes(tokens):
+    """Returns the act and scene each token is in, as a pair of roman
+    numerals like ("i", "iii"), or None before the first scene"""
+    scenes = []
+    scene = None
+    for idx, token in enumerate(tokens):
+        if token == "scenelabel":
+            label = extract_next_elements(tokens, 5, idx)
+            scene = (label[2], label[4])
+        scenes.append(scene)
+    return scenes
+
+def describe_scene(scene):
+    """Names an act and scene from source_scenes the way the play does"""
+    if scene is None:
+        return "Outside any scene"
+    return "Act %s, Scene %s" % (scene[0].upper(), scene[1].upper())
+
+def profile_stacks(text, profile):
+    """Breaks down the steps and tape accesses in a brainfuck.Profile of
+    running a program transpiled from the NSPL text with marking by
+    where they happened in the play. Returns a map from stacks like
+    (scene, line, statement, expression) to (steps, accesses), where
+    the scene is from source_scenes and the expression is None for
+    code generated by the statement itself."""
+    tokens = prepare_text(text).split(',')
+    lines = source_lines(tokens)
+    scenes = source_scenes(tokens)
+    stacks = {}
+    for label in set(profile.steps) | set(profile.accesses):
+        if label is None:
+            stack = (None, None, None, None)
+        elif label[1] is None:
+            stack = (None, None, label[0], None)
+        else:
+            name, token = label
+            expression = None if name == tokens[token] else name
+            stack = (scenes[token], lines[token], tokens[token], expression)
+        steps, accesses = stacks.get(stack, (0, 0))
+        stacks[stack] = (steps + profile.steps.get(label, 0),
+                         accesses + profile.accesses.get(label, 0))
+    return stacks
+
+def profile_report(text, profile, top=10):
+    """Returns a report of the top hottest lines of the play, and of
+    every scene, by steps executed in a brainfuck.Profile of running a
+    program transpiled from the NSPL text with marking"""
+    by_line = {}
+    by_scene = {}
+    for (scene, line, statement, expression), counts in profile_stacks(
+            text, profile).items():
+        for totals, key in ((by_line, (scene, line)), (by_scene, scene)):
+            steps, accesses = totals.get(key, (0, 0))
+            totals[key] = (steps + counts[0], accesses + counts[1])
+    total_steps = max(sum(steps for steps, _ in by_scene.values()), 1)
+
+    def rows(totals, describe):
+        ranked = sorted(totals.items(), key=lambda item: -item[1][0])
+        return ["%12d %6.1f%% %12d  %s" % (
+            steps, 100.0 * steps / total_steps, accesses, describe(key))
+            for key, (steps, accesses) in ranked]
+
+    def describe_line(key):
+        scene, line = key
+        if line is None:
+            return describe_scene(scene)
+        return "%s, line %d" % (describe_scene(scene), line)
+
+    heading = "%12s %7s %12s  %s" % ("steps", "", "accesses", "where")
+    report = ["Hottest lines:", heading]
+    report += rows(by_line, describe_line)[:top]
+    report += ["By scene:", heading]
+    report += rows(by_scene, describe_scene)
+    report.append("Highest tape cell touched: %d" % profile.highest_cell)
+    return "\n".join(report)
+
+def folded_stacks(text, profile):
+    """Returns the steps in a brainfuck.Profile as folded stacks, one
+    "scene;line;statement;expression count" line per stack, which is
+    what flamegraph.pl and similar tools read"""
+    folded = []
+    for (scene, line, statement, expression), (steps, _) in sorted(
+            profile_stacks(text, profile).items(),
+            key=lambda item: [(part is not None, part) for part in item[0]]):
+        if not steps:
+            continue
+        frames = [describe_scene(scene)]
+        if line is not None:
+            frames.append("line %d" % line)
+        frames.append(statement or "(start)")
+        if expression:
+            frames.append(expression)
+        folded.append("%s %d" % (";".join(frames), steps))
+    return "\n".join(folded) + "\n"
+
+def source_map(text, program):
+    """Returns a source map for a program transpiled from the NSPL text
+    with marking, as a dict ready to be written out as JSON. Each of
+    its mappings is [start, end, token, line, name]: the Brainfuck
+    bytes from start up to end were generated by the statement or
+    expression name, whose statement starts at that token index in the
+    NSPL, and ends on that line of the play. token and line are null
+    for code not generated by any statement, and line is null if the
+    NSPL has no line annotations."""
+    lines = source_lines(prepare_text(text).split(','))
+    mappings = []
+    for start, end, label in brainfuck.label_ranges(program):
+        if label is None:
+            mappings.append([start, end, None, None, None])
+            continue
+        name, token = label
+        line = None if token is None else lines[token]
+        mappings.append([start, end, token, line, name])
+    return {"version": 1, "mappings": mappings}
+
+def stack_characters(file_text):
+    """Compiles the NSPL once to find whose stacks the play pushes to
+    or pops from, in the order they are first used, so that only those
+    characters need a stack"""
+    memory = MemoryLayout()
+    parse_file(file_text, memory)
+    return memory.stacked
+
+def tidy_up(program, cell_bits=None):
+    """Runs the peephole optimiser over a generated program"""
+    return brainfuck.optimise(program, cell_bits)
+
+def transpile(text,
+              layout="declaration",
+              dispatch="linear",
+              cell_bits=None,
+              timings=None,
+              marking=False):
+    """Transpiles the NSPL output of spl2nspl into an optimised program,
+    see the brainfuck module for its format. Returns the program along
+    with the frequency layout report, or None for the declaration
+    layout. If given a dict for timings, records the seconds spent in
+    parse_file (including any frequency layout pass) and tidy_up. With
+    marking, the program is MARKed with (name, token offset) labels
+    naming the statement or kind of expression that generated it."""
+    start = time.time()
+    text = prepare_text(text)
+    memory = MemoryLayout(dispatch)
+    memory.cell_bits = cell_bits
+    memory.marking = marking
+    tokens = text.split(',')
+    if "push" in tokens or "pop" in tokens:
+        memory.stack_characters = stack_characters(text)
+    report = None
+    if layout == "frequency":
+        memory.cell_layout, report = frequency_layout(text, dispatch)
+    program = parse_file(text, memory)
+    parsed = time.time()
+    program = tidy_up(program, cell_bits)
+    if timings is not None:
+        timings["parse_file"] = parsed - start
+        timings["tidy_up"] = time.time() - parsed
+    return program, report
+
+def add_arguments(parser):
+    """Adds the options controlling code generation to an argparse
+    parser, for this script and for speare2brain"""
+    parser.add_argument("--layout", choices=["declaration", "frequency"],
+                        default="declaration",
+                        help="how to arrange registers and characters on "
+                        "the tape; frequency prints a layout report to "
+                        "stderr")
+    parser.add_argument("--dispatch", choices=["linear", "binary"],
+                        default="linear",
+                        help="how to find the active or second person's "
+                        "register when it is only known at runtime; "
+                        "binary is faster with many characters")
+    parser.add_argument("--cell-bits", type=int, choices=[8, 16, 32],
+                        help="cell width of the target interpreter, if "
+                        "known, so constants can wrap around and numbers "
+                        "get as many digits as they need; running the "
+                        "program or printing C assumes %d"
+                        % DEFAULT_CELL_BITS)
+    parser.add_argument("--target", choices=["bf", "c"], default="bf",
+                        help="print Brainfuck, or a C program to build "
+                        "into a native executable")
+
+def stats_report(program, profile):
+    """Returns a table of how many bytes of a MARKed program, and how
+    many of the steps in a brainfuck.Profile of running it, came from
+    each kind of statement and expression, busiest first"""
+    sizes = {}
+    steps = {}
+    statements = {}
+    for label, size in brainfuck.label_sizes(program).items():
+        name = label[0] if label else "(start)"
+        sizes[name] = sizes.get(name, 0) + size
+        statements.setdefault(name, set()).add(label)
+    for label, count in profile.steps.items():
+        name = label[0] if label else "(start)"
+        steps[name] = steps.get(name, 0) + count
+    total_size = max(sum(sizes.values()), 1)
+    total_steps = max(sum(steps.values()), 1)
+    names = sorted(set(sizes) | set(steps),
+                   key=lambda name: (-steps.get(name, 0),
+                                     -sizes.get(name, 0)))
+    report = ["%-24s %6s %9s %7s %12s %7s" % (
+        "construct", "count", "bytes", "", "steps", "")]
+    for name in names:
+        report.append("%-24s %6d %9d %6.1f%% %12d %6.1f%%" % (
+            name, len(statements.get(name, ())), sizes.get(name, 0),
+            100.0 * sizes.get(name, 0) / total_size, steps.get(name, 0),
+            100.0 * steps.get(name, 0) / total_steps))
+    report.append("%-24s %6s %9d %7s %12d" % (
+        "total", "", sum(sizes.values()), "", sum(steps.values())))
+    return "\n".join(report)
+
+def format_program(program, target="bf", cell_bits=None):
+    """Returns the text of a program for the chosen target"""
+    if target == "c":
+        return brainfuck.to_c(program, cell_bits or DEFAULT_CELL_BITS)
+    return brainfuck.to_brainfuck(program) + "\n"
 
 if __name__ == "__main__":
-    mem = MemoryLayout()
-    if len(sys.argv) < 2:
-        print("Usage: ./nspl2bf.py input.nspl > output.bf")
-        sys.exit(2)
-    filename = sys.argv[1]
+    parser = argparse.ArgumentParser(
+        usage="./nspl2bf.py [options] input.nspl > output.bf")
+    parser.add_argument("filename", help="NSPL file to transpile")
+    add_arguments(parser)
+    parser.add_argument("--stats", action="store_true",
+                        help="run the program and print a table of which "
+                        "statements and expressions its bytes and steps "
+                        "come from to stderr")
+    parser.add_argument("--stats-input", metavar="FILE",
+                        help="what the program reads while running for "
+                        "--stats, nothing if not given")
+    parser.add_argument("--source-map", metavar="FILE",
+                        help="write a JSON map from ranges of the "
+                        "Brainfuck to the NSPL tokens and lines of the "
+                        "play they came from")
+    args = parser.parse_args()
+    if args.source_map and args.target != "bf":
+        parser.error("--source-map maps Brainfuck, not C")
+    if args.cell_bits is None and (args.stats or args.target == "c"):
+        args.cell_bits = DEFAULT_CELL_BITS
+    filename = args.filename
     try:
         f = open(filename, "r")
     except IOError:
         print("Could not find file " + filename, file=sys.stderr)
         sys.exit(2)
     text = f.read()
-    text = re.sub('\n', '', text)
-    text = re.sub(', *$', '', text)
     f.close()
 
-    brainfuck = parse_file(text, mem)
-    brainfuck = tidy_up(brainfuck)
-    print(brainfuck)
+    program, report = transpile(text, args.layout, args.dispatch,
+                                args.cell_bits,
+                                marking=args.stats or bool(args.source_map))
+    if report:
+        print(report, file=sys.stderr)
+    if args.stats:
+        stdin = io.BytesIO()
+        if args.stats_input:
+            with open(args.stats_input, "rb") as f:
+                stdin = io.BytesIO(f.read())
+        profile = brainfuck.Profile()
+        try:
+            brainfuck.run(program, args.cell_bits, stdin=stdin,
+                          stdout=io.BytesIO(), max_steps=100000000,
+                          profile=profile)
+        except (IndexError, RuntimeError) as error:
+            print("Stopped running: " + str(error), file=sys.stderr)
+        print(stats_report(program, profile), file=sys.stderr)
+    if args.source_map:
+        with open(args.source_map, "w") as f:
+            json.dump(source_map(text, program), f)
+    sys.stdout.write(format_program(program, args.target, args.cell_bits))
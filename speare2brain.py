@@ -22,19 +22,376 @@
 #  USA.
 #
 ########################################################################
-import sys, os
-from subprocess import call
+import sys, os, argparse, shlex, tempfile, time, glob, hashlib
+from subprocess import call, run, PIPE
+from multiprocessing import Pool
+import brainfuck, nspl2bf
+
+BASEPATH = os.path.dirname(os.path.realpath(__file__))
+
+class CompileCache:
+    """An on-disk cache of compiler outputs, one file per entry, named
+    after a hash of the input and of everything else that affects the
+    output. A file's modification time records when it was last used,
+    so the least recently used entries are thrown away first once the
+    cache grows past max_bytes."""
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+
+    def key(self, *parts):
+        digest = hashlib.sha256()
+        for part in parts:
+            if isinstance(part, str):
+                part = part.encode()
+            digest.update(part)
+            digest.update(b"\0")
+        return digest.hexdigest()
+
+    def get(self, key):
+        path = os.path.join(self.directory, key)
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except OSError:
+            return None
+        return data
+
+    def put(self, key, data):
+        # Write somewhere else first so that other compiles running at
+        # the same time never see half an entry. A cache that can't be
+        # written to is skipped, like one that can't be read.
+        temporary = None
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+            descriptor, temporary = tempfile.mkstemp(dir=self.directory,
+                                                     suffix=".tmp")
+            with os.fdopen(descriptor, "wb") as f:
+                f.write(data)
+            os.replace(temporary, os.path.join(self.directory, key))
+        except OSError:
+            if temporary:
+                try:
+                    os.remove(temporary)
+                except OSError:
+                    pass
+            return
+        self.evict()
+
+    def entries(self):
+        """Returns (last used, size, path) for every entry"""
+        entries = []
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return entries
+        for name in names:
+            path = os.path.join(self.directory, name)
+            try:
+                status = os.stat(path)
+            except OSError:
+                continue
+            entries.append((status.st_mtime, status.st_size, path))
+        return entries
+
+    def evict(self):
+        entries = sorted(self.entries())
+        total = sum(size for used, size, path in entries)
+        for used, size, path in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total -= size
+
+    def clear(self):
+        for used, size, path in self.entries():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+FILE_DIGESTS = {}
+
+def file_digest(*paths):
+    """Hashes the contents of the files that make up a compiler stage,
+    which stands in for its version. Each is only read once per run."""
+    if paths not in FILE_DIGESTS:
+        digest = hashlib.sha256()
+        for path in paths:
+            with open(path, "rb") as f:
+                digest.update(f.read())
+        FILE_DIGESTS[paths] = digest.hexdigest()
+    return FILE_DIGESTS[paths]
+
+def spl_to_nspl(source):
+    """Pipes SPL source, as bytes, through spl2nspl from the same
+    directory as this script. Returns the NSPL text, or None if
+    spl2nspl found errors, along with any errors or warnings it
+    reported."""
+    path_to_spl2nspl = os.path.join(BASEPATH, "spl2nspl")
+    result = run([path_to_spl2nspl], input=source, stdout=PIPE,
+                 stderr=PIPE)
+    messages = result.stderr.decode(errors="replace")
+    if result.returncode:
+        return None, messages
+    return result.stdout.decode(), messages
+
+def cached_spl_to_nspl(source, cache=None):
+    """spl_to_nspl, skipped if the cache already has the NSPL for the
+    same source and spl2nspl"""
+    nspl_key = text = None
+    if cache:
+        nspl_key = cache.key("nspl", source,
+                             file_digest(os.path.join(BASEPATH, "spl2nspl")))
+        text = cache.get(nspl_key)
+        if text is not None:
+            return text.decode(), ""
+    text, messages = spl_to_nspl(source)
+    if text is not None and cache:
+        cache.put(nspl_key, text.encode())
+    return text, messages
+
+def compile_source(source, args, cache=None):
+    """Compiles SPL source, as bytes, into the text of the chosen
+    target. Either stage is skipped if the cache already has its
+    output for the same input, compiler and options. Returns the
+    output, or None if spl2nspl found errors, along with any messages
+    from spl2nspl and the layout report if there is one. The report is
+    cached alongside the output, and the output isn't used without it
+    if the layout makes one."""
+    text, messages = cached_spl_to_nspl(source, cache)
+    if text is None:
+        return None, messages, None
+
+    output_key = report_key = None
+    if cache:
+        output_key = cache.key(
+            "output", text, file_digest(nspl2bf.__file__, brainfuck.__file__),
+            args.layout, args.dispatch, str(args.cell_bits), args.target)
+        report_key = cache.key("report", output_key)
+        output = cache.get(output_key)
+        report = cache.get(report_key)
+        if output is not None and args.layout != "frequency":
+            return output.decode(), messages, None
+        if output is not None and report is not None:
+            return output.decode(), messages, report.decode()
+    program, report = nspl2bf.transpile(text, args.layout, args.dispatch,
+                                        args.cell_bits)
+    output = nspl2bf.format_program(program, args.target, args.cell_bits)
+    if cache:
+        cache.put(output_key, output.encode())
+        if report is not None:
+            cache.put(report_key, report.encode())
+    return output, messages, report
+
+def compile_file(job):
+    """Compiles one file for batch mode, writing the output next to it
+    or into the output directory. Runs in a worker process, so rather
+    than raising it returns the filename, the output filename, whether
+    it failed, any errors or warnings, the time taken and the size of
+    the output."""
+    filename, output_directory, args, cache = job
+    extension = ".c" if args.target == "c" else ".bf"
+    output_filename = os.path.splitext(filename)[0] + extension
+    if output_directory:
+        output_filename = os.path.join(output_directory,
+                                       os.path.basename(output_filename))
+    start = time.time()
+    messages = ""
+    try:
+        with open(filename, "rb") as f:
+            output, messages, report = compile_source(f.read(), args, cache)
+        if output is None:
+            return (filename, output_filename, True, messages,
+                    time.time() - start, 0)
+        with open(output_filename, "w") as f:
+            f.write(output)
+    except Exception as error:
+        messages += "%s: %s" % (type(error).__name__, error)
+        return (filename, output_filename, True, messages,
+                time.time() - start, 0)
+    return (filename, output_filename, False, messages,
+            time.time() - start, len(output))
+
+def compile_batch(filenames, output_directory, args, cache=None):
+    """Compiles many files at once with one worker process per core,
+    printing a line per file and a summary to stderr. Returns the
+    number of files that failed."""
+    start = time.time()
+    jobs = [(filename, output_directory, args, cache)
+            for filename in filenames]
+    with Pool(min(os.cpu_count() or 1, len(jobs))) as pool:
+        results = sorted(pool.imap_unordered(compile_file, jobs))
+    failures = 0
+    for (filename, output_filename, failed, messages,
+         seconds, size) in results:
+        if failed:
+            failures += 1
+            print("%-30s FAILED %6.2fs" % (filename, seconds),
+                  file=sys.stderr)
+        else:
+            print("%-30s %6.2fs %9d bytes -> %s" % (
+                filename, seconds, size, output_filename), file=sys.stderr)
+        for line in messages.splitlines():
+            print("    " + line, file=sys.stderr)
+    print("%d compiled, %d failed: %.2fs compiling, %.2fs elapsed, "
+          "%d bytes in total" % (
+              len(results) - failures, failures,
+              sum(result[4] for result in results), time.time() - start,
+              sum(result[5] for result in results)), file=sys.stderr)
+    return failures
+
+def profile_source(source, args, cache=None):
+    """Compiles SPL source, as bytes, and runs it in the bundled
+    executor, reporting to stderr which lines and scenes of the play
+    it spent its steps in. Returns the exit status."""
+    text, messages = cached_spl_to_nspl(source, cache)
+    sys.stderr.write(messages)
+    if text is None:
+        return 1
+    program, report = nspl2bf.transpile(text, args.layout, args.dispatch,
+                                        args.cell_bits, marking=True)
+    if report:
+        print(report, file=sys.stderr)
+    profile = brainfuck.Profile()
+    status = 0
+    try:
+        steps = brainfuck.run(program, args.cell_bits, args.tape_size,
+                              profile=profile)
+        if args.steps:
+            print("Steps: %d" % steps, file=sys.stderr)
+    except IndexError as error:
+        print("Error: " + str(error), file=sys.stderr)
+        status = 1
+    print(nspl2bf.profile_report(text, profile, args.profile_top),
+          file=sys.stderr)
+    if args.folded:
+        with open(args.folded, "w") as f:
+            f.write(nspl2bf.folded_stacks(text, profile))
+    return status
+
+def run_native(c_source):
+    """Builds C source with $CC and $CCFLAGS, gcc -O2 by default, and
+    runs the executable. Returns its exit status."""
+    compiler = os.environ.get("CC", "gcc")
+    flags = shlex.split(os.environ.get("CCFLAGS", "-O2"))
+    with tempfile.TemporaryDirectory() as directory:
+        source = os.path.join(directory, "play.c")
+        executable = os.path.join(directory, "play")
+        with open(source, "w") as f:
+            f.write(c_source)
+        status = call([compiler] + flags + [source, "-o", executable])
+        if status:
+            return status
+        return call([executable])
 
 if __name__ == "__main__":
-    if len(sys.argv) < 2:
-        print("Usage: ./speare2brain.py input.spl > output.bf")
-        sys.exit(2)
-    filename = sys.argv[1]
-    path_to_this = os.path.realpath(__file__)
-    basepath = os.path.dirname(path_to_this)
-    path_to_spl2nspl = basepath + '/spl2nspl'
-    command = "{1} < {0} > {0}.nspl".format(filename, path_to_spl2nspl)
-    call(command, shell = True)
-    path_to_nspl2bf = basepath + '/nspl2bf.py'
-    command = "{1} {0}.nspl".format(filename, path_to_nspl2bf)
-    call(command, shell = True)
+    parser = argparse.ArgumentParser(
+        usage="./speare2brain.py [options] [input.spl ...] > output.bf")
+    parser.add_argument("filenames", nargs="*", metavar="filename",
+                        help="SPL files to transpile, stdin if none are "
+                        "given. With more than one, each is written to a "
+                        "file of its own as with --batch")
+    parser.add_argument("--batch", metavar="DIR", action="append",
+                        default=[],
+                        help="compile every .spl file in DIR in parallel, "
+                        "writing each output next to its source")
+    parser.add_argument("--output-dir", metavar="DIR",
+                        help="where batch mode writes its outputs")
+    nspl2bf.add_arguments(parser)
+    parser.add_argument("--run", action="store_true",
+                        help="run the program instead of printing it; "
+                        "with --target c, builds it with $CC first")
+    parser.add_argument("--tape-size", type=int, default=30000,
+                        help="number of cells to run with in the bundled "
+                        "executor")
+    parser.add_argument("--steps", action="store_true",
+                        help="when running, print the number of "
+                        "instructions executed to stderr")
+    parser.add_argument("--profile", action="store_true",
+                        help="run the program in the bundled executor and "
+                        "report the lines and scenes it spends its steps "
+                        "in to stderr")
+    parser.add_argument("--profile-top", metavar="N", type=int, default=10,
+                        help="how many of the hottest lines to report")
+    parser.add_argument("--folded", metavar="FILE",
+                        help="with --profile, also write the steps as "
+                        "folded stacks for flamegraph.pl")
+    parser.add_argument("--cache-dir", metavar="DIR",
+                        default=os.environ.get("SPEARE2BRAIN_CACHE",
+                            os.path.join(os.environ.get("XDG_CACHE_HOME",
+                                os.path.expanduser("~/.cache")),
+                                "speare2brain")),
+                        help="where to cache compiled output, "
+                        "$SPEARE2BRAIN_CACHE or ~/.cache/speare2brain by "
+                        "default")
+    parser.add_argument("--cache-size", metavar="MB", type=float,
+                        default=64,
+                        help="how big the cache may grow before the least "
+                        "recently used entries are removed")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="neither read nor write the cache")
+    parser.add_argument("--clear-cache", action="store_true",
+                        help="empty the cache before compiling")
+    args = parser.parse_args()
+    if args.cell_bits is None and (args.run or args.profile
+                                   or args.target == "c"):
+        # Compile for the width the program will be run at
+        args.cell_bits = nspl2bf.DEFAULT_CELL_BITS
+    cache = CompileCache(args.cache_dir, int(args.cache_size * 1024 * 1024))
+    if args.clear_cache:
+        cache.clear()
+        if not args.filenames and not args.batch:
+            sys.exit(0)
+    if args.no_cache:
+        cache = None
+    filenames = args.filenames
+    for directory in args.batch:
+        filenames += sorted(glob.glob(os.path.join(directory, "*.spl")))
+    if args.batch or len(filenames) > 1:
+        if args.run or args.profile:
+            parser.error("--run and --profile take a single file")
+        if not filenames:
+            print("No .spl files found", file=sys.stderr)
+            sys.exit(2)
+        failures = compile_batch(filenames, args.output_dir, args, cache)
+        sys.exit(1 if failures else 0)
+
+    if filenames:
+        try:
+            f = open(filenames[0], "rb")
+        except IOError:
+            print("Could not find file " + filenames[0], file=sys.stderr)
+            sys.exit(2)
+        source = f.read()
+        f.close()
+    else:
+        source = sys.stdin.buffer.read()
+    if args.profile:
+        if args.target != "bf":
+            parser.error("--profile runs Brainfuck, not C")
+        sys.exit(profile_source(source, args, cache))
+    output, messages, report = compile_source(source, args, cache)
+    sys.stderr.write(messages)
+    if output is None:
+        sys.exit(1)
+    if report:
+        print(report, file=sys.stderr)
+
+    if args.run and args.target == "c":
+        sys.exit(run_native(output))
+    if not args.run:
+        sys.stdout.write(output)
+        sys.exit(0)
+    program = brainfuck.optimise(brainfuck.parse(output), args.cell_bits)
+    try:
+        steps = brainfuck.run(program, args.cell_bits, args.tape_size)
+    except IndexError as error:
+        print("Error: " + str(error), file=sys.stderr)
+        sys.exit(1)
+    if args.steps:
+        print("Steps: %d" % steps, file=sys.stderr)
@@ -0,0 +1,64 @@
+#!/usr/bin/python3
+
+########################################################################
+#
+#  Speare2Brain, the Shakespeare -> Brainfuck transpiler
+#
+#  Copyright (C) 2014 Matthew Darby
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or (at
+#  your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful, but
+#  WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#  General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+#  USA.
+#
+########################################################################
+"""Tests for the brainfuck module. Run with python3 -m unittest."""
+import io, unittest
+import brainfuck
+
+class WrittenOutput(io.BytesIO):
+    """Records what had been written each time it is flushed"""
+    def __init__(self):
+        super().__init__()
+        self.flushed = []
+
+    def flush(self):
+        self.flushed.append(self.getvalue())
+
+class RunOutputTest(unittest.TestCase):
+    def run_text(self, text, **options):
+        program = brainfuck.optimise(brainfuck.parse(text))
+        output = WrittenOutput()
+        return output, lambda: brainfuck.run(program, stdout=output,
+                                             **options)
+
+    def test_output_kept_on_error(self):
+        # Prints AB, then moves off the left end of the tape
+        output, run = self.run_text("++++++++[>++++++++<-]>+.+.<<<.")
+        self.assertRaises(IndexError, run)
+        self.assertEqual(output.getvalue(), b"AB")
+
+    def test_output_kept_at_step_limit(self):
+        output, run = self.run_text("+++++[>++++++++++<-]>.[]",
+                                    max_steps=100)
+        self.assertRaises(RuntimeError, run)
+        self.assertEqual(output.getvalue(), b"2")
+
+    def test_written_at_newline(self):
+        # A newline, then a long loop
+        output, run = self.run_text("++++++++++.>+[++]", max_steps=1000)
+        self.assertRaises(RuntimeError, run)
+        self.assertIn(b"\n", output.flushed)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,75 @@
+#!/usr/bin/python3
+
+########################################################################
+#
+#  Speare2Brain, the Shakespeare -> Brainfuck transpiler
+#
+#  Copyright (C) 2014 Matthew Darby
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or (at
+#  your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful, but
+#  WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#  General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+#  USA.
+#
+########################################################################
+"""Tests for nspl2bf, compiling small NSPL plays and running them in
+the bundled executor. Run with python3 -m unittest."""
+import io, unittest
+import brainfuck, nspl2bf
+
+# Two characters on stage, the first activated, so that the second is
+# the one spoken to
+PLAY = ("chars,a,b,endchars,actlabel,act,i,endactlabel,"
+        "scenelabel,act,i,scene,i,endscenelabel,"
+        "enter_scene_multiple,a,b,end_enter_scene_multiple,activate,a,")
+NEWLINE = "assign,const,10,end_assign,output,"
+
+def run_play(body, cell_bits, max_steps=1000000, **options):
+    """Compiles a play with the given statements and runs it at the
+    same cell width, returning what it printed"""
+    program, report = nspl2bf.transpile(PLAY + body, cell_bits=cell_bits,
+                                        **options)
+    output = io.BytesIO()
+    brainfuck.run(program, cell_bits, stdin=io.BytesIO(), stdout=output,
+                  max_steps=max_steps)
+    return output.getvalue()
+
+class StackTest(unittest.TestCase):
+    VALUES = [-1, 5, 0, -100, 127, -128, -7]
+
+    def push_and_pop(self, cell_bits, **options):
+        body = "".join("push,const,%d,end_push," % value
+                       for value in self.VALUES)
+        body += ("pop,int_output," + NEWLINE) * (len(self.VALUES) + 1)
+        expected = b"".join(b"%d\n" % value
+                            for value in reversed(self.VALUES))
+        # Popping an empty stack gives zero
+        expected += b"0\n"
+        self.assertEqual(run_play(body, cell_bits, **options), expected)
+
+    def test_negative_values_16_bits(self):
+        self.push_and_pop(16)
+
+    def test_negative_values_unbounded(self):
+        self.push_and_pop(None)
+
+    def test_negative_values_binary_dispatch(self):
+        self.push_and_pop(16, layout="frequency", dispatch="binary")
+
+    def test_cost_follows_magnitude(self):
+        # Pushing and popping -1 used to carry it round the whole cell
+        body = "push,const,-1,end_push,pop,int_output," + NEWLINE
+        self.assertEqual(run_play(body, 32, max_steps=20000), b"-1\n")
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,75 @@
+#!/usr/bin/python3
+
+########################################################################
+#
+#  Speare2Brain, the Shakespeare -> Brainfuck transpiler
+#
+#  Copyright (C) 2014 Matthew Darby
+#
+#  This program is free software; you can redistribute it and/or modify
+#  it under the terms of the GNU General Public License as published by
+#  the Free Software Foundation; either version 2 of the License, or (at
+#  your option) any later version.
+#
+#  This program is distributed in the hope that it will be useful, but
+#  WITHOUT ANY WARRANTY; without even the implied warranty of
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU
+#  General Public License for more details.
+#
+#  You should have received a copy of the GNU General Public License
+#  along with this program; if not, write to the Free Software
+#  Foundation, Inc., 59 Temple Place - Suite 330, Boston, MA 02111-1307,
+#  USA.
+#
+########################################################################
+"""Tests for speare2brain. Run with python3 -m unittest."""
+import argparse, os, subprocess, sys, tempfile, unittest
+from unittest import mock
+import speare2brain
+
+HELLO = ("chars,a,b,endchars,actlabel,act,i,endactlabel,"
+         "scenelabel,act,i,scene,i,endscenelabel,"
+         "enter_scene_multiple,a,b,end_enter_scene_multiple,activate,a,"
+         "assign,const,72,end_assign,output,")
+
+class UnusableCacheTest(unittest.TestCase):
+    def setUp(self):
+        # A file where the cache directory should be, so that nothing
+        # can be created in it
+        descriptor, self.blocker = tempfile.mkstemp()
+        os.close(descriptor)
+        self.directory = os.path.join(self.blocker, "cache")
+
+    def tearDown(self):
+        os.remove(self.blocker)
+
+    def test_put_is_skipped(self):
+        cache = speare2brain.CompileCache(self.directory, 1024)
+        cache.put("key", b"data")
+        self.assertIsNone(cache.get("key"))
+
+    def test_compile_carries_on(self):
+        cache = speare2brain.CompileCache(self.directory, 1024)
+        args = argparse.Namespace(layout="declaration", dispatch="linear",
+                                  cell_bits=8, target="bf")
+        with mock.patch.object(speare2brain, "cached_spl_to_nspl",
+                               return_value=(HELLO, "")):
+            output, messages, report = speare2brain.compile_source(
+                b"", args, cache)
+        self.assertTrue(output)
+
+    @unittest.skipUnless(os.path.exists(os.path.join(speare2brain.BASEPATH,
+                                                     "spl2nspl")),
+                         "spl2nspl isn't built")
+    def test_command_line(self):
+        script = os.path.join(speare2brain.BASEPATH, "speare2brain.py")
+        play = os.path.join(speare2brain.BASEPATH, "examples", "hello.spl")
+        result = subprocess.run([sys.executable, script, "--cache-dir",
+                                 self.directory, "--run", play],
+                                stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE)
+        self.assertEqual(result.returncode, 0, result.stderr)
+        self.assertTrue(result.stdout)
+
+if __name__ == "__main__":
+    unittest.main()